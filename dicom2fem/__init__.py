@@ -1,4 +1,16 @@
-__all__ = ['base', 'dicom2fem', 'genfem_base', 'ioutils', 'marching_cubes',
-           'mesh', 'meshio', 'seg2fem', 'viewer', 'vtk2stl']
-import base, dicom2fem, genfem_base, ioutils, marching_cubes
-import mesh, meshio, seg2fem, viewer, vtk2stl
+__all__ = ['base', 'convert', 'dcmloader', 'decimate', 'genfem_base',
+           'ioutils', 'marching_cubes', 'mesh', 'meshio', 'pipeline',
+           'project', 'rescale', 'seg2fem', 'stagecache', 'vtk2stl']
+import base, convert, dcmloader, decimate, genfem_base, ioutils
+import marching_cubes, mesh, meshio, pipeline, project, rescale, seg2fem
+import stagecache, vtk2stl
+
+# The GUI modules need PyQt4 and VTK, missing e.g. on headless cluster nodes.
+try:
+    import dicom2fem, viewer
+
+except ImportError:
+    pass
+
+else:
+    __all__ += ['dicom2fem', 'viewer']
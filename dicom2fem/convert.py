@@ -0,0 +1,366 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Convert mesh files between the supported mesh formats.
+
+The input files are given as file names, glob patterns or directories
+(searched recursively for files with a readable mesh suffix). The files
+are converted in parallel, and the outputs that are newer than their
+inputs are skipped. With an output directory, the paths of the inputs
+relative to their common directory are kept in it.
+
+Example:
+
+$ convert.py -f vtk -d out meshes/*.inp more_meshes
+"""
+from optparse import OptionParser
+from glob import glob
+import os
+import os.path as op
+import sys
+import time
+import multiprocessing
+
+from base import output
+from mesh import Mesh
+from meshio import (MeshIO, supported_formats, supported_capabilities,
+                    io_table)
+
+def get_format_suffix(format):
+    """
+    Get the file suffix of the mesh `format`. A suffix passed in place of
+    the format is returned as is.
+    """
+    if format.startswith('.'):
+        return format.lower()
+
+    for ext, fmt in sorted(supported_formats.iteritems()):
+        if fmt == format:
+            return ext
+
+    raise ValueError('no file suffix for mesh format! (%s)' % format)
+
+def get_suffix_format(ext):
+    """
+    Get the mesh format of the file suffix `ext`. For ambiguous suffixes a
+    tuple of candidate formats is returned.
+    """
+    try:
+        return supported_formats[ext.lower()]
+
+    except KeyError:
+        raise ValueError('unsupported mesh file suffix! (%s)' % ext)
+
+def is_readable(filename):
+    ext = op.splitext(filename)[1].lower()
+    format = supported_formats.get(ext)
+    if format is None:
+        return False
+
+    if isinstance(format, tuple):
+        format = format[-1]
+
+    return 'r' in supported_capabilities[format]
+
+def collect_files(names):
+    """
+    Expand the file names, glob patterns and directories in `names` to a
+    sorted list of mesh file names without duplicates.
+    """
+    filenames = set()
+    for name in names:
+        if op.isdir(name):
+            for root, dirs, files in os.walk(name):
+                filenames.update(op.join(root, fn) for fn in files
+                                 if is_readable(fn))
+
+        else:
+            matches = glob(name)
+            if not matches:
+                output('no files match "%s"!' % name)
+
+            filenames.update(fn for fn in matches if op.isfile(fn))
+
+    return sorted(filenames)
+
+def get_input_root(filenames):
+    """
+    Get the deepest directory containing all of `filenames`.
+    """
+    dirs = [op.dirname(op.abspath(fn)).split(os.sep) for fn in filenames]
+    root = []
+    for parts in zip(*dirs):
+        if any(part != parts[0] for part in parts[1:]):
+            break
+        root.append(parts[0])
+
+    return os.sep.join(root) or os.sep
+
+def get_output_name(filename, ext, output_dir=None, input_root=None):
+    """
+    Get the output file name of `filename`. With `output_dir`, the path of
+    the file relative to `input_root` (the directory of the file by
+    default) is kept under `output_dir`.
+    """
+    trunk = op.splitext(filename)[0]
+    if output_dir is not None:
+        if input_root is None:
+            trunk = op.basename(trunk)
+
+        else:
+            trunk = op.relpath(op.abspath(trunk), input_root)
+
+        trunk = op.join(output_dir, trunk)
+
+    return trunk + ext
+
+def check_output_names(filenames, filenames_out):
+    """
+    Raise ValueError, if several input files map to the same output file.
+    """
+    inputs = {}
+    for fn, fn_out in zip(filenames, filenames_out):
+        inputs.setdefault(op.abspath(fn_out), []).append(fn)
+
+    dups = sorted((fn_out, fns) for fn_out, fns in inputs.iteritems()
+                  if len(fns) > 1)
+    if dups:
+        msg = '; '.join('%s <- %s' % (fn_out, ', '.join(fns))
+                        for fn_out, fns in dups)
+        raise ValueError('several input files have the same output file! (%s)'
+                         % msg)
+
+def is_up_to_date(filename_in, filename_out):
+    """
+    Return True, if `filename_out` exists and is not older than
+    `filename_in`.
+    """
+    return (op.exists(filename_out)
+            and (op.getmtime(filename_out) >= op.getmtime(filename_in)))
+
+class FormatCache(object):
+    """
+    The input mesh formats of file suffixes. A format guessed for an
+    ambiguous suffix (e.g. '.inp') is reused for the following files with
+    the same suffix in the same directory.
+    """
+
+    def __init__(self, format=None):
+        self.format = format
+        self.cache = {}
+
+    def __call__(self, filename):
+        if self.format is not None:
+            return self.format
+
+        ext = op.splitext(filename)[1].lower()
+        format = get_suffix_format(ext)
+        if not isinstance(format, tuple):
+            return format
+
+        key = (op.dirname(filename), ext)
+        if key not in self.cache:
+            self.cache[key] = MeshIO.any_from_filename(filename).format
+
+        return self.cache[key]
+
+def convert_file(args):
+    """
+    Convert a single mesh file. Errors are returned instead of raised, so
+    that a bad file does not stop the whole batch.
+
+    Parameters
+    ----------
+    args : tuple
+        The input file name, the input format (or None to guess it), the
+        output file name and the output format.
+
+    Returns
+    -------
+    stats : tuple
+        The input file name, the input size in bytes, the number of
+        vertices and elements, the conversion time and the error message
+        or None.
+    """
+    filename_in, format_in, filename_out, format_out = args
+    try:
+        tt = time.time()
+        io = MeshIO.for_format(filename_in, format=format_in)
+        try:
+            mesh = Mesh.from_file(filename_in, io=io)
+
+        except Exception:
+            # The cached format of an ambiguous suffix may not fit.
+            ext = op.splitext(filename_in)[1].lower()
+            if not isinstance(supported_formats.get(ext), tuple):
+                raise
+
+            io = MeshIO.any_from_filename(filename_in)
+            if io.format == format_in:
+                raise
+            mesh = Mesh.from_file(filename_in, io=io)
+
+        io = MeshIO.for_format(filename_out, format=format_out,
+                               writable=True)
+        mesh.write(filename_out, io=io)
+
+        stats = (filename_in, op.getsize(filename_in), mesh.n_nod,
+                 mesh.n_el, time.time() - tt, None)
+
+    except Exception, exc:
+        stats = (filename_in, 0, 0, 0, 0.0, '%s: %s'
+                 % (exc.__class__.__name__, exc))
+
+    return stats
+
+def convert_files(filenames, format_out, output_dir=None, format_in=None,
+                  n_jobs=None, force=False):
+    """
+    Convert mesh files to `format_out` using a pool of `n_jobs` processes.
+
+    Returns
+    -------
+    n_ok : int
+        The number of converted files.
+    n_skipped : int
+        The number of skipped up-to-date files.
+    failed : list
+        The (file name, error message) pairs of failed conversions.
+    """
+    ext_out = get_format_suffix(format_out)
+    if format_out.startswith('.'):
+        format_out = get_suffix_format(ext_out)
+
+    if format_out not in io_table:
+        raise ValueError('unknown output mesh format! (%s)' % format_out)
+
+    if 'w' not in supported_capabilities[format_out]:
+        raise ValueError('output mesh format is not writable! (%s)'
+                         % format_out)
+
+    if (output_dir is not None) and not op.exists(output_dir):
+        os.makedirs(output_dir)
+
+    input_root = get_input_root(filenames) if filenames else None
+    filenames_out = [get_output_name(fn, ext_out, output_dir, input_root)
+                     for fn in filenames]
+    check_output_names(filenames, filenames_out)
+
+    get_format = FormatCache(format_in)
+
+    jobs = []
+    n_skipped = 0
+    failed = []
+    for fn, fn_out in zip(filenames, filenames_out):
+        if op.abspath(fn_out) == op.abspath(fn):
+            output('skipping %s: same input and output file' % fn)
+            n_skipped += 1
+
+        elif not force and is_up_to_date(fn, fn_out):
+            n_skipped += 1
+
+        else:
+            try:
+                format_in = get_format(fn)
+
+            except (ValueError, NotImplementedError), exc:
+                output('%s failed: %s' % (fn, exc))
+                failed.append((fn, str(exc)))
+                continue
+
+            dirname = op.dirname(fn_out)
+            if dirname and not op.exists(dirname):
+                os.makedirs(dirname)
+
+            jobs.append((fn, format_in, fn_out, format_out))
+
+    output('converting %d file(s), %d up-to-date file(s) skipped'
+           % (len(jobs), n_skipped))
+
+    if n_jobs is None:
+        n_jobs = multiprocessing.cpu_count()
+    n_jobs = max(min(n_jobs, len(jobs)), 1)
+
+    if n_jobs == 1:
+        pool = None
+        results = (convert_file(job) for job in jobs)
+
+    else:
+        pool = multiprocessing.Pool(n_jobs)
+        results = pool.imap_unordered(convert_file, jobs)
+
+    tt = time.time()
+    n_ok = 0
+    size = 0
+    n_el = 0
+    for fn, n_bytes, n_nod, n_els, dt, err in results:
+        if err is not None:
+            output('%s failed: %s' % (fn, err))
+            failed.append((fn, err))
+            continue
+
+        n_ok += 1
+        size += n_bytes
+        n_el += n_els
+        dt = max(dt, 1e-6)
+        output('%s: %d vertices, %d elements in %.2f s'
+               ' (%.2f MB/s, %.0f elements/s)'
+               % (fn, n_nod, n_els, dt, n_bytes / dt / 2.0**20, n_els / dt))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    dt = max(time.time() - tt, 1e-6)
+    output('%d file(s) converted in %.2f s (%.2f MB/s, %.0f elements/s),'
+           ' %d failed'
+           % (n_ok, dt, size / dt / 2.0**20, n_el / dt, len(failed)))
+
+    return n_ok, n_skipped, failed
+
+usage = '%prog [options] file_or_dir [file_or_dir ...]\n' + __doc__.rstrip()
+help = {
+    'format': 'output mesh format or file suffix [default: %default]',
+    'input_format': 'force the input mesh format instead of guessing it'
+    ' from the file suffix',
+    'output_dir': 'output directory [default: next to the input files]',
+    'jobs': 'number of parallel processes [default: number of CPUs]',
+    'force': 'convert also the files with up-to-date outputs',
+}
+
+def main():
+    parser = OptionParser(usage=usage, description='Mesh format converter')
+    parser.add_option('-f', '--format', action='store',
+                      dest='format', default='vtk',
+                      help=help['format'])
+    parser.add_option('-i', '--input-format', action='store',
+                      dest='input_format', default=None,
+                      help=help['input_format'])
+    parser.add_option('-d', '--output-dir', action='store',
+                      dest='output_dir', default=None,
+                      help=help['output_dir'])
+    parser.add_option('-j', '--jobs', type='int', action='store',
+                      dest='jobs', default=None,
+                      help=help['jobs'])
+    parser.add_option('--force', action='store_true',
+                      dest='force', default=False,
+                      help=help['force'])
+    (options, args) = parser.parse_args()
+
+    if not args:
+        parser.print_help()
+        sys.exit(1)
+
+    filenames = collect_files(args)
+    if not filenames:
+        raise IOError('No input mesh files!')
+
+    n_ok, n_skipped, failed = convert_files(filenames, options.format,
+                                            options.output_dir,
+                                            options.input_format,
+                                            options.jobs, options.force)
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
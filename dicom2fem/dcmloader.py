@@ -0,0 +1,396 @@
+"""
+Parallel DICOM series loader with an on-disk volume cache.
+
+The slice headers and pixel data are read by a pool of threads, and the
+decoded slices are stored directly into a preallocated volume. The
+assembled volumes are cached as .npy files keyed by the series UID and the
+modification times and sizes of the slice files, and the series found in a
+directory are cached in an index keyed by the directory listing. Opening a
+cached series thus reads no DICOM file at all and the volume is
+memory-mapped.
+
+The volume axes are (slices, rows, columns), ordered along the slice
+normal, and the voxel size and offset (of the first voxel, in the patient
+coordinate system projected to the volume axes) are in mm in the same
+order.
+"""
+import os
+import os.path as op
+import json
+import tempfile
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+import numpy as nm
+
+from base import output
+from stagecache import StageCache
+
+try:
+    import dicom
+
+except ImportError:
+    try:
+        import pydicom as dicom
+
+    except ImportError:
+        dicom = None
+
+default_cache_dir = op.join(op.expanduser('~'), '.dicom2fem', 'dcmcache')
+
+class DicomCache(StageCache):
+    """
+    The cache of DICOM volumes and of the series indices of directories.
+    """
+    suffix = '.npy'
+
+    def read(self, filename):
+        # Copy-on-write, so that the volume can be modified in memory.
+        return nm.load(filename, mmap_mode='c')
+
+    def write(self, filename, data):
+        fd = open(filename, 'wb')
+        try:
+            nm.save(fd, data)
+
+        finally:
+            fd.close()
+
+    def get_index_filename(self, key):
+        return op.join(self.dirname, key + '.json')
+
+    def load_index(self, key):
+        """
+        Load the series index stored under `key`, or return None.
+        """
+        try:
+            fd = open(self.get_index_filename(key), 'r')
+
+        except IOError:
+            return None
+
+        try:
+            return json.load(fd)
+
+        except ValueError:
+            return None
+
+        finally:
+            fd.close()
+
+    def save_index(self, key, index):
+        fd, tmp_filename = tempfile.mkstemp(suffix='.json.tmp',
+                                            dir=self.dirname)
+        fd = os.fdopen(fd, 'w')
+        try:
+            json.dump(index, fd)
+            fd.close()
+            os.rename(tmp_filename, self.get_index_filename(key))
+
+        finally:
+            fd.close()
+            if op.exists(tmp_filename):
+                os.remove(tmp_filename)
+
+def list_files(dcmdir):
+    """
+    List the files in `dcmdir` with their modification times and sizes.
+
+    Returns
+    -------
+    stats : list
+        The sorted (file name, modification time, size) tuples.
+    """
+    stats = []
+    for fn in os.listdir(dcmdir):
+        if fn.upper() == 'DICOMDIR':
+            continue
+
+        filename = op.join(dcmdir, fn)
+        if op.isfile(filename):
+            stat = os.stat(filename)
+            stats.append((fn, stat.st_mtime, stat.st_size))
+
+    return sorted(stats)
+
+def read_header(filename):
+    """
+    Read the slice header needed to assemble the volume, or return None
+    for files that are not DICOM images.
+    """
+    try:
+        ds = dicom.read_file(filename, stop_before_pixels=True)
+
+    except Exception:
+        return None
+
+    uid = getattr(ds, 'SeriesInstanceUID', None)
+    rows = getattr(ds, 'Rows', None)
+    if (uid is None) or (rows is None):
+        return None
+
+    header = {
+        'filename': op.basename(filename),
+        'series_uid': str(uid),
+        'shape': (int(rows), int(ds.Columns)),
+        'spacing': [float(ii) for ii in getattr(ds, 'PixelSpacing',
+                                                 [1.0, 1.0])],
+        'thickness': float(getattr(ds, 'SliceThickness', 0.0) or 0.0),
+        'slope': float(getattr(ds, 'RescaleSlope', 1.0)),
+        'intercept': float(getattr(ds, 'RescaleIntercept', 0.0)),
+        'bits': int(getattr(ds, 'BitsStored', 16)),
+        'signed': int(getattr(ds, 'PixelRepresentation', 0)),
+        'number': int(getattr(ds, 'InstanceNumber', 0) or 0),
+    }
+
+    ipp = getattr(ds, 'ImagePositionPatient', None)
+    iop = getattr(ds, 'ImageOrientationPatient', None)
+    if (ipp is not None) and (iop is not None):
+        header['position'] = [float(ii) for ii in ipp]
+        header['orientation'] = [float(ii) for ii in iop]
+
+    location = getattr(ds, 'SliceLocation', None)
+    if location is not None:
+        header['location'] = float(location)
+
+    return header
+
+def get_volume_dtype(headers):
+    """
+    Get the smallest volume data type holding the rescaled pixel values of
+    all slices. It is an integer type, if the rescaling parameters are
+    integers, as in `dcmreaddata.DicomReader`.
+    """
+    vmin, vmax = 0.0, 0.0
+    is_int = True
+    for header in headers:
+        bits = header['bits']
+        if header['signed']:
+            smin, smax = -2.0**(bits - 1), 2.0**(bits - 1) - 1
+
+        else:
+            smin, smax = 0.0, 2.0**bits - 1
+
+        slope, intercept = header['slope'], header['intercept']
+        aux = [slope * smin + intercept, slope * smax + intercept]
+        vmin, vmax = min(vmin, min(aux)), max(vmax, max(aux))
+        is_int = is_int and (slope == int(slope)) \
+                 and (intercept == int(intercept))
+
+    if not is_int:
+        return nm.float32
+
+    for dtype in [nm.int16, nm.int32]:
+        info = nm.iinfo(dtype)
+        if (vmin >= info.min) and (vmax <= info.max):
+            return dtype
+
+    return nm.float64
+
+def make_series(headers):
+    """
+    Sort the slices of a series along the slice normal and compute the
+    volume geometry.
+
+    Returns
+    -------
+    series : dict
+        The sorted slice file names, the volume shape and data type, the
+        voxel size and the offset.
+    """
+    # Skip slices of other sizes, e.g. rendered overview images.
+    shapes = [tuple(header['shape']) for header in headers]
+    shape = max(set(shapes), key=shapes.count)
+    headers = [header for header in headers
+               if tuple(header['shape']) == shape]
+
+    offset = [0.0, 0.0, 0.0]
+    if all('position' in header for header in headers):
+        iop = nm.array(headers[0]['orientation']).reshape((2, 3))
+        axes = nm.array([nm.cross(iop[0], iop[1]), iop[1], iop[0]])
+        poss = [nm.dot(axes, header['position']) for header in headers]
+        keys = [pos[0] for pos in poss]
+        offset = [float(ii) for ii in min(poss, key=lambda pos: pos[0])]
+
+    elif all('location' in header for header in headers):
+        keys = [header['location'] for header in headers]
+
+    else:
+        keys = None
+
+    if keys is not None:
+        iis = nm.argsort(keys, kind='mergesort')
+        keys = nm.array(keys)[iis]
+        dz = float(nm.median(nm.diff(keys))) if len(keys) > 1 else 0.0
+
+    else:
+        iis = nm.argsort([header['number'] for header in headers],
+                         kind='mergesort')
+        dz = 0.0
+
+    headers = [headers[ii] for ii in iis]
+
+    if dz <= 0.0:
+        dz = headers[0]['thickness'] or 1.0
+
+    return {
+        'series_uid': headers[0]['series_uid'],
+        'files': [header['filename'] for header in headers],
+        'shape': [len(headers)] + list(shape),
+        'dtype': nm.dtype(get_volume_dtype(headers)).str,
+        'rescale': [(header['slope'], header['intercept'])
+                     for header in headers],
+        'voxelsize_mm': [dz] + headers[0]['spacing'],
+        'offset_mm': offset,
+    }
+
+def find_series(dcmdir, n_threads=None, progress=None):
+    """
+    Read the slice headers of all files in `dcmdir` in parallel and group
+    them to series.
+
+    Returns
+    -------
+    series : dict
+        The series as returned by :func:`make_series()` keyed by the series
+        UIDs.
+    """
+    if dicom is None:
+        raise ValueError('pydicom is needed to read DICOM data!')
+
+    filenames = [op.join(dcmdir, ii[0]) for ii in list_files(dcmdir)]
+    headers = _map_threads(read_header, filenames, n_threads, progress)
+
+    groups = {}
+    for header in headers:
+        if header is not None:
+            groups.setdefault(header['series_uid'], []).append(header)
+
+    return dict((uid, make_series(group))
+                for uid, group in groups.iteritems())
+
+def read_slice(filename, slope, intercept, out):
+    """
+    Decode the pixel data of a slice, rescale them and store them into
+    `out`.
+    """
+    pixels = dicom.read_file(filename).pixel_array
+    if (slope != 1.0) or (intercept != 0.0):
+        out[...] = slope * pixels.astype(nm.float64) + intercept
+
+    else:
+        out[...] = pixels
+
+def read_series(dcmdir, series, n_threads=None, progress=None):
+    """
+    Read the volume of a series found by :func:`find_series()`. The slices
+    are decoded in parallel threads directly into the volume.
+    """
+    data = nm.empty(series['shape'], dtype=series['dtype'])
+
+    def fun(ii):
+        slope, intercept = series['rescale'][ii]
+        read_slice(op.join(dcmdir, series['files'][ii]), slope, intercept,
+                   data[ii])
+
+    _map_threads(fun, range(len(series['files'])), n_threads, progress)
+
+    return data
+
+def _map_threads(fun, args, n_threads, progress):
+    if n_threads is None:
+        # Reading is partly I/O bound, so use more threads than CPUs.
+        n_threads = 2 * cpu_count()
+
+    pool = ThreadPool(max(min(n_threads, len(args)), 1))
+    try:
+        results = [None] * len(args)
+        iresults = pool.imap_unordered(lambda ii: (ii, fun(args[ii])),
+                                       range(len(args)))
+        for ir, (ii, result) in enumerate(iresults):
+            results[ii] = result
+            if progress is not None:
+                progress(ir + 1, len(args))
+
+    finally:
+        pool.terminate()
+        pool.join()
+
+    return results
+
+def load_dcmdir(dcmdir, series_uid=None, cache_dir=default_cache_dir,
+                cache_size=4096, n_threads=None, progress=None):
+    """
+    Load a DICOM series from a directory.
+
+    Parameters
+    ----------
+    dcmdir : str
+        The DICOM directory.
+    series_uid : str, optional
+        The UID of the series to load. By default the series with the most
+        slices is loaded.
+    cache_dir : str, optional
+        The cache directory. If None, no cache is used.
+    cache_size : int
+        The cache size limit in MB.
+    n_threads : int, optional
+        The number of reading threads.
+    progress : callable, optional
+        If given, it is called as `progress(n_done, n_files)` after reading
+        each file header and each slice. It can raise an exception to
+        cancel the loading.
+
+    Returns
+    -------
+    data : array
+        The 3D volume, memory-mapped if taken from the cache.
+    metadata : dict
+        The series UID, the voxel size and the offset of the volume.
+    """
+    dcmdir = op.abspath(dcmdir)
+
+    cache = None
+    series = None
+    if cache_dir is not None:
+        cache = DicomCache(cache_dir, cache_size * 2**20)
+        stats = list_files(dcmdir)
+        dir_key = cache.get_key(dcmdir, stats)
+        series = cache.load_index(dir_key)
+
+    if series is None:
+        series = find_series(dcmdir, n_threads=n_threads, progress=progress)
+        if cache is not None:
+            cache.save_index(dir_key, series)
+
+    if not series:
+        raise ValueError('no DICOM data in directory! (%s)' % dcmdir)
+
+    if series_uid is None:
+        series_uid = max(series, key=lambda uid: len(series[uid]['files']))
+
+    elif series_uid not in series:
+        raise ValueError('no series %s in directory! (%s)'
+                         % (series_uid, dcmdir))
+
+    aux = series[series_uid]
+    metadata = {
+        'series_uid': series_uid,
+        'voxelsize_mm': aux['voxelsize_mm'],
+        'offset_mm': aux['offset_mm'],
+    }
+
+    if cache is not None:
+        stats = dict((ii[0], ii) for ii in stats)
+        key = cache.get_key(series_uid, [stats[fn] for fn in aux['files']])
+        data = cache.load(key)
+        if data is not None:
+            output('DICOM series %s loaded from cache' % series_uid)
+            return data, metadata
+
+    data = read_series(dcmdir, aux, n_threads=n_threads, progress=progress)
+
+    if cache is not None:
+        cache.save(key, data)
+
+    return data, metadata
@@ -0,0 +1,506 @@
+"""
+Decimation of surface meshes: the fast vertex clustering for previews of
+large marching cubes surfaces and the quadric error edge collapse for
+reducing the size of FE models.
+"""
+import heapq
+
+import numpy as nm
+
+from mesh import Mesh
+from genfem_base import get_surface_faces, unique_rows
+
+def get_surface_triangles(mesh):
+    """
+    Get the surface triangles of a mesh: the boundary faces of volume
+    elements and the surface elements, with quadrilaterals split.
+
+    Returns
+    -------
+    coors : array
+        The 3D vertex coordinates.
+    tris : array
+        The triangles.
+    mat_ids : array
+        The material ids of the triangles.
+    """
+    coors = nm.zeros((mesh.n_nod, 3), dtype=nm.float64)
+    coors[:, :mesh.dim] = mesh.coors
+
+    tris = []
+    mat_ids = []
+    for ig, conn in enumerate(mesh.conns):
+        desc = mesh.descs[ig]
+        mat_id = mesh.mat_ids[ig]
+        if desc[0] == '3':
+            conn, iels = get_surface_faces(conn, desc)
+            mat_id = mat_id[iels]
+
+        elif desc[0] != '2':
+            continue
+
+        if conn.shape[1] == 4:
+            tris.extend([conn[:, [0, 1, 2]], conn[:, [0, 2, 3]]])
+            mat_ids.extend([mat_id, mat_id])
+
+        elif conn.shape[1] == 3:
+            tris.append(conn)
+            mat_ids.append(mat_id)
+
+        else:
+            raise ValueError('unsupported element type! (%s)' % desc)
+
+    if not len(tris):
+        return coors, nm.empty((0, 3), dtype=nm.int32), \
+               nm.empty((0,), dtype=nm.int32)
+
+    return coors, nm.concatenate(tris), nm.concatenate(mat_ids)
+
+def cluster_vertices(coors, tris, mat_ids, cell_size):
+    """
+    Merge the vertices in the cells of a regular grid into their mean and
+    remove the collapsed and duplicate triangles.
+
+    Returns
+    -------
+    ccoors : array
+        The cluster vertex coordinates.
+    ctris : array
+        The remaining triangles.
+    cmat_ids : array
+        The material ids of the remaining triangles.
+    """
+    # Only the vertices of triangles.
+    used = nm.unique(tris)
+    cells = nm.floor((coors[used] - coors[used].min(axis=0))
+                     / cell_size).astype(nm.int64)
+    _, icells = nm.unique(cells.view(nm.dtype((nm.void, 3 * 8))).ravel(),
+                          return_inverse=True)
+
+    remap = nm.empty(coors.shape[0], dtype=nm.int64)
+    remap[used] = icells
+
+    n_cl = icells.max() + 1
+    counts = nm.bincount(icells, minlength=n_cl).astype(nm.float64)
+    ccoors = nm.empty((n_cl, 3), dtype=nm.float64)
+    for ic in range(3):
+        ccoors[:, ic] = nm.bincount(icells, weights=coors[used, ic],
+                                    minlength=n_cl) / counts
+
+    ctris = remap[tris]
+    ok = ((ctris[:, 0] != ctris[:, 1]) & (ctris[:, 1] != ctris[:, 2])
+          & (ctris[:, 2] != ctris[:, 0]))
+    ctris = ctris[ok]
+    cmat_ids = mat_ids[ok]
+
+    # Triangles collapsed onto the same clusters, keep the first ones.
+    aux = nm.sort(ctris, axis=1)
+    _, ii = nm.unique(aux.view(nm.dtype((nm.void, 3 * 8))).ravel(),
+                      return_index=True)
+    ii.sort()
+
+    return ccoors, ctris[ii], cmat_ids[ii]
+
+def decimate_clustering(mesh, n_tri, n_iter=8):
+    """
+    Decimate the surface of a mesh by the vertex clustering to at most
+    `n_tri` triangles.
+
+    The grid cell size is estimated from the mean edge length and then
+    refined by a few bisection steps to get close to the triangle budget.
+
+    Parameters
+    ----------
+    mesh : Mesh
+        The mesh, volume elements are replaced by their boundary faces.
+    n_tri : int
+        The target number of triangles.
+    n_iter : int
+        The maximum number of cell size refinement steps.
+
+    Returns
+    -------
+    out : Mesh
+        The decimated triangular surface mesh, or `mesh` itself if its
+        surface has at most `n_tri` triangles.
+    """
+    coors, tris, mat_ids = get_surface_triangles(mesh)
+    if tris.shape[0] <= n_tri:
+        return mesh
+
+    edges = coors[tris[:, [1, 2, 0]]] - coors[tris]
+    h0 = nm.sqrt((edges**2).sum(axis=2)).mean()
+
+    # The number of triangles decreases roughly with the cell area.
+    h_min, h_max = 0.0, None
+    h = h0 * nm.sqrt(float(tris.shape[0]) / n_tri)
+    out = None
+    for ii in xrange(n_iter):
+        aux = cluster_vertices(coors, tris, mat_ids, h)
+        n_out = aux[1].shape[0]
+        if n_out <= n_tri:
+            out = aux
+            h_max = h
+            if n_out >= 0.9 * n_tri:
+                break
+
+        else:
+            h_min = h
+
+        if h_max is None:
+            h *= 1.5
+
+        else:
+            h = 0.5 * (h_min + h_max)
+
+    if out is None:
+        while n_out > n_tri:
+            h *= 2.0
+            aux = cluster_vertices(coors, tris, mat_ids, h)
+            n_out = aux[1].shape[0]
+        out = aux
+
+    coors, tris, mat_ids = out
+    used = nm.unique(tris)
+    remap = nm.empty(coors.shape[0], dtype=nm.int32)
+    remap[used] = nm.arange(used.shape[0], dtype=nm.int32)
+
+    return Mesh.from_data(mesh.name + '_lod', coors[used],
+                          nm.zeros((used.shape[0],), dtype=nm.int32),
+                          [remap[tris]], [mat_ids.astype(nm.int32)],
+                          ['2_3'])
+
+def get_face_quadrics(coors, tris):
+    """
+    Get the area-weighted quadrics of the triangle planes.
+
+    Returns
+    -------
+    quadrics : array
+        The (n_tri, 4, 4) quadrics.
+    areas : array
+        The triangle areas.
+    """
+    normals = nm.cross(coors[tris[:, 1]] - coors[tris[:, 0]],
+                       coors[tris[:, 2]] - coors[tris[:, 0]])
+    areas = 0.5 * nm.sqrt((normals**2).sum(axis=1))
+    nm.divide(normals, 2.0 * areas[:, None], out=normals,
+              where=areas[:, None] > 0.0)
+
+    planes = nm.empty((tris.shape[0], 4), dtype=nm.float64)
+    planes[:, :3] = normals
+    planes[:, 3] = -(normals * coors[tris[:, 0]]).sum(axis=1)
+
+    quadrics = areas[:, None, None] * planes[:, :, None] * planes[:, None, :]
+
+    return quadrics, areas
+
+def get_feature_edges(tris, mat_ids):
+    """
+    Get the feature edges of a triangular surface: the open boundary and
+    non-manifold edges and the edges between triangles with different
+    material ids.
+
+    Returns
+    -------
+    edges : array
+        The feature edges with sorted vertices.
+    iedges : array
+        For each feature edge, the index of an adjacent triangle.
+    """
+    n_tri = tris.shape[0]
+    edges = nm.sort(tris[:, [0, 1, 1, 2, 2, 0]].reshape((3 * n_tri, 2)),
+                    axis=1)
+    itris = nm.repeat(nm.arange(n_tri), 3)
+
+    order = nm.lexsort((edges[:, 1], edges[:, 0]))
+    edges = edges[order]
+    itris = itris[order]
+    labels = mat_ids[itris]
+
+    new = nm.ones(edges.shape[0], dtype=nm.bool)
+    new[1:] = (edges[1:] != edges[:-1]).any(axis=1)
+    starts = nm.where(new)[0]
+    counts = nm.diff(nm.r_[starts, edges.shape[0]])
+
+    # Label changes within groups of the same edge.
+    changed = nm.zeros(edges.shape[0], dtype=nm.int32)
+    changed[1:] = (labels[1:] != labels[:-1]) & ~new[1:]
+    n_changes = nm.add.reduceat(changed, starts)
+
+    ii = starts[(counts != 2) | (n_changes > 0)]
+
+    return edges[ii], itris[ii]
+
+def _get_collapse_costs(quadrics, weights, coors, is_feature, is_corner,
+                        feature_edges, edges):
+    """
+    Get the costs and target positions of collapsing `edges`. The costs
+    are the root mean square distances of the target positions to the
+    planes of the original triangles around the edges, or inf for
+    forbidden collapses.
+    """
+    n_edge = edges.shape[0]
+    v0, v1 = edges[:, 0], edges[:, 1]
+    qs = quadrics[v0] + quadrics[v1]
+    ws = weights[v0] + weights[v1]
+
+    # The candidate positions: the end points, the midpoint and the
+    # optimal position, regularized towards the midpoint for the singular
+    # quadrics of flat or straight regions.
+    cands = nm.empty((4, n_edge, 3), dtype=nm.float64)
+    cands[0] = coors[v0]
+    cands[1] = coors[v1]
+    cands[2] = 0.5 * (cands[0] + cands[1])
+    aa = qs[:, :3, :3].copy()
+    eps = 1e-6 * nm.trace(aa, axis1=1, axis2=2) + 1e-300
+    aa[:, [0, 1, 2], [0, 1, 2]] += eps[:, None]
+    cands[3] = nm.linalg.solve(aa, eps[:, None] * cands[2] - qs[:, :3, 3])
+
+    xs = nm.ones((4, n_edge, 4), dtype=nm.float64)
+    xs[..., :3] = cands
+    errs = nm.einsum('kij,ijl,kil->ki', xs, qs, xs)
+
+    # Feature vertices stay on their curves: a vertex on a curve does not
+    # move off it and corners do not move at all.
+    f0, f1 = is_feature[v0], is_feature[v1]
+    c0, c1 = is_corner[v0], is_corner[v1]
+    on_curve = nm.zeros(n_edge, dtype=nm.bool)
+    for ii in nm.where(f0 & f1)[0]:
+        on_curve[ii] = (min(v0[ii], v1[ii]),
+                        max(v0[ii], v1[ii])) in feature_edges
+
+    fixed0 = f0 & (~f1 | (c0 & ~c1))
+    fixed1 = f1 & (~f0 | (c1 & ~c0))
+    errs[3, f0 | f1] = nm.inf
+    errs[1:, fixed0] = nm.inf
+    errs[0, fixed1] = nm.inf
+    errs[2:, fixed1] = nm.inf
+    errs[:, (f0 & f1 & ~on_curve) | (c0 & c1)] = nm.inf
+
+    ibest = errs.argmin(axis=0)
+    iedges = nm.arange(n_edge)
+    costs = nm.sqrt(nm.maximum(errs[ibest, iedges], 0.0) / ws)
+
+    return costs, cands[ibest, iedges]
+
+def _cross(a, b):
+    # Faster than nm.cross() for the small arrays in the collapse loop.
+    out = nm.empty_like(a)
+    out[:, 0] = a[:, 1] * b[:, 2] - a[:, 2] * b[:, 1]
+    out[:, 1] = a[:, 2] * b[:, 0] - a[:, 0] * b[:, 2]
+    out[:, 2] = a[:, 0] * b[:, 1] - a[:, 1] * b[:, 0]
+
+    return out
+
+def _get_neighbours(faces, vfaces, iv):
+    out = set()
+    for ifc in vfaces[iv]:
+        out.update(faces[ifc])
+    out.discard(iv)
+
+    return out
+
+def decimate_mesh(mesh, target_faces=None, max_error=None,
+                  feature_weight=1e3):
+    """
+    Decimate a triangular surface mesh by the quadric error edge collapse.
+
+    The edges are collapsed in the order of the increasing quadric error
+    kept in a priority queue. Collapses changing the surface topology
+    (violating the link condition) or flipping triangles are rejected, so
+    that closed surfaces stay closed. The open boundaries and the
+    boundaries between material ids are feature curves: their vertices
+    only move along them and their corners stay fixed.
+
+    Parameters
+    ----------
+    mesh : Mesh
+        The surface mesh with triangles or quadrilaterals, which are split.
+    target_faces : int, optional
+        Stop when the number of triangles drops to this value.
+    max_error : float, optional
+        Stop when the smallest collapse error - the root mean square
+        distance of the new vertex to the planes of the original triangles
+        around it - exceeds this value.
+    feature_weight : float
+        The weight of the error of moving the feature curves.
+
+    Returns
+    -------
+    out : Mesh
+        The decimated triangular surface mesh.
+    """
+    if (target_faces is None) and (max_error is None):
+        raise ValueError('target_faces or max_error must be given!')
+
+    for desc in mesh.descs:
+        if desc[0] != '2':
+            raise ValueError('decimation needs a surface mesh! (%s)' % desc)
+
+    coors, tris, mat_ids = get_surface_triangles(mesh)
+    n_nod = coors.shape[0]
+
+    fquadrics, areas = get_face_quadrics(coors, tris)
+    fquadrics = fquadrics.reshape((-1, 16))
+    quadrics = nm.zeros((n_nod, 16), dtype=nm.float64)
+    weights = nm.zeros((n_nod,), dtype=nm.float64)
+    for ic in range(3):
+        for ik in range(16):
+            quadrics[:, ik] += nm.bincount(tris[:, ic],
+                                           weights=fquadrics[:, ik],
+                                           minlength=n_nod)
+        weights += nm.bincount(tris[:, ic], weights=areas, minlength=n_nod)
+    del fquadrics
+
+    # Penalize moving the feature curves off the planes perpendicular to
+    # the adjacent triangles.
+    fedges, itris = get_feature_edges(tris, mat_ids)
+    if fedges.shape[0]:
+        normals = nm.cross(coors[tris[itris, 1]] - coors[tris[itris, 0]],
+                           coors[tris[itris, 2]] - coors[tris[itris, 0]])
+        vecs = coors[fedges[:, 1]] - coors[fedges[:, 0]]
+        planes = nm.zeros((fedges.shape[0], 4), dtype=nm.float64)
+        planes[:, :3] = nm.cross(vecs, normals)
+        norms = nm.sqrt((planes[:, :3]**2).sum(axis=1))
+        nm.divide(planes[:, :3], norms[:, None], out=planes[:, :3],
+                  where=norms[:, None] > 0.0)
+        planes[:, 3] = -(planes[:, :3] * coors[fedges[:, 0]]).sum(axis=1)
+
+        aux = feature_weight * (vecs**2).sum(axis=1)
+        aux = (aux[:, None, None] * planes[:, :, None]
+               * planes[:, None, :]).reshape((-1, 16))
+        for ic in range(2):
+            for ik in range(16):
+                quadrics[:, ik] += nm.bincount(fedges[:, ic],
+                                               weights=aux[:, ik],
+                                               minlength=n_nod)
+
+    quadrics = quadrics.reshape((n_nod, 4, 4))
+
+    feature_edges = set((int(ii), int(ij)) for ii, ij in fedges)
+    fdegrees = nm.bincount(fedges.ravel(), minlength=n_nod)
+    is_feature = fdegrees > 0
+    is_corner = is_feature & (fdegrees != 2)
+
+    faces = tris.tolist()
+    alive = [True] * len(faces)
+    vfaces = [set() for ii in xrange(n_nod)]
+    for ifc, face in enumerate(faces):
+        for iv in face:
+            vfaces[iv].add(ifc)
+
+    versions = [0] * n_nod
+
+    def get_entries(edges):
+        costs, poss = _get_collapse_costs(quadrics, weights, coors,
+                                          is_feature, is_corner,
+                                          feature_edges, edges)
+        return [(cost, int(edge[0]), int(edge[1]), versions[edge[0]],
+                 versions[edge[1]], pos)
+                for cost, edge, pos in zip(costs, edges, poss)
+                if cost < nm.inf]
+
+    edges = nm.sort(tris[:, [0, 1, 1, 2, 2, 0]].reshape((-1, 2)), axis=1)
+    edges = edges[unique_rows(edges.copy())[0]]
+    heap = get_entries(edges)
+    heapq.heapify(heap)
+
+    if target_faces is None:
+        target_faces = 0
+
+    if max_error is None:
+        max_error = nm.inf
+
+    n_faces = len(faces)
+    while heap and (n_faces > target_faces):
+        cost, iu, iv, ver_u, ver_v, pos = heapq.heappop(heap)
+        if (versions[iu] != ver_u) or (versions[iv] != ver_v):
+            continue
+
+        if cost > max_error:
+            break
+
+        shared = vfaces[iu] & vfaces[iv]
+        if not shared:
+            continue
+
+        # The link condition: the common neighbours of the edge vertices
+        # are only the opposite vertices of the edge triangles.
+        opposite = set()
+        for ifc in shared:
+            opposite.update(faces[ifc])
+        nbu = _get_neighbours(faces, vfaces, iu)
+        nbv = _get_neighbours(faces, vfaces, iv)
+        if ((nbu & nbv) != (opposite - set([iu, iv])))  \
+           or (len(nbu | nbv) < 5):
+            continue
+
+        # No flipped or degenerate triangles.
+        ifcs = list((vfaces[iu] | vfaces[iv]) - shared)
+        if ifcs:
+            aux = nm.array([faces[ifc] for ifc in ifcs])
+            old = coors[aux]
+            new = old.copy()
+            new[(aux == iu) | (aux == iv)] = pos
+            nold = _cross(old[:, 1] - old[:, 0], old[:, 2] - old[:, 0])
+            nnew = _cross(new[:, 1] - new[:, 0], new[:, 2] - new[:, 0])
+            if ((nold * nnew).sum(axis=1) <= 0.0).any():
+                continue
+
+        # The surviving vertex is the one that keeps its position.
+        if ((is_feature[iv] and not is_feature[iu])
+            or (is_corner[iv] and not is_corner[iu])):
+            iu, iv = iv, iu
+
+        for ifc in shared:
+            alive[ifc] = False
+            for ii in faces[ifc]:
+                vfaces[ii].discard(ifc)
+        n_faces -= len(shared)
+
+        for ifc in vfaces[iv]:
+            face = faces[ifc]
+            face[face.index(iv)] = iu
+            vfaces[iu].add(ifc)
+        vfaces[iv] = set()
+
+        if is_feature[iv]:
+            feature_edges.discard((min(iu, iv), max(iu, iv)))
+            for ii in nbv:
+                edge = (min(ii, iv), max(ii, iv))
+                if edge in feature_edges:
+                    feature_edges.discard(edge)
+                    feature_edges.add((min(ii, iu), max(ii, iu)))
+
+            if is_feature[iu]:
+                fdegrees[iu] += fdegrees[iv] - 2
+
+            else:
+                fdegrees[iu] = fdegrees[iv]
+            is_feature[iu] = fdegrees[iu] > 0
+            is_corner[iu] = is_feature[iu] and (fdegrees[iu] != 2)
+
+        coors[iu] = pos
+        quadrics[iu] += quadrics[iv]
+        weights[iu] += weights[iv]
+        versions[iu] += 1
+        versions[iv] = -1
+
+        nbu = _get_neighbours(faces, vfaces, iu)
+        if nbu:
+            edges = nm.array([(iu, ii) for ii in nbu])
+            for entry in get_entries(edges):
+                heapq.heappush(heap, entry)
+
+    alive = nm.array(alive, dtype=nm.bool)
+    tris = nm.array(faces, dtype=nm.int32)[alive]
+    mat_ids = mat_ids[alive]
+
+    used = nm.unique(tris)
+    remap = nm.empty(n_nod, dtype=nm.int32)
+    remap[used] = nm.arange(used.shape[0], dtype=nm.int32)
+
+    return Mesh.from_data(mesh.name, coors[used][:, :mesh.dim],
+                          mesh.ngroups[used], [remap[tris]],
+                          [mat_ids.astype(nm.int32)], ['2_3'])
@@ -12,8 +12,6 @@ $ dicom2fem -d sample_data
 
 # import unittest
 from optparse import OptionParser
-from scipy.io import loadmat, savemat
-from scipy import ndimage
 import numpy as np
 import sys
 import os
@@ -21,7 +19,8 @@ import os
 from PyQt4.QtGui import QApplication, QMainWindow, QWidget,\
      QHBoxLayout, QVBoxLayout, QTabWidget,\
      QLabel, QPushButton, QFrame, QFileDialog,\
-     QFont, QInputDialog, QComboBox, QPixmap
+     QFont, QInputDialog, QComboBox, QPixmap, QProgressBar
+from PyQt4.QtCore import QThread, pyqtSignal
 from PyQt4.Qt import QString
 
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
@@ -32,36 +31,65 @@ from seed_editor_qt import QTSeedEditor
 import pycut
 
 from meshio import supported_capabilities, supported_formats, MeshIO
-from seg2fem import gen_mesh_from_voxels, gen_mesh_from_voxels_mc
-from seg2fem import smooth_mesh
+from seg2fem import mesh_generators, smooth_methods, elem_tab
+from rescale import rescale_volume, rescale_mask
+from project import load_file, save_file
+from dcmloader import load_dcmdir
 
 from viewer import QVTKViewer
 
 inv_supported_formats = dict(zip(supported_formats.values(),
                                  supported_formats.keys()))
-smooth_methods = {
-    'taubin vol.': (smooth_mesh, {'n_iter': 10, 'volume_corr': True,
-                             'lam': 0.6307, 'mu': -0.6347}),
-    'taubin': (smooth_mesh, {'n_iter': 10, 'volume_corr': False,
-                             'lam': 0.6307, 'mu': -0.6347}),
-
-    }
-
-mesh_generators = {
-    'surface/tri': (6, gen_mesh_from_voxels, {'etype': 't', 'mtype': 's'}),
-    'surface/quad': (5, gen_mesh_from_voxels, {'etype': 'q', 'mtype': 's'}),
-    'volume/tetra': (4, gen_mesh_from_voxels, {'etype': 't', 'mtype': 'v'}),
-    'volume/hexa': (3, gen_mesh_from_voxels, {'etype': 'q', 'mtype': 'v'}),
-    'march. cubes - surf.': (2, gen_mesh_from_voxels_mc, {}),
-    'march. cubes - vol.': (1, gen_mesh_from_voxels_mc, {'gmsh3d': True}),
-    }
-
-elem_tab = {
-    '2_3': 'triangles',
-    '3_4': 'tetrahedrons',
-    '2_4': 'quads',
-    '3_8': 'hexahedrons'
-    }
+project_filter = 'Project files (*.h5);;MATLAB files (*.dcm *.seg *.mat)'
+
+class OperationCancelled(Exception):
+    pass
+
+class Worker(QThread):
+    """
+    Run a long operation in a background thread.
+
+    If `kwargs` contain the 'progress' key, it is set to a callback that
+    emits the `progress` signal, and that raises OperationCancelled after
+    cancel() has been called.
+    """
+    progress = pyqtSignal(int, int)
+    done = pyqtSignal(object)
+    failed = pyqtSignal(str)
+
+    def __init__(self, fun, args=(), kwargs=None):
+        QThread.__init__(self)
+
+        self.fun = fun
+        self.args = args
+        self.kwargs = {} if kwargs is None else kwargs.copy()
+        self.cancelled = False
+        if 'progress' in self.kwargs:
+            self.kwargs['progress'] = self.report
+
+    def cancel(self):
+        self.cancelled = True
+
+    def report(self, step, n_steps):
+        if self.cancelled:
+            raise OperationCancelled
+
+        self.progress.emit(step, n_steps)
+
+    def run(self):
+        try:
+            result = self.fun(*self.args, **self.kwargs)
+            if self.cancelled:
+                raise OperationCancelled
+
+        except OperationCancelled:
+            self.failed.emit('cancelled')
+
+        except Exception, exc:
+            self.failed.emit('%s: %s' % (exc.__class__.__name__, exc))
+
+        else:
+            self.done.emit(result)
 
 class MainWindow(QMainWindow):
 
@@ -82,6 +110,8 @@ class MainWindow(QMainWindow):
         self.mesh_data = None
         self.mesh_out_format = 'vtk'
         self.mesh_smooth_method = 'taubin vol.'
+        self.worker = None
+        self.tasks = []
         self.initUI()
 
     def init_ReaderTab(self):
@@ -300,6 +330,14 @@ class MainWindow(QMainWindow):
 
         # status bar
         self.statusBar().showMessage('Ready')
+        self.progress_bar = QProgressBar()
+        self.progress_bar.setMaximumWidth(200)
+        self.progress_bar.hide()
+        self.statusBar().addPermanentWidget(self.progress_bar)
+        self.btn_cancel = QPushButton('Cancel', self)
+        self.btn_cancel.clicked.connect(self.cancelTask)
+        self.btn_cancel.hide()
+        self.statusBar().addPermanentWidget(self.btn_cancel)
 
         # info panel
         font_label = QFont()
@@ -372,6 +410,90 @@ class MainWindow(QMainWindow):
     def quit(self, event):
         self.close()
 
+    def closeEvent(self, event):
+        self.tasks = []
+        if self.worker is not None:
+            self.worker.cancel()
+            self.worker.wait()
+
+        QMainWindow.closeEvent(self, event)
+
+    def addTask(self, message, prepare):
+        """
+        Queue a long operation to run in a background thread.
+
+        The function `prepare()` is called in the GUI thread when the
+        operation is about to start. It returns None to skip the operation,
+        or a tuple `(fun, args, kwargs, on_done)`. Then `fun(*args,
+        **kwargs)` runs in a Worker thread and `on_done(result)` is called
+        in the GUI thread when it finishes.
+        """
+        self.tasks.append((message, prepare))
+        if self.worker is None:
+            self.nextTask()
+
+        else:
+            self.statusBar().showMessage('%s - queued (%d waiting)'
+                                         % (message, len(self.tasks)))
+
+    def nextTask(self):
+        self.worker = None
+        while len(self.tasks):
+            message, prepare = self.tasks.pop(0)
+            try:
+                task = prepare()
+
+            except Exception, exc:
+                self.statusBar().showMessage('%s failed: %s'
+                                             % (message, exc))
+                continue
+
+            if task is None:
+                continue
+
+            fun, args, kwargs, self.task_done = task
+            self.task_message = message
+
+            self.worker = Worker(fun, args, kwargs)
+            self.worker.progress.connect(self.taskProgress)
+            self.worker.done.connect(self.taskDone)
+            self.worker.failed.connect(self.taskFailed)
+
+            self.statusBar().showMessage('%s...' % message)
+            # Busy indicator until the first progress report.
+            self.progress_bar.setRange(0, 0)
+            self.progress_bar.show()
+            self.btn_cancel.show()
+            self.worker.start()
+            break
+
+        else:
+            self.progress_bar.hide()
+            self.btn_cancel.hide()
+
+    def taskProgress(self, step, n_steps):
+        self.progress_bar.setRange(0, n_steps)
+        self.progress_bar.setValue(step)
+
+    def taskDone(self, result):
+        self.worker.wait()
+        try:
+            self.task_done(result)
+
+        finally:
+            self.nextTask()
+
+    def taskFailed(self, message):
+        self.worker.wait()
+        self.statusBar().showMessage('%s %s!' % (self.task_message, message))
+        self.nextTask()
+
+    def cancelTask(self):
+        if self.worker is not None:
+            self.worker.cancel()
+            self.statusBar().showMessage('%s - cancelling...'
+                                         % self.task_message)
+
     def clearall(self, event):
         self.dcmdir = None
         del(self.dcm_3Ddata)
@@ -430,31 +552,29 @@ class MainWindow(QMainWindow):
         self.voxel_volume = np.prod(vxs)
 
     def loadDcmDir(self):
-        self.statusBar().showMessage('Reading DICOM directory...')
-        QApplication.processEvents()
-
         if self.dcmdir is None:
             self.dcmdir = dcmreader.get_dcmdir_qt(app=True)
 
-        if self.dcmdir is not None:
-            dcr = dcmreader.DicomReader(os.path.abspath(self.dcmdir),
-                                        qt_app=self)
-        else:
+        if self.dcmdir is None:
             self.statusBar().showMessage('No DICOM directory specified!')
             return
 
-        if dcr.validData():
-            self.dcm_3Ddata = dcr.get_3Ddata()
-            self.dcm_metadata = dcr.get_metaData()
+        dcmdir = self.dcmdir
+
+        def prepare():
+            return (load_dcmdir, (os.path.abspath(dcmdir),),
+                    {'progress': None}, done)
+
+        def done(ret):
+            self.dcm_3Ddata, self.dcm_metadata = ret
             self.voxel_sizemm = np.array(self.dcm_metadata['voxelsize_mm'])
             self.setVoxelVolume(self.voxel_sizemm)
-            self.setLabelText(self.text_dcm_dir, self.dcmdir)
+            self.setLabelText(self.text_dcm_dir, dcmdir)
             self.setLabelText(self.text_dcm_data, self.getDcmInfo())
             self.statusBar().showMessage('Ready')
             self.setLabelText(self.text_seg_in, 'DICOM reader')
 
-        else:
-            self.statusBar().showMessage('No DICOM data in direcotry!')
+        self.addTask('Reading DICOM directory', prepare)
 
     def getRescaleValues(self, new_vsize, old_vsize, labels):
         aux = '%.2f,%.2f,%.2f' % tuple(new_vsize)
@@ -482,25 +602,35 @@ class MainWindow(QMainWindow):
             self.statusBar().showMessage('No DICOM data!')
             return
 
-        self.statusBar().showMessage('Rescaling DICOM data...')
-        QApplication.processEvents()
-
         if event is not None:
             zoom = self.getRescaleValues(new_vsize, self.voxel_sizemm,
                                          ('Rescale DICOM data',
                                           'Voxel size [mm]:'))
 
-        if zoom is not None:
+        else:
+            zoom = self.voxel_sizemm / np.array(new_vsize)
+
+        if zoom is None:
+            self.statusBar().showMessage('Invalid voxel size!')
+            return
+
+        def prepare():
+            if self.dcm_3Ddata is None:
+                self.statusBar().showMessage('No DICOM data!')
+                return None
+
+            return (rescale_volume, (self.dcm_3Ddata, zoom),
+                    {'progress': None}, done)
+
+        def done(data):
             self.dcm_zoom *= zoom
-            self.dcm_3Ddata = ndimage.zoom(self.dcm_3Ddata, zoom,
-                                           prefilter=False, mode='nearest')
-            self.voxel_sizemm /= zoom
+            self.dcm_3Ddata = data
+            self.voxel_sizemm = self.voxel_sizemm / zoom
             self.setLabelText(self.text_dcm_data, self.getDcmInfo())
 
             self.statusBar().showMessage('Ready')
 
-        else:
-            self.statusBar().showMessage('Invalid voxel size!')
+        self.addTask('Rescaling DICOM data', prepare)
 
     def cropDcm(self):
         if self.dcm_3Ddata is None:
@@ -523,22 +653,23 @@ class MainWindow(QMainWindow):
 
     def saveDcm(self, event=None, filename=None):
         if self.dcm_3Ddata is not None:
-            self.statusBar().showMessage('Saving DICOM data...')
-            QApplication.processEvents()
-
             if filename is None:
                 filename = \
                     str(QFileDialog.getSaveFileName(self,
                                                     'Save DCM file',
-                                                    filter='Files (*.dcm)'))
+                                                    filter=project_filter))
             if len(filename) > 0:
-                savemat(filename, {'data': self.dcm_3Ddata,
-                                   'voxelsize_mm': self.voxel_sizemm,
-                                   'offset_mm': self.dcm_offsetmm},
-                                   appendmat=False)
+                def prepare():
+                    return (save_file, (filename,),
+                            {'data': self.dcm_3Ddata,
+                             'voxelsize_mm': self.voxel_sizemm,
+                             'offset_mm': self.dcm_offsetmm}, done)
 
-                #self.setLabelText(self.text_dcm_out, filename)
-                self.statusBar().showMessage('Ready')
+                def done(ret):
+                    #self.setLabelText(self.text_dcm_out, filename)
+                    self.statusBar().showMessage('Ready')
+
+                self.addTask('Saving DICOM data', prepare)
 
             else:
                 self.statusBar().showMessage('No output file specified!')
@@ -547,25 +678,23 @@ class MainWindow(QMainWindow):
             self.statusBar().showMessage('No DICOM data!')
 
     def loadDcm(self, event=None, filename=None):
-        self.statusBar().showMessage('Loading DICOM data...')
-        QApplication.processEvents()
-
         if filename is None:
             filename = str(QFileDialog.getOpenFileName(self, 'Load DCM file',
-                                                       filter='Files (*.dcm)'))
+                                                       filter=project_filter))
 
         if len(filename) > 0:
+            def prepare():
+                return load_file, (filename,), {'names': ['data']}, done
+
+            def done(data):
+                self.dcm_3Ddata = data['data']
+                self.voxel_sizemm = data['voxelsize_mm']
+                self.dcm_offsetmm = data['offset_mm']
+                self.setVoxelVolume(self.voxel_sizemm)
+                self.setLabelText(self.text_seg_in, filename)
+                self.statusBar().showMessage('Ready')
 
-            data = loadmat(filename,
-                           variable_names=['data', 'voxelsize_mm', 'offset_mm'],
-                           appendmat=False)
-
-            self.dcm_3Ddata = data['data']
-            self.voxel_sizemm = data['voxelsize_mm'].reshape((3,))
-            self.dcm_offsetmm = data['offset_mm'].reshape((3,))
-            self.setVoxelVolume(self.voxel_sizemm.reshape((3,)))
-            self.setLabelText(self.text_seg_in, filename)
-            self.statusBar().showMessage('Ready')
+            self.addTask('Loading DICOM data', prepare)
 
         else:
             self.statusBar().showMessage('No input file specified!')
@@ -636,28 +765,26 @@ class MainWindow(QMainWindow):
 
     def saveSeg(self, event=None, filename=None):
         if self.segmentation_data is not None:
-            self.statusBar().showMessage('Saving segmentation data...')
-            QApplication.processEvents()
-
             if filename is None:
                 filename = \
                     str(QFileDialog.getSaveFileName(self,
                                                     'Save SEG file',
-                                                    filter='Files (*.seg)'))
+                                                    filter=project_filter))
 
             if len(filename) > 0:
+                def prepare():
+                    return (save_file, (filename,),
+                            {'data': self.dcm_3Ddata,
+                             'segdata': self.segmentation_data,
+                             'segseeds': self.segmentation_seeds,
+                             'voxelsize_mm': self.voxel_sizemm,
+                             'offset_mm': self.dcm_offsetmm}, done)
 
-                outdata = {'data': self.dcm_3Ddata,
-                           'segdata': self.segmentation_data,
-                           'voxelsize_mm': self.voxel_sizemm,
-                           'offset_mm': self.dcm_offsetmm}
+                def done(ret):
+                    #self.setLabelText(self.text_seg_out, filename)
+                    self.statusBar().showMessage('Ready')
 
-                if self.segmentation_seeds is not None:
-                    outdata['segseeds'] = self.segmentation_seeds
-
-                savemat(filename, outdata, appendmat=False)
-                #self.setLabelText(self.text_seg_out, filename)
-                self.statusBar().showMessage('Ready')
+                self.addTask('Saving segmentation data', prepare)
 
             else:
                 self.statusBar().showMessage('No output file specified!')
@@ -668,31 +795,29 @@ class MainWindow(QMainWindow):
     def loadSeg(self, event=None, filename=None):
         if filename is None:
             filename = str(QFileDialog.getOpenFileName(self, 'Load SEG file',
-                                                       filter='Files (*.seg)'))
+                                                       filter=project_filter))
 
         if len(filename) > 0:
-            self.statusBar().showMessage('Loading segmentation data...')
-            QApplication.processEvents()
-
-            data = loadmat(filename,
-                           variable_names=['data', 'segdata', 'segseeds',
-                                           'voxelsize_mm', 'offset_mm'],
-                           appendmat=False)
-
-            self.dcm_3Ddata = data['data']
-            self.segmentation_data = data['segdata']
-            if 'segseeds' in data:
-                self.segmentation_seeds = data['segseeds']
-
-            else:
-                self.segmentation_seeds = None
+            def prepare():
+                return load_file, (filename,), {}, done
+
+            def done(data):
+                if 'segdata' not in data:
+                    self.statusBar().showMessage('No segmentation data'
+                                                 ' in file!')
+                    return
+
+                self.dcm_3Ddata = data.get('data')
+                self.segmentation_data = data['segdata']
+                self.segmentation_seeds = data.get('segseeds')
+                self.voxel_sizemm = data['voxelsize_mm']
+                self.dcm_offsetmm = data['offset_mm']
+                self.setVoxelVolume(self.voxel_sizemm)
+                self.setLabelText(self.text_mesh_in, filename)
+                self.setLabelText(self.text_mesh_grid, self.getSegInfo())
+                self.statusBar().showMessage('Ready')
 
-            self.voxel_sizemm = data['voxelsize_mm'].reshape((3,))
-            self.dcm_offsetmm = data['offset_mm'].reshape((3,))
-            self.setVoxelVolume(self.voxel_sizemm.reshape((3,)))
-            self.setLabelText(self.text_mesh_in, filename)
-            self.setLabelText(self.text_mesh_grid, self.getSegInfo())
-            self.statusBar().showMessage('Ready')
+            self.addTask('Loading segmentation data', prepare)
 
         else:
             self.statusBar().showMessage('No input file specified!')
@@ -702,31 +827,34 @@ class MainWindow(QMainWindow):
             self.statusBar().showMessage('No segmentation data!')
             return
 
-        self.statusBar().showMessage('Rescaling segmentation data...')
-        QApplication.processEvents()
-
         zoom = self.getRescaleValues(new_vsize, self.voxel_sizemm,
                                      ('Rescale segmentation data',
                                       'Grid size [mm]:'))
 
-        if zoom is not None:
+        if zoom is None:
+            self.statusBar().showMessage('Invalid grid size!')
+            return
+
+        def prepare():
+            if self.segmentation_data is None:
+                self.statusBar().showMessage('No segmentation data!')
+                return None
+
+            return (rescale_mask, (self.segmentation_data, zoom),
+                    {'progress': None}, done)
+
+        def done(data):
             self.dcm_zoom *= zoom
-            self.segmentation_data_scaled =\
-                ndimage.zoom(self.segmentation_data, zoom,
-                             prefilter=False, mode='nearest')
+            self.segmentation_data_scaled = data
             self.voxel_sizemm_scaled = self.voxel_sizemm / zoom
             self.setLabelText(self.text_mesh_grid, self.getSegInfo())
 
             self.statusBar().showMessage('Ready')
 
-        else:
-            self.statusBar().showMessage('Invalid grid size!')
+        self.addTask('Rescaling segmentation data', prepare)
 
     def saveMesh(self, event=None, filename=None):
         if self.mesh_data is not None:
-            self.statusBar().showMessage('Saving mesh...')
-            QApplication.processEvents()
-
             if filename is None:
                 file_ext = inv_supported_formats[self.mesh_out_format]
                 filename = \
@@ -735,12 +863,17 @@ class MainWindow(QMainWindow):
                                                         % file_ext))
 
             if len(filename) > 0:
+                out_format = self.mesh_out_format
 
-                io = MeshIO.for_format(filename, format=self.mesh_out_format,
-                                       writable=True)
-                io.write(filename, self.mesh_data)
+                def prepare():
+                    io = MeshIO.for_format(filename, format=out_format,
+                                           writable=True)
+                    return io.write, (filename, self.mesh_data), {}, done
 
-                self.statusBar().showMessage('Ready')
+                def done(ret):
+                    self.statusBar().showMessage('Ready')
+
+                self.addTask('Saving mesh', prepare)
 
             else:
                 self.statusBar().showMessage('No output file specified!')
@@ -763,24 +896,38 @@ class MainWindow(QMainWindow):
             else:
                 return None
 
-        self.statusBar().showMessage('Generating mesh...')
-        QApplication.processEvents()
+        if (self.segmentation_data is None
+            and self.segmentation_data_scaled is None):
+            self.statusBar().showMessage('No segmentation data!')
+            return
 
-        if self.segmentation_data_scaled is not None:
-            segdata = self.segmentation_data_scaled
-            voxelsize = self.voxel_sizemm_scaled * 1.0e-3
+        mgid, gen_fun, pars = mesh_generators[self.mesh_generator]
+        pars = pars.copy()
+        if mgid == 1:
+            pars['scale_factor'] = getScaleFactor(self, value=0.25)
+            if pars['scale_factor'] is None:
+                self.statusBar().showMessage('Invalid scale factor!')
+                return
 
-        else:
-            segdata = self.segmentation_data
-            voxelsize = self.voxel_sizemm * 1.0e-3
+        pars['progress'] = None
 
-        if segdata is not None:
-            mgid, gen_fun, pars = mesh_generators[self.mesh_generator]
-            if mgid == 1:
-                pars['scale_factor'] = getScaleFactor(self, value=0.25)
+        def prepare():
+            if self.segmentation_data_scaled is not None:
+                segdata = self.segmentation_data_scaled
+                voxelsize = self.voxel_sizemm_scaled * 1.0e-3
 
-            self.mesh_data = gen_fun(segdata, voxelsize, **pars)
+            else:
+                segdata = self.segmentation_data
+                voxelsize = self.voxel_sizemm * 1.0e-3
+
+            if segdata is None:
+                self.statusBar().showMessage('No segmentation data!')
+                return None
 
+            return gen_fun, (segdata, voxelsize), pars, done
+
+        def done(mesh):
+            self.mesh_data = mesh
             self.mesh_data.coors += self.dcm_offsetmm * 1.0e-3
 
             self.setLabelText(self.text_mesh_data, '%d %s'\
@@ -789,39 +936,42 @@ class MainWindow(QMainWindow):
 
             self.statusBar().showMessage('Ready')
 
-        else:
-            self.statusBar().showMessage('No segmentation data!')
+        self.addTask('Generating mesh', prepare)
 
     def smoothMesh(self):
-        self.statusBar().showMessage('Smoothing mesh...')
-        QApplication.processEvents()
+        method = self.mesh_smooth_method
+        smooth_fun, pars = smooth_methods[method]
+        pars = dict(pars, progress=None)
+
+        def prepare():
+            if self.mesh_data is None:
+                self.statusBar().showMessage('No mesh data!')
+                return None
 
-        if self.mesh_data is not None:
-            smooth_fun, pars = smooth_methods[self.mesh_smooth_method]
             etype = '%d_%d' % (self.mesh_data.dim,
                                self.mesh_data.conns[0].shape[-1])
             if (etype == '2_2' or etype == '3_3') and pars['volume_corr']:
                 self.statusBar().showMessage('No volume mesh!')
+                return None
 
-            else:
-                self.mesh_data.coors = smooth_fun(self.mesh_data, **pars)
+            return smooth_fun, (self.mesh_data,), pars, done
 
-                self.setLabelText(self.text_mesh_data,
-                                  '%d %s, smooth method - %s'\
-                                      % (self.mesh_data.n_el,
-                                         elem_tab[self.mesh_data.descs[0]],
-                                         self.mesh_smooth_method))
+        def done(coors):
+            self.mesh_data.coors = coors
 
-                self.statusBar().showMessage('Ready')
+            self.setLabelText(self.text_mesh_data,
+                              '%d %s, smooth method - %s'\
+                                  % (self.mesh_data.n_el,
+                                     elem_tab[self.mesh_data.descs[0]],
+                                     method))
 
-        else:
-            self.statusBar().showMessage('No mesh data!')
+            self.statusBar().showMessage('Ready')
+
+        self.addTask('Smoothing mesh', prepare)
 
     def viewMesh(self):
         if self.mesh_data is not None:
-            vtk_file = 'mesh_geom.vtk'
-            self.mesh_data.write(vtk_file)
-            view = QVTKViewer(vtk_file)
+            view = QVTKViewer(self.mesh_data)
             view.exec_()
 
         else:
@@ -839,8 +989,8 @@ class MainWindow(QMainWindow):
 usage = '%prog [options]\n' + __doc__.rstrip()
 help = {
     'dcm_dir': 'DICOM data direcotory',
-    'dcm_file': 'DCM file with DICOM data',
-    'seg_file': 'file with segmented data',
+    'dcm_file': 'project or DCM file with DICOM data',
+    'seg_file': 'project or SEG file with segmented data',
 }
 
 def main():
@@ -86,6 +86,21 @@ face_tab = {
                      [4,5,6,7]]),
 }
 
+# The element faces ordered so that their normals point outwards of
+# positively oriented elements - for the boundary surfaces.
+surface_face_tab = {
+    '3_4': nm.array([[0,2,1],
+                     [0,1,3],
+                     [1,2,3],
+                     [0,3,2]]),
+    '3_8': nm.array([[0,3,2,1],
+                     [0,1,5,4],
+                     [1,2,6,5],
+                     [2,3,7,6],
+                     [3,0,4,7],
+                     [4,5,6,7]]),
+}
+
 def unique_rows(a):
     a.sort(axis=1)
     order = nm.lexsort(a.T)
@@ -137,3 +152,39 @@ def get_snodes_uedges(conns, etype):
         uedges = edges[uedi]
 
     return sndi, uedges
+
+def get_surface_faces(conns, etype):
+    """
+    Get the boundary faces of volume elements or the edges of surface
+    elements, i.e. the element faces (edges) not shared by two elements.
+
+    Parameters
+    ----------
+    conns : array
+        The element connectivity.
+    etype : str
+        The element type, e.g. '3_4'.
+
+    Returns
+    -------
+    sfaces : array
+        The boundary faces, oriented outwards for positively oriented
+        volume elements, or the boundary edges in the vertex order of the
+        elements.
+    iels : array
+        The indices of elements the faces belong to.
+    """
+    if etype[0] == '2':
+        fci = edge_tab[etype]
+
+    else:
+        fci = surface_face_tab[etype]
+
+    nel = conns.shape[0]
+    nfc, nnpdfc = fci.shape
+
+    faces = conns[:,fci].reshape((nel * nfc, nnpdfc))
+    _, sfci = unique_rows(faces.copy())
+    sfci = nm.where(sfci)[0]
+
+    return faces[sfci], sfci // nfc
@@ -4,9 +4,11 @@
 import numpy as nm
 import os
 import os.path as op
+import re
 import fnmatch
 import shutil
-from base import output, Struct, basestr
+import json
+from base import output, get_default, Struct, basestr
 try:
     import tables as pt
 except:
@@ -197,6 +199,269 @@ def read_array(fd, n_row, n_col, dtype):
 
     return val
 
+_token_re = re.compile(r'\s*(\S*)')
+
+class Tokenizer(object):
+    """
+    A buffered reader of lines, tokens and arrays from a file.
+
+    The file is read in large blocks, and the numeric arrays are parsed
+    directly from the buffer by `numpy.fromstring()`.
+
+    Parameters
+    ----------
+    fd : file or str
+        The file object or the file name. A file opened by the tokenizer is
+        closed by `close()`.
+    block_size : int
+        The size of blocks read from the file.
+    """
+
+    def __init__(self, fd, block_size=1048576):
+        if isinstance(fd, basestr):
+            fd = open(fd, 'rb')
+
+        self.fd = fd
+        self.block_size = block_size
+        self.buf = ''
+        self.pos = 0
+        self.offset = fd.tell()
+        self.eof = False
+
+    def close(self):
+        self.fd.close()
+
+    def tell(self):
+        """
+        Return the file position of the next unread byte.
+        """
+        return self.offset + self.pos
+
+    def _fill(self, size=None):
+        """
+        Read the next block of at least `size` bytes and drop the already
+        consumed part of the buffer. Return False at EOF.
+        """
+        if self.eof:
+            return False
+
+        size = max(get_default(size, 0), self.block_size)
+        block = self.fd.read(size)
+        if not block:
+            self.eof = True
+            return False
+
+        self.offset += self.pos
+        self.buf = self.buf[self.pos:] + block
+        self.pos = 0
+
+        return True
+
+    def readline(self):
+        """
+        Read a line including the end-of-line character, as file.readline().
+        Return an empty string at EOF.
+        """
+        while 1:
+            ii = self.buf.find('\n', self.pos)
+            if ii >= 0:
+                break
+
+            if not self._fill():
+                ii = len(self.buf) - 1
+                break
+
+        line = self.buf[self.pos:ii+1]
+        self.pos = ii + 1
+
+        return line
+
+    def skip_read_line(self, no_eof=False):
+        """
+        Read the first non-empty line that is not a comment, see
+        `skip_read_line()`.
+        """
+        return skip_read_line(self, no_eof=no_eof)
+
+    def read_token(self):
+        """
+        Read a single token (sequence of non-whitespace characters).
+
+        Notes
+        -----
+        Consumes the first whitespace character after the token.
+        """
+        while 1:
+            match = _token_re.match(self.buf, self.pos)
+            if (match.end() < len(self.buf)) or not self._fill():
+                break
+
+        self.pos = min(match.end() + 1, len(self.buf))
+
+        return match.group(1)
+
+    def _find_values_end(self, count, size):
+        """
+        Find the end of the whitespace following `count` tokens in the next
+        `size` bytes of the buffer. Return None, if they are not all there.
+        """
+        size = min(size, len(self.buf) - self.pos)
+        if size <= 0:
+            return None
+
+        chars = nm.frombuffer(self.buf, dtype=nm.uint8, count=size,
+                              offset=self.pos)
+        is_space = (chars == 32) | ((chars >= 9) & (chars <= 13))
+        starts = nm.flatnonzero(is_space[:-1] & ~is_space[1:]) + 1
+        if not is_space[0]:
+            starts = nm.r_[0, starts]
+
+        if len(starts) > count:
+            return self.pos + starts[count]
+
+        elif ((len(starts) == count) and self.eof
+              and (self.pos + size == len(self.buf))):
+            return len(self.buf)
+
+        return None
+
+    def read_values(self, count, dtype=nm.float64):
+        """
+        Read `count` whitespace-separated numbers with a single
+        `numpy.fromstring()` call. The whitespace after the last number is
+        consumed.
+        """
+        # Scan a geometrically growing part of the buffer.
+        size = 16 * count + 64
+        while 1:
+            end = self._find_values_end(count, size)
+            if end is not None:
+                break
+
+            if size >= len(self.buf) - self.pos:
+                if not self._fill(size):
+                    end = self._find_values_end(count, size)
+                    break
+
+            size *= 2
+
+        if end is None:
+            raise ValueError('reading of %d values failed!' % count)
+
+        val = nm.fromstring(self.buf[self.pos:end], dtype=dtype, sep=' ',
+                            count=count)
+        self.pos = end
+
+        return val
+
+    def read_array(self, n_row, n_col, dtype):
+        """
+        Read a NumPy array of shape `(n_row, n_col)`, see `read_array()`.
+        """
+        if n_col is None:
+            pos = self.pos
+            n_col = len(self.readline().split())
+            self.pos = pos
+
+        count = n_row * n_col
+        try:
+            val = self.read_values(count)
+
+        except ValueError:
+            raise ValueError('(%d, %d) array reading failed!' % (n_row, n_col))
+
+        val = nm.asarray(val, dtype=dtype)
+        val.shape = (n_row, n_col)
+
+        return val
+
+    def read_binary(self, count, dtype, skip=False):
+        """
+        Read `count` binary values of type `dtype`. If `skip` is True, the
+        values are skipped and None is returned.
+        """
+        dtype = nm.dtype(dtype)
+        size = count * dtype.itemsize
+
+        if skip and (len(self.buf) - self.pos < size):
+            self.fd.seek(self.offset + self.pos + size)
+            self.offset += self.pos + size
+            self.buf = ''
+            self.pos = 0
+            return None
+
+        while len(self.buf) - self.pos < size:
+            if not self._fill(size - (len(self.buf) - self.pos)):
+                raise ValueError('reading of %d binary values failed!'
+                                 % count)
+
+        if skip:
+            val = None
+
+        else:
+            val = nm.frombuffer(self.buf, dtype=dtype, count=count,
+                                offset=self.pos).copy()
+        self.pos += size
+
+        return val
+
+def write_array(fd, array, format, chunk_size=10000):
+    """
+    Write rows of a NumPy array to the given text file object.
+
+    The rows are formatted in chunks - the row `format` is repeated for
+    all rows of a chunk, applied to the flattened chunk values at once,
+    and the result is written by a single `fd.write()` call. The output is
+    identical to writing `format % tuple(row)` for each row.
+
+    Parameters
+    ----------
+    fd : file
+        The file object opened for writing.
+    array : array or tuple of arrays
+        The array to write. 1D arrays are treated as columns. A tuple of
+        arrays with the same number of rows is written as if the arrays
+        were stacked horizontally, but without casting them to a common
+        data type, so that e.g. float coordinates can be followed by
+        integer groups.
+    format : str
+        The format of a single row, including the newline character(s).
+    chunk_size : int
+        The number of rows formatted at once.
+    """
+    if not isinstance(array, tuple):
+        array = (array,)
+
+    arrays = []
+    for ar in array:
+        ar = nm.asarray(ar)
+        if ar.ndim == 1:
+            ar = ar[:, None]
+
+        elif ar.ndim > 2:
+            ar = ar.reshape((ar.shape[0], int(nm.prod(ar.shape[1:]))))
+
+        arrays.append(ar)
+
+    n_row = arrays[0].shape[0]
+    n_col = sum(ar.shape[1] for ar in arrays)
+    for ir in xrange(0, n_row, chunk_size):
+        chunk = [ar[ir:ir + chunk_size] for ar in arrays]
+        n_chunk = chunk[0].shape[0]
+
+        if len(chunk) == 1:
+            vals = chunk[0].ravel().tolist()
+
+        else:
+            aux = nm.empty((n_chunk, n_col), dtype=nm.object)
+            ic = 0
+            for ar in chunk:
+                aux[:, ic:ic + ar.shape[1]] = ar
+                ic += ar.shape[1]
+            vals = aux.ravel().tolist()
+
+        fd.write((format * n_chunk) % tuple(vals))
+
 ##
 # c: 05.02.2008, r: 05.02.2008
 def read_list(fd, n_item, dtype):
@@ -212,6 +477,99 @@ def read_list(fd, n_item, dtype):
 
     return vals
 
+def get_file_stamp(filename):
+    """
+    Get the modification time and the size of a file, that identify its
+    contents for caching purposes.
+    """
+    st = os.stat(filename)
+    return st.st_mtime, st.st_size
+
+def get_sidecar_name(filename):
+    return filename + '.meta'
+
+def read_sidecar(filename, key):
+    """
+    Read the data cached for `filename` in its sidecar file.
+
+    Returns
+    -------
+    data : dict or None
+        The cached data, or None if the sidecar does not exist, was written
+        for another `key`, or the file has changed since.
+    """
+    try:
+        fd = open(get_sidecar_name(filename), 'r')
+        aux = json.load(fd)
+        fd.close()
+
+    except (IOError, ValueError):
+        return None
+
+    mtime, size = get_file_stamp(filename)
+    if ((aux.get('key') != key) or (aux.get('mtime') != mtime)
+        or (aux.get('size') != size)):
+        return None
+
+    return aux.get('data')
+
+def write_sidecar(filename, key, data):
+    """
+    Cache JSON-serializable `data` for `filename` in its sidecar file,
+    together with `key` and the file stamp. Failures to write (e.g. in
+    read-only directories) are silently ignored.
+    """
+    mtime, size = get_file_stamp(filename)
+    aux = {'key' : key, 'mtime' : mtime, 'size' : size, 'data' : data}
+    try:
+        fd = open(get_sidecar_name(filename), 'w')
+        try:
+            json.dump(aux, fd)
+
+        finally:
+            fd.close()
+
+    except (IOError, OSError):
+        pass
+
+class LazyList(object):
+    """
+    A list of arrays that are read from the given nodes (e.g. PyTables
+    arrays, or any objects with `shape` attribute and `read()` method) on
+    the first access.
+    """
+
+    def __init__(self, nodes, dtype=None):
+        self.nodes = list(nodes)
+        self.dtype = dtype
+        self.shapes = [tuple(node.shape) for node in self.nodes]
+        self.arrays = [None] * len(self.nodes)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def __getitem__(self, ii):
+        if isinstance(ii, slice):
+            return [self[ir] for ir in xrange(*ii.indices(len(self)))]
+
+        if self.arrays[ii] is None:
+            self.arrays[ii] = nm.asarray(self.nodes[ii].read(),
+                                         dtype=self.dtype)
+
+        return self.arrays[ii]
+
+    def __setitem__(self, ii, array):
+        self.arrays[ii] = array
+        self.shapes[ii] = array.shape
+
+    def __iter__(self):
+        for ii in xrange(len(self)):
+            yield self[ii]
+
+    def __repr__(self):
+        return 'LazyList(%s)' % ', '.join('%s' % (shape,)
+                                          for shape in self.shapes)
+
 def write_dict_hdf5(filename, adict, level=0, group=None, fd=None):
 
     if level == 0:
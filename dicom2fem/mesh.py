@@ -401,7 +401,7 @@ class Mesh( Struct ):
 
     @staticmethod
     def from_file(filename=None, io='auto', prefix_dir=None,
-                  omit_facets=False):
+                  omit_facets=False, lazy=False):
         """
         Read a mesh from a file.
 
@@ -419,6 +419,11 @@ class Mesh( Struct ):
             If True, do not read cells of lower dimension than the space
             dimension (faces and/or edges). Only some MeshIO subclasses
             support this!
+        lazy : bool
+            If True, the mesh arrays are read on the first access, and the
+            file is kept open until the mesh is closed, see Mesh.close().
+            Only some MeshIO subclasses support this, the others read the
+            whole mesh.
         """
         if isinstance(filename, Mesh):
             return filename
@@ -435,7 +440,11 @@ class Mesh( Struct ):
 
         trunk = io.get_filename_trunk()
         mesh = Mesh(trunk)
-        mesh = io.read(mesh, omit_facets=omit_facets)
+        if lazy:
+            mesh = io.read_lazy(mesh, omit_facets=omit_facets)
+
+        else:
+            mesh = io.read(mesh, omit_facets=omit_facets)
 
         output('...done in %.2f s' % (time.clock() - tt))
 
@@ -536,6 +545,49 @@ class Mesh( Struct ):
             output( '...done in %.2f s' % (time.clock() - tt) )
             self._set_shape_info()
             
+    def __getattr__(self, name):
+        """
+        Read a lazily loaded array on the first access.
+        """
+        lazy = self.__dict__.get('_lazy_arrays')
+        if lazy and (name in lazy):
+            val = nm.ascontiguousarray(lazy.pop(name).read())
+            setattr(self, name, val)
+            return val
+
+        raise AttributeError(name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """
+        Close the file of a lazily read mesh. The arrays not accessed
+        before cannot be read afterwards - call Mesh.load() to read them.
+        """
+        fd = self.__dict__.pop('_lazy_fd', None)
+        if fd is not None:
+            fd.close()
+
+    def load(self):
+        """
+        Read all lazily loaded arrays and close the file.
+        """
+        if '_lazy_fd' not in self.__dict__:
+            return
+
+        for name in self._lazy_arrays.keys():
+            getattr(self, name)
+        del self._lazy_arrays
+
+        self.conns = list(self.conns)
+        self.mat_ids = list(self.mat_ids)
+
+        self.close()
+
     def copy(self, name=None):
         """Make a deep copy of self.
 
@@ -544,15 +596,25 @@ class Mesh( Struct ):
         name : str
             Name of the copied mesh.
         """
+        self.load()
         return Struct.copy(self, deep=True, name=name)
 
     ##
     # 04.08.2006, c
     # 29.09.2006
     def _set_shape_info( self ):
-        self.n_nod, self.dim = self.coors.shape
-        self.n_els = nm.array( [conn.shape[0] for conn in self.conns] )
-        self.n_e_ps = nm.array( [conn.shape[1] for conn in self.conns] )
+        lazy = self.__dict__.get('_lazy_arrays', {})
+        if 'coors' in lazy:
+            self.n_nod, self.dim = lazy['coors'].shape
+        else:
+            self.n_nod, self.dim = self.coors.shape
+
+        if hasattr(self.conns, 'shapes'):
+            shapes = self.conns.shapes
+        else:
+            shapes = [conn.shape for conn in self.conns]
+        self.n_els = nm.array( [shape[0] for shape in shapes] )
+        self.n_e_ps = nm.array( [shape[1] for shape in shapes] )
         self.el_offsets = nm.cumsum( nm.r_[0, self.n_els] )
         self.n_el = nm.sum( self.n_els )
         self.dims = [int(ii[0]) for ii in self.descs]
@@ -591,6 +653,33 @@ class Mesh( Struct ):
         self.descs = descs
         self.nodal_bcs = get_default(nodal_bcs, {})
 
+    def _set_lazy_data(self, fd, arrays, conns, mat_ids, descs):
+        """
+        Set mesh data to be read on the first access.
+
+        Parameters
+        ----------
+        fd : file
+            The open file, closed by Mesh.close().
+        arrays : dict
+            The objects with `shape` attribute and `read()` method for the
+            `coors` and `ngroups` arrays.
+        conns, mat_ids : list-like of arrays
+            The lazily loaded connectivities and material ids (see
+            `ioutils.LazyList`).
+        descs: list of strings
+            The element type for each element group.
+        """
+        for name in arrays:
+            self.__dict__.pop(name, None)
+
+        self._lazy_fd = fd
+        self._lazy_arrays = dict(arrays)
+        self.conns = conns
+        self.mat_ids = mat_ids
+        self.descs = descs
+        self.nodal_bcs = {}
+
     def _append_region_faces(self, region, force_faces=False):
         fa = region.domain.get_facets(force_faces=force_faces)[1]
         if fa is None:
@@ -2,6 +2,7 @@
 # Thanks to Robert Cimrman
 
 import sys
+import re
 from copy import copy
 import os.path as op
 import numpy as nm
@@ -9,13 +10,15 @@ import numpy as nm
 from base import (complex_types, dict_from_keys_init,
                   assert_, is_derived_class,
                   insert_static_method, output, get_default,
-                  get_default_attr, Struct, basestr)
+                  get_default_attr, ordered_iteritems, Struct, basestr)
 from ioutils \
-     import skip_read_line, read_token, read_array, read_list, pt
+     import (skip_read_line, write_array, Tokenizer, read_sidecar,
+             write_sidecar, LazyList, pt)
 
 supported_formats = {
     '.mesh' : 'medit',
     '.vtk'  : 'vtk',
+    '.vtu'  : 'vtu',
     '.node' : 'tetgen',
     '.txt'  : 'comsol',
     '.h5'   : 'hdf5',
@@ -27,6 +30,7 @@ supported_formats = {
     '.neu'  : 'gambit',
     '.med'  : 'med',
     '.cdb'  : 'ansys_cdb',
+    '.stl'  : 'stl',
 }
 
 # Map mesh formats to read and write capabilities.
@@ -37,6 +41,7 @@ supported_formats = {
 supported_capabilities = {
     'medit' : ['r', 'w'],
     'vtk' : ['r', 'w'],
+    'vtu' : ['r', 'w'],
     'tetgen' : ['r'],
     'comsol' : ['r', 'w'],
     'hdf5' : ['r', 'w'],
@@ -48,6 +53,7 @@ supported_capabilities = {
     'gambit' : ['r', 'rn'],
     'med' : ['r'],
     'ansys_cdb' : ['r'],
+    'stl' : ['r', 'w'],
 }
 
 def output_writable_meshes():
@@ -117,6 +123,21 @@ def split_by_mat_id( conns_in, mat_ids_in, descs_in ):
     return (conns, mat_ids, descs)
 
 
+def get_metadata_dict(coors, descs, n_els, dim=None, offsets=None):
+    """
+    Assemble the JSON-serializable mesh metadata, see
+    MeshIO.read_metadata().
+    """
+    dim = get_default(dim, coors.shape[1])
+
+    bbox = nm.vstack((nm.amin(coors[:,:dim], 0), nm.amax(coors[:,:dim], 0)))
+    metadata = {'n_nod' : int(coors.shape[0]), 'n_el' : int(sum(n_els)),
+                'dim' : int(dim), 'bbox' : bbox.tolist(),
+                'descs' : list(descs), 'n_els' : [int(ii) for ii in n_els],
+                'offsets' : get_default(offsets, {})}
+
+    return metadata
+
 ##
 # 12.10.2005, c
 def write_bb( fd, array, dtype ):
@@ -124,8 +145,7 @@ def write_bb( fd, array, dtype ):
     fd.write( '3 %d %d %d\n' % (array.shape[1], array.shape[0], dtype) )
     format = ' '.join( ['%.5e'] * array.shape[1] + ['\n'] )
 
-    for row in array:
-        fd.write( format % tuple( row ) )
+    write_array( fd, array, format )
 
 ##
 # c: 03.10.2005, r: 08.02.2008
@@ -211,6 +231,12 @@ class MeshIO( Struct ):
     subclasses, as it is often possible to get that kind of information without
     reading the whole mesh file.
 
+    The method read_metadata() returns the numbers of nodes and elements, the
+    dimension, the bounding box and the element types, and on request caches
+    them in a sidecar file next to the mesh file. By default, the whole mesh
+    is read once to get them - subclasses can implement _read_metadata() to
+    scan the file faster.
+
     Optionally, subclasses can implement read_data() to read also computation
     results. This concerns mainly the subclasses with implemented write()
     supporting the 'out' kwarg.
@@ -221,6 +247,7 @@ class MeshIO( Struct ):
     
     format = None
     call_msg = 'called an abstract MeshIO instance!'
+    metadata_version = 1
 
     def __init__( self, filename, **kwargs ):
         Struct.__init__( self, filename = filename, **kwargs )
@@ -240,6 +267,60 @@ class MeshIO( Struct ):
     def read_bounding_box( self, ret_fd = False, ret_dim = False ):
         raise ValueError(MeshIO.call_msg)
 
+    def read_metadata(self, cache=False):
+        """
+        Read the mesh metadata.
+
+        Parameters
+        ----------
+        cache : bool
+            If True, the metadata are taken from the sidecar file
+            `<filename>.meta`, if it is up to date, or stored there
+            otherwise. It is off by default, so that queries such as
+            read_dimension() do not write into the mesh directory.
+
+        Returns
+        -------
+        metadata : Struct
+            The numbers of nodes `n_nod` and elements `n_el`, the space
+            dimension `dim`, the bounding box `bbox`, the element types
+            `descs` with the corresponding numbers of elements `n_els` and
+            the file offsets of the file sections `offsets` (if supported by
+            the format).
+        """
+        cache = cache and isinstance(self.filename, basestr)
+        key = '%s:%d' % (self.format, self.metadata_version)
+
+        metadata = read_sidecar(self.filename, key) if cache else None
+        if metadata is None:
+            metadata = self._read_metadata()
+            if cache:
+                write_sidecar(self.filename, key, metadata)
+
+        metadata = Struct(**dict((str(key), val)
+                                 for key, val in metadata.iteritems()))
+        metadata.bbox = nm.array(metadata.bbox, dtype=nm.float64)
+        metadata.descs = [str(desc) for desc in metadata.descs]
+
+        return metadata
+
+    def _read_metadata(self):
+        """
+        Get the metadata as a JSON-serializable dict by reading the whole
+        mesh.
+        """
+        from mesh import Mesh
+
+        mesh = Mesh.from_file(io=self)
+
+        n_els = {}
+        for ig, desc in enumerate(mesh.descs):
+            n_els[desc] = n_els.get(desc, 0) + mesh.n_els[ig]
+        descs = sorted(n_els.keys())
+
+        return get_metadata_dict(mesh.coors, descs,
+                                 [n_els[desc] for desc in descs])
+
     def read_last_step(self):
         """The default implementation: just return 0 as the last step."""
         return 0
@@ -267,6 +348,13 @@ class MeshIO( Struct ):
     def read(self, mesh, omit_facets=False, **kwargs):
         raise ValueError(MeshIO.call_msg)
 
+    def read_lazy(self, mesh, **kwargs):
+        """
+        Read the mesh so that its arrays are loaded on the first access, see
+        Mesh.from_file(). The default implementation just reads the mesh.
+        """
+        return self.read(mesh, **kwargs)
+
     def write(self, filename, mesh, **kwargs):
         raise ValueError(MeshIO.call_msg)
 
@@ -314,7 +402,7 @@ class MeditMeshIO( MeshIO ):
     format = 'medit'
 
     def read_dimension(self, ret_fd=False):
-        fd = open(self.filename, 'r')
+        fd = Tokenizer(self.filename)
         while 1:
             line = skip_read_line(fd, no_eof=True).split()
             if line[0] == 'Dimension':
@@ -331,15 +419,13 @@ class MeditMeshIO( MeshIO ):
             return dim
 
     def read_bounding_box(self, ret_fd=False, ret_dim=False):
-        fd = open(self.filename, 'r')
-
         dim, fd  = self.read_dimension(ret_fd=True)
 
         while 1:
             line = skip_read_line(fd, no_eof=True).split()
             if line[0] == 'Vertices':
-                num = int( read_token( fd ) )
-                nod = read_array( fd, num, dim + 1, nm.float64 )
+                num = self._read_count(fd, line)
+                nod = fd.read_array(num, dim + 1, nm.float64)
                 break
 
         bbox = nm.vstack( (nm.amin( nod[:,:dim], 0 ),
@@ -359,6 +445,17 @@ class MeditMeshIO( MeshIO ):
                 return bbox
 
 
+    def _read_count(self, fd, line):
+        """
+        Read the number of items of a section, given either on the section
+        keyword `line` or on the next line.
+        """
+        if len(line) > 1:
+            return int(line[1])
+
+        else:
+            return int(skip_read_line(fd, no_eof=True).split()[0])
+
     def read(self, mesh, omit_facets=False, **kwargs):
         dim, fd  = self.read_dimension(ret_fd=True)
 
@@ -366,8 +463,8 @@ class MeditMeshIO( MeshIO ):
         descs = []
 
         def _read_cells(dimension, size):
-            num = int(read_token(fd))
-            data = read_array(fd, num, size + 1, nm.int32)
+            num = self._read_count(fd, line)
+            data = fd.read_array(num, size + 1, nm.int32)
             if omit_facets and (dimension < dim): return
 
             data[:, :-1] -= 1
@@ -382,8 +479,8 @@ class MeditMeshIO( MeshIO ):
 
             ls = line[0]
             if (ls == 'Vertices'):
-                num = int( read_token( fd ) )
-                nod = read_array( fd, num, dim + 1, nm.float64 )
+                num = self._read_count(fd, line)
+                nod = fd.read_array(num, dim + 1, nm.float64)
 
             elif (ls == 'Tetrahedra'):
                 _read_cells(3, 4)
@@ -419,12 +516,9 @@ class MeditMeshIO( MeshIO ):
             mat_id_in = mat_ids.pop(ic)
             
             flag = nm.zeros( (conn_in.shape[0],), nm.int32 )
-            for ii, el in enumerate( conn_in ):
-                if (el[4] == el[5]):
-                    if (el[5] == el[6]):
-                        flag[ii] = 2
-                    else:
-                        flag[ii] = 1
+            is_wedge = conn_in[:,4] == conn_in[:,5]
+            flag[is_wedge] = 1
+            flag[is_wedge & (conn_in[:,5] == conn_in[:,6])] = 2
 
             conn = []
             desc = []
@@ -475,41 +569,18 @@ class MeditMeshIO( MeshIO ):
 
         fd.write( "Vertices\n%d\n" % n_nod )
         format = self.get_vector_format( dim ) + ' %d\n'
-        for ii in range( n_nod ):
-            nn = tuple( coors[ii] ) + (mesh.ngroups[ii],)
-            fd.write( format % tuple( nn ) )
+        write_array( fd, (coors, mesh.ngroups), format )
 
+        medit_names = {'1_2' : 'Edges', '2_4' : 'Quadrilaterals',
+                       '2_3' : 'Triangles', '3_4' : 'Tetrahedra',
+                       '3_8' : 'Hexahedra'}
         for ig, conn in enumerate( conns ):
-            if (desc[ig] == "1_2"):
-                fd.write( "Edges\n%d\n" % conn.shape[0] )
-                for ii in range( conn.shape[0] ):
-                    nn = conn[ii] + 1
-                    fd.write( "%d %d %d\n" \
-                              % (nn[0], nn[1], nn[2] - 1) )
-            elif (desc[ig] == "2_4"):
-                fd.write( "Quadrilaterals\n%d\n" % conn.shape[0] )
-                for ii in range( conn.shape[0] ):
-                    nn = conn[ii] + 1
-                    fd.write( "%d %d %d %d %d\n" \
-                              % (nn[0], nn[1], nn[2], nn[3], nn[4] - 1) )
-            elif (desc[ig] == "2_3"):
-                fd.write( "Triangles\n%d\n" % conn.shape[0] )
-                for ii in range( conn.shape[0] ):
-                    nn = conn[ii] + 1
-                    fd.write( "%d %d %d %d\n" % (nn[0], nn[1], nn[2], nn[3] - 1) )
-            elif (desc[ig] == "3_4"):
-                fd.write( "Tetrahedra\n%d\n" % conn.shape[0] )
-                for ii in range( conn.shape[0] ):
-                    nn = conn[ii] + 1
-                    fd.write( "%d %d %d %d %d\n"
-                              % (nn[0], nn[1], nn[2], nn[3], nn[4] - 1) )
-            elif (desc[ig] == "3_8"):
-                fd.write( "Hexahedra\n%d\n" % conn.shape[0] )
-                for ii in range( conn.shape[0] ):
-                    nn = conn[ii] + 1
-                    fd.write( "%d %d %d %d %d %d %d %d %d\n"
-                              % (nn[0], nn[1], nn[2], nn[3], nn[4], nn[5],
-                                 nn[6], nn[7], nn[8] - 1) )
+            if desc[ig] in medit_names:
+                fd.write( "%s\n%d\n" % (medit_names[desc[ig]],
+                                         conn.shape[0]) )
+                # Vertices are one-based, the last column is mat_id.
+                format = ' '.join( ['%d'] * conn.shape[1] ) + '\n'
+                write_array( fd, (conn[:, :-1] + 1, conn[:, -1]), format )
             else:
                 print 'unknown element type!', desc[ig]
                 raise ValueError
@@ -523,7 +594,7 @@ class MeditMeshIO( MeshIO ):
 
 vtk_header = r"""# vtk DataFile Version 2.0
 step %d time %e normalized time %e, generated by %s
-ASCII
+%s
 DATASET UNSTRUCTURED_GRID
 """
 vtk_cell_types = {'2_2' : 3, '2_4' : 9, '2_3' : 5,
@@ -537,26 +608,245 @@ vtk_remap = {8 : nm.array([0, 1, 3, 2], dtype=nm.int32),
              11 : nm.array([0, 1, 3, 2, 4, 5, 7, 6], dtype=nm.int32)}
 vtk_remap_keys = vtk_remap.keys()
 
+def reshape_vtk_tensors(data, dim, sym, nc):
+    """
+    Reshape symmetric or non-symmetric tensors with `nc` components to the
+    full 3x3 VTK tensors stored row-wise.
+    """
+    if dim == 3:
+        if nc == sym:
+            aux = data[:, [0,3,4,3,1,5,4,5,2]]
+        elif nc == (dim * dim):
+            aux = data[:, [0,3,4,6,1,5,7,8,2]]
+        else:
+            aux = data.reshape((data.shape[0], dim*dim))
+
+    else:
+        zz = nm.zeros((data.shape[0], 1), dtype=nm.float64)
+        if nc == sym:
+            aux = nm.c_[data[:,[0,2]], zz, data[:,[2,1]],
+                        zz, zz, zz, zz]
+        elif nc == (dim * dim):
+            aux = nm.c_[data[:,[0,2]], zz, data[:,[3,1]],
+                        zz, zz, zz, zz]
+        else:
+            aux = nm.c_[data[:,0,[0,1]], zz, data[:,1,[0,1]],
+                        zz, zz, zz, zz]
+
+    return aux
+
+vtk_dtypes = {'unsigned_char' : 'u1', 'char' : 'i1',
+              'unsigned_short' : '>u2', 'short' : '>i2',
+              'unsigned_int' : '>u4', 'int' : '>i4',
+              'unsigned_long' : '>u8', 'long' : '>i8',
+              'vtktypeuint64' : '>u8', 'vtktypeint64' : '>i8',
+              'float' : '>f4', 'double' : '>f8'}
+vtk_n_e_ps = {1 : 1, 3 : 2, 5 : 3, 8 : 4, 9 : 4, 10 : 4, 11 : 8, 12 : 8,
+              13 : 6, 14 : 5}
+
+def get_vtk_cell_starts(cells, cell_types):
+    """
+    Get the starts and the numbers of vertices of cells stored in the
+    legacy VTK CELLS array `cells` (the count followed by the vertices for
+    each cell).
+
+    The starts are computed from the cell types, if all of them have a fixed
+    number of vertices. Otherwise the array is traversed cell by cell.
+    """
+    table = nm.zeros(max(cell_types.max(), max(vtk_n_e_ps.keys())) + 1,
+                     dtype=nm.int64)
+    table[vtk_n_e_ps.keys()] = vtk_n_e_ps.values()
+
+    n_e_ps = table[cell_types]
+    if (n_e_ps > 0).all():
+        starts = nm.cumsum(n_e_ps + 1) - n_e_ps
+        if (cells[starts - 1] == n_e_ps).all():
+            return starts, n_e_ps
+
+    starts = nm.empty(len(cell_types), dtype=nm.int64)
+    ii = 0
+    for iel in xrange(len(cell_types)):
+        starts[iel] = ii + 1
+        ii += cells[ii] + 1
+
+    return starts, cells[starts - 1]
+
 ##
 # c: 05.02.2008
 class VTKMeshIO( MeshIO ):
     format = 'vtk'
 
-    def read_coors(self, ret_fd=False):
-        fd = open( self.filename, 'r' )
+    def _open(self):
+        """
+        Open the file and read the header. Return the file tokenizer, the
+        file format version and the binary flag.
+        """
+        fd = Tokenizer(self.filename)
+        version = fd.readline().split()[-1]
+        fd.readline() # title
+        encoding = fd.readline().strip().upper()
+        if encoding not in ('ASCII', 'BINARY'):
+            raise ValueError('unknown VTK file encoding! (%s)' % encoding)
+
+        return fd, version, encoding == 'BINARY'
+
+    def _read_block(self, fd, count, dtype, binary, skip=False):
+        """
+        Read a block of `count` values of the VTK type `dtype` with a single
+        call. If `skip` is True, the block is skipped and None returned.
+        """
+        if dtype not in vtk_dtypes:
+            raise ValueError('unsupported VTK data type! (%s)' % dtype)
+
+        dtype = nm.dtype(vtk_dtypes[dtype])
+        try:
+            if binary:
+                data = fd.read_binary(count, dtype, skip=skip)
+
+            else:
+                data = fd.read_values(count, dtype=dtype.newbyteorder('='))
+
+        except ValueError:
+            raise ValueError('VTK data block reading failed! (%d values of %s)'
+                             % (count, dtype))
+
+        if skip:
+            return None
+
+        return data
+
+    def read_sections(self, stop=None, skip=(), ret_fd=False):
+        """
+        Read the sections of the file up to the section `stop` (all, if
+        None). The data of sections in `skip` are not stored, and in the
+        BINARY files they are not read at all.
+
+        Returns
+        -------
+        sections : Struct
+            The points, the cells and the point and cell data. For the
+            cells, the `starts` and numbers of vertices `n_e_ps` index the
+            flat `cells` array. The file offsets of the section keyword
+            lines are in `offsets`.
+        """
+        fd, version, binary = self._open()
+
+        sections = Struct(coors=None, cells=None, starts=None, n_e_ps=None,
+                          cell_types=None, point_data={}, cell_data={},
+                          offsets={})
+        def block(count, dtype, shape=None):
+            data = self._read_block(fd, count, dtype, binary,
+                                    skip=key in skip)
+            if (data is not None) and (shape is not None):
+                data.shape = shape
+            return data
+
+        def add_data(name, data):
+            if data is not None:
+                datas[name] = data
+
+        datas = {} # Dataset-level field data are not stored.
         while 1:
-            line = skip_read_line(fd, no_eof=True).split()
-            if line[0] == 'POINTS':
-                n_nod = int( line[1] )
-                coors = read_array(fd, n_nod, 3, nm.float64)
+            offset = fd.tell()
+            line = skip_read_line(fd)
+            if not line:
+                break
+
+            line = line.split()
+            key = line[0].upper()
+            if key in ('POINTS', 'CELLS', 'CELL_TYPES', 'POINT_DATA',
+                       'CELL_DATA'):
+                sections.offsets[key] = offset
+
+            if key == 'DATASET':
+                if line[1].upper() != 'UNSTRUCTURED_GRID':
+                    raise ValueError('unsupported VTK dataset! (%s)'
+                                     % line[1])
+
+            elif key == 'POINTS':
+                n_nod = int(line[1])
+                sections.coors = block(3 * n_nod, line[2], (n_nod, 3))
+
+            elif key == 'CELLS':
+                if float(version) >= 5.1:
+                    # OFFSETS and CONNECTIVITY arrays.
+                    n_off, n_val = int(line[1]), int(line[2])
+                    aux = skip_read_line(fd).split()
+                    offsets = block(n_off, aux[1])
+                    aux = skip_read_line(fd).split()
+                    sections.cells = block(n_val, aux[1])
+                    if offsets is not None:
+                        sections.starts = offsets[:-1]
+                        sections.n_e_ps = nm.diff(offsets)
+
+                else:
+                    sections.cells = block(int(line[2]), 'int')
+
+            elif key == 'CELL_TYPES':
+                sections.cell_types = block(int(line[1]), 'int')
+                if (sections.starts is None) and (sections.cells is not None):
+                    sections.starts, sections.n_e_ps = \
+                        get_vtk_cell_starts(sections.cells,
+                                            sections.cell_types)
+
+            elif key == 'POINT_DATA':
+                n_row, datas = int(line[1]), sections.point_data
+
+            elif key == 'CELL_DATA':
+                n_row, datas = int(line[1]), sections.cell_data
+
+            elif key == 'SCALARS':
+                nc = int(line[3]) if len(line) > 3 else 1
+                skip_read_line(fd) # LOOKUP_TABLE line
+                add_data(line[1], block(n_row * nc, line[2], (n_row, nc)))
+
+            elif key in ('VECTORS', 'NORMALS'):
+                add_data(line[1], block(n_row * 3, line[2], (n_row, 3)))
+
+            elif key == 'TENSORS':
+                add_data(line[1], block(n_row * 9, line[2], (n_row, 9)))
+
+            elif key == 'TEXTURE_COORDINATES':
+                nc = int(line[2])
+                add_data(line[1], block(n_row * nc, line[3], (n_row, nc)))
+
+            elif key == 'COLOR_SCALARS':
+                nc = int(line[2])
+                aux = block(n_row * nc, 'unsigned_char' if binary else 'float')
+
+            elif key == 'LOOKUP_TABLE':
+                aux = block(4 * int(line[2]),
+                            'unsigned_char' if binary else 'float')
+
+            elif key == 'FIELD':
+                for ii in xrange(int(line[2])):
+                    aux = skip_read_line(fd).split()
+                    nc, nt = int(aux[1]), int(aux[2])
+                    add_data(aux[0], block(nc * nt, aux[3], (nt, nc)))
+
+            # Other lines (METADATA etc.) carry no data blocks and are
+            # skipped.
+
+            if key == stop:
                 break
 
+        if ret_fd:
+            return sections, fd
+
+        else:
+            fd.close()
+            return sections
+
+    def read_coors(self, ret_fd=False):
+        sections, fd = self.read_sections(stop='POINTS', ret_fd=True)
+        coors = nm.asarray(sections.coors, dtype=nm.float64)
+
         if ret_fd:
             return coors, fd
         else:
             fd.close()
             return coors
-        
+
     def get_dimension(self, coors):
         dz = nm.diff(coors[:,2])
         if nm.allclose(dz, 0.0):
@@ -565,18 +855,47 @@ class VTKMeshIO( MeshIO ):
             dim = 3
         return dim
 
+    def _read_metadata(self):
+        """
+        Get the metadata by scanning the file sections, reading only the
+        points and the cell types.
+        """
+        skip = ('CELLS', 'SCALARS', 'VECTORS', 'NORMALS', 'TENSORS',
+                'TEXTURE_COORDINATES', 'COLOR_SCALARS', 'LOOKUP_TABLE',
+                'FIELD')
+        sections = self.read_sections(skip=skip)
+        dim = self.get_dimension(sections.coors)
+
+        descs = []
+        n_els = []
+        counts = nm.bincount(sections.cell_types)
+        for ct in nm.nonzero(counts)[0]:
+            key = (ct, dim)
+            if key in vtk_inverse_cell_types:
+                descs.append(vtk_inverse_cell_types[key])
+                n_els.append(counts[ct])
+
+        return get_metadata_dict(sections.coors, descs, n_els, dim=dim,
+                                 offsets=sections.offsets)
+
     def read_dimension( self, ret_fd = False ):
+        if not ret_fd:
+            return self.read_metadata().dim
+
         coors, fd = self.read_coors(ret_fd=True)
         dim = self.get_dimension(coors)
-        if ret_fd:
-            return dim, fd
-        else:
-            fd.close()
-            return dim
+        return dim, fd
 
     ##
     # c: 22.07.2008
     def read_bounding_box( self, ret_fd = False, ret_dim = False ):
+        if not ret_fd:
+            metadata = self.read_metadata()
+            if ret_dim:
+                return metadata.bbox, metadata.dim
+            else:
+                return metadata.bbox
+
         coors, fd = self.read_coors(ret_fd=True)
         dim = self.get_dimension(coors)
         
@@ -584,183 +903,111 @@ class VTKMeshIO( MeshIO ):
                            nm.amax( coors[:,:dim], 0 )) )
 
         if ret_dim:
-            if ret_fd:
-                return bbox, dim, fd
-            else:
-                fd.close()
-                return bbox, dim
+            return bbox, dim, fd
         else:
-            if ret_fd:
-                return bbox, fd
-            else:
-                fd.close()
-                return bbox
+            return bbox, fd
 
     ##
     # c: 05.02.2008, r: 10.07.2008
     def read( self, mesh, **kwargs ):
-        fd = open( self.filename, 'r' )
-        mode = 'header'
-        mode_status = 0
-        coors = conns = desc = mat_id = node_grps = None
-        finished = 0
-        while 1:
-            line = skip_read_line(fd)
-            if not line:
-                break
+        sections = self.read_sections()
 
-            if mode == 'header':
-                if mode_status == 0:
-                    if line.strip() == 'ASCII':
-                        mode_status = 1
-                elif mode_status == 1:
-                    if line.strip() == 'DATASET UNSTRUCTURED_GRID':
-                        mode_status = 0
-                        mode = 'points'
-
-            elif mode == 'points':
-                line = line.split()
-                if line[0] == 'POINTS':
-                    n_nod = int( line[1] )
-                    coors = read_array(fd, n_nod, 3, nm.float64)
-                    mode = 'cells'
-
-            elif mode == 'cells':
-                line = line.split()
-                if line[0] == 'CELLS':
-                    n_el, n_val = map( int, line[1:3] )
-                    raw_conn = read_list( fd, n_val, int )
-                    mode = 'cell_types'
-
-            elif mode == 'cell_types':
-                line = line.split()
-                if line[0] == 'CELL_TYPES':
-                    assert_( int( line[1] ) == n_el )
-                    cell_types = read_array(fd, n_el, 1, nm.int32)
-                    mode = 'cp_data'
-
-            elif mode == 'cp_data':
-                line = line.split()
-                if line[0] == 'CELL_DATA':
-                    assert_( int( line[1] ) == n_el )
-                    mode_status = 1
-                    mode = 'mat_id'
-                elif line[0] == 'POINT_DATA':
-                    assert_( int( line[1] ) == n_nod )
-                    mode_status = 1
-                    mode = 'node_groups'
-
-            elif mode == 'mat_id':
-                if mode_status == 1:
-                    if 'SCALARS mat_id int' in line.strip():
-                        mode_status = 2
-                elif mode_status == 2:
-                    if line.strip() == 'LOOKUP_TABLE default':
-                        mat_id = read_list( fd, n_el, int )
-                        mode_status = 0
-                        mode = 'cp_data'
-                        finished += 1
-
-            elif mode == 'node_groups':
-                if mode_status == 1:
-                    if 'SCALARS node_groups int' in line.strip():
-                        mode_status = 2
-                elif mode_status == 2:
-                    if line.strip() == 'LOOKUP_TABLE default':
-                        node_grps = read_list( fd, n_nod, int )
-                        mode_status = 0
-                        mode = 'cp_data'
-                        finished += 1
-
-            elif finished >= 2:
-                break
-        fd.close()
+        coors = sections.coors
+        n_nod = coors.shape[0]
+        cells, starts, n_e_ps = sections.cells, sections.starts, \
+                                sections.n_e_ps
+        cell_types = sections.cell_types
+        n_el = cell_types.shape[0]
 
+        mat_id = sections.cell_data.get('mat_id')
         if mat_id is None:
-            mat_id = [[0]] * n_el
+            mat_id = nm.zeros((n_el,), dtype=nm.int32)
         else:
-            if len(mat_id) < n_el:
-                mat_id = [[ii] for jj in mat_id for ii in jj]
+            mat_id = nm.asarray(mat_id[:,0], dtype=nm.int32)
 
+        node_grps = sections.point_data.get('node_groups')
         if node_grps is None:
-            node_grps = [0] * n_nod
+            node_grps = nm.zeros((n_nod,), dtype=nm.int32)
         else:
-            if len(node_grps) < n_nod:
-                node_grps = [ii for jj in node_grps for ii in jj]
+            node_grps = nm.asarray(node_grps[:,0], dtype=nm.int32)
 
         dim = self.get_dimension(coors)
         if dim == 2:
             coors = coors[:,:2]
-        coors = nm.ascontiguousarray( coors )
+        coors = nm.ascontiguousarray(coors, dtype=nm.float64)
 
-        cell_types = cell_types.squeeze()
+        # Group cells by type.
+        ii = nm.argsort(cell_types, kind='mergesort')
+        aux = cell_types[ii]
+        bounds = nm.r_[0, nm.where(aux[1:] != aux[:-1])[0] + 1, n_el]
 
-        dconns = {}
-        for iel, row in enumerate( raw_conn ):
-            ct = cell_types[iel]
+        desc = []
+        conns = []
+        mat_ids = []
+        for ib in xrange(len(bounds) - 1):
+            iels = ii[bounds[ib]:bounds[ib+1]]
+            ct = aux[bounds[ib]]
             key = (ct, dim)
             if key not in vtk_inverse_cell_types:
                 continue
-            ct = vtk_inverse_cell_types[key]
-            dconns.setdefault(key, []).append(row[1:] + mat_id[iel])
 
-        desc = []
-        conns = []
-        for key, conn in dconns.iteritems():
-            ct = key[0]
-            sct = vtk_inverse_cell_types[key]
-            desc.append(sct)
+            n_ep = n_e_ps[iels[0]]
+            assert_((n_e_ps[iels] == n_ep).all())
 
-            aconn = nm.array(conn, dtype = nm.int32)
+            conn = cells[starts[iels][:,None] + nm.arange(n_ep)]
             if ct in vtk_remap_keys: # Remap pixels and voxels.
-                aconn[:, :-1] = aconn[:, vtk_remap[ct]]
+                conn = conn[:, vtk_remap[ct]]
 
-            conns.append(aconn)
+            desc.append(vtk_inverse_cell_types[key])
+            conns.append(nm.asarray(conn, dtype=nm.int32))
+            mat_ids.append(mat_id[iels])
 
-        conns_in, mat_ids = sort_by_mat_id( conns )
+        conns_in, mat_ids = sort_by_mat_id2( conns, mat_ids )
         conns, mat_ids, descs = split_by_mat_id( conns_in, mat_ids, desc )
 
         mesh._set_data( coors, node_grps, conns, mat_ids, descs )
 
         return mesh
 
-    def write(self, filename, mesh, out=None, ts=None, **kwargs):
-        def _reshape_tensors(data, dim, sym, nc):
-            if dim == 3:
-                if nc == sym:
-                    aux = data[:, [0,3,4,3,1,5,4,5,2]]
-                elif nc == (dim * dim):
-                    aux = data[:, [0,3,4,6,1,5,7,8,2]]
-                else:
-                    aux = data.reshape((data.shape[0], dim*dim))
+    def write(self, filename, mesh, out=None, ts=None, binary=False,
+              **kwargs):
+        """
+        Write mesh + optional results in `out` to a legacy VTK file.
+
+        Parameters
+        ----------
+        binary : bool, optional
+            If True, the data sections are written in the big-endian
+            BINARY encoding instead of ASCII, one `tofile()` call per
+            section.
+        """
+        def _write_data(data, format, dtype):
+            """
+            Write a section body - `format` is the ASCII row format,
+            `dtype` the big-endian type of the BINARY encoding.
+            """
+            data = nm.asarray(data)
+            data = data.reshape((data.shape[0], -1))
+            if binary:
+                nm.ascontiguousarray(data, dtype=dtype).tofile(fd)
+                fd.write('\n')
 
             else:
-                zz = nm.zeros((data.shape[0], 1), dtype=nm.float64)
-                if nc == sym:
-                    aux = nm.c_[data[:,[0,2]], zz, data[:,[2,1]],
-                                zz, zz, zz, zz]
-                elif nc == (dim * dim):
-                    aux = nm.c_[data[:,[0,2]], zz, data[:,[3,1]],
-                                zz, zz, zz, zz]
-                else:
-                    aux = nm.c_[data[:,0,[0,1]], zz, data[:,1,[0,1]],
-                                zz, zz, zz, zz]
-
-            return aux
+                write_array(fd, data, format)
 
         def _write_tensors(data):
             format = self.get_vector_format(3)
             format = '\n'.join([format] * 3) + '\n\n'
-            for row in aux:
-                fd.write(format % tuple(row))
+            _write_data(data, format, '>f4')
 
         if ts is None:
             step, time, nt  = 0, 0.0, 0.0
         else:
             step, time, nt = ts.step, ts.time, ts.nt
 
-        fd = open( filename, 'w' )
-        fd.write(vtk_header % (step, time, nt, op.basename(sys.argv[0])))
+        fd = open(filename, 'wb' if binary else 'w')
+        fd.write(vtk_header % (step, time, nt, op.basename(sys.argv[0]),
+                               'BINARY' if binary else 'ASCII'))
 
         n_nod, dim = mesh.coors.shape
         sym = dim * (dim + 1) / 2
@@ -771,31 +1018,41 @@ class VTKMeshIO( MeshIO ):
         if dim == 2:
             aux = nm.hstack((aux, nm.zeros((aux.shape[0], 1), dtype=aux.dtype)))
 
-        format = self.get_vector_format( 3 ) + '\n'
-        for row in aux:
-            fd.write( format % tuple( row ) )
+        _write_data(aux, self.get_vector_format( 3 ) + '\n', '>f4')
 
         n_el, n_els, n_e_ps = mesh.n_el, mesh.n_els, mesh.n_e_ps
         total_size = nm.dot( n_els, n_e_ps + 1 )
         fd.write( '\nCELLS %d %d\n' % (n_el, total_size) )
 
+        # The (count, connectivity) rows of all groups in a single array,
+        # so that the BINARY section is written by a single tofile() call.
+        cells = nm.empty((total_size,), dtype=nm.int32)
         ct = []
+        ii = 0
         for ig, conn in enumerate( mesh.conns ):
             nn = n_e_ps[ig] + 1
             ct += [vtk_cell_types[mesh.descs[ig]]] * n_els[ig]
-            format = ' '.join( ['%d'] * nn + ['\n'] )
 
-            for row in conn:
-                fd.write( format % ((nn-1,) + tuple( row )) )
+            aux = cells[ii:ii + n_els[ig] * nn].reshape((n_els[ig], nn))
+            aux[:, 0] = nn - 1
+            aux[:, 1:] = conn
+            if not binary:
+                format = ' '.join( ['%d'] * nn + ['\n'] )
+                write_array(fd, aux, format)
+
+            ii += n_els[ig] * nn
+
+        if binary:
+            _write_data(cells, '%d\n', '>i4')
 
         fd.write( '\nCELL_TYPES %d\n' % n_el )
-        fd.write( ''.join( ['%d\n' % ii for ii in ct] ) )
+        _write_data(nm.array(ct, dtype=nm.int32), '%d\n', '>i4')
 
         fd.write( '\nPOINT_DATA %d\n' % n_nod )
 
         # node groups
         fd.write( '\nSCALARS node_groups int 1\nLOOKUP_TABLE default\n' )
-        fd.write( ''.join( ['%d\n' % ii for ii in mesh.ngroups] ) )
+        _write_data(mesh.ngroups, '%d\n', '>i4')
 
         if out is not None:
             point_keys = [key for key, val in out.iteritems()
@@ -811,9 +1068,7 @@ class VTKMeshIO( MeshIO ):
                 fd.write( '\nSCALARS %s float %d\n' % (key, nc) )
                 fd.write( 'LOOKUP_TABLE default\n' )
 
-                format = self.float_format + '\n'
-                for row in val.data:
-                    fd.write( format % row )
+                _write_data(val.data, self.float_format + '\n', '>f4')
 
             elif nc == dim:
                 fd.write( '\nVECTORS %s float\n' % key )
@@ -823,13 +1078,11 @@ class VTKMeshIO( MeshIO ):
                 else:
                     aux = val.data
 
-                format = self.get_vector_format( 3 ) + '\n'
-                for row in aux:
-                    fd.write( format % tuple( row ) )
+                _write_data(aux, self.get_vector_format( 3 ) + '\n', '>f4')
 
             elif (nc == sym) or (nc == (dim * dim)):
                 fd.write('\nTENSORS %s float\n' % key)
-                aux = _reshape_tensors(val.data, dim, sym, nc)
+                aux = reshape_vtk_tensors(val.data, dim, sym, nc)
                 _write_tensors(aux)
 
             else:
@@ -845,8 +1098,7 @@ class VTKMeshIO( MeshIO ):
 
         # cells - mat_id
         fd.write( 'SCALARS mat_id int 1\nLOOKUP_TABLE default\n' )
-        aux = nm.hstack(mesh.mat_ids).tolist() 
-        fd.write( ''.join( ['%d\n' % ii for ii in aux] ) )
+        _write_data(nm.hstack(mesh.mat_ids), '%d\n', '>i4')
 
         for key in cell_keys:
             val = out[key]
@@ -855,31 +1107,24 @@ class VTKMeshIO( MeshIO ):
             if (nr == 1) and (nc == 1):
                 fd.write( '\nSCALARS %s float %d\n' % (key, nc) )
                 fd.write( 'LOOKUP_TABLE default\n' )
-                format = self.float_format + '\n'
-                aux = val.data.squeeze()
-                if len(aux.shape) == 0:
-                    fd.write(format % aux)
-                else:
-                    for row in aux:
-                        fd.write(format % row)
+                aux = val.data.reshape((ne, 1))
+                _write_data(aux, self.float_format + '\n', '>f4')
 
             elif (nr == dim) and (nc == 1):
                 fd.write( '\nVECTORS %s float\n' % key )
                 if dim == 2:
-                    aux = nm.hstack( (val.data.squeeze(),
+                    aux = nm.hstack( (val.data.reshape((ne, dim)),
                                       nm.zeros( (ne, 1), dtype = nm.float64 ) ) )
                 else:
                     aux = val.data
 
-                format = self.get_vector_format( 3 ) + '\n'
-                for row in aux:
-                    fd.write( format % tuple( row.squeeze() ) )
+                _write_data(aux, self.get_vector_format( 3 ) + '\n', '>f4')
 
             elif (((nr == sym) or (nr == (dim * dim))) and (nc == 1)) \
                      or ((nr == dim) and (nc == dim)):
                 fd.write('\nTENSORS %s float\n' % key)
                 data = val.data.squeeze()
-                aux = _reshape_tensors(data, dim, sym, nr)
+                aux = reshape_vtk_tensors(data, dim, sym, nr)
                 _write_tensors(aux)
 
             else:
@@ -891,60 +1136,541 @@ class VTKMeshIO( MeshIO ):
         """Point data only!"""
         filename = get_default( filename, self.filename )
 
+        io = self if filename == self.filename else VTKMeshIO(filename)
+        sections = io.read_sections(stop='CELL_DATA')
+
         out = {}
+        for name, data in sections.point_data.iteritems():
+            data = nm.asarray(data, dtype=nm.float64)
+            if data.shape[1] == 1:
+                data = data[:,0]
 
-        fd = open( self.filename, 'r' )
-        while 1:
-            line = skip_read_line(fd, no_eof=True).split()
-            if line[0] == 'POINT_DATA':
-                break
+            out[name] = Struct( name = name,
+                                mode = 'vertex',
+                                data = data,
+                                dofs = None )
 
-        n_nod = int(line[1])
+        return out
 
-        while 1:
-            line = skip_read_line(fd)
-            if not line:
-                break
+vtu_types = {'Int8' : 'i1', 'UInt8' : 'u1', 'Int16' : 'i2', 'UInt16' : 'u2',
+             'Int32' : 'i4', 'UInt32' : 'u4', 'Int64' : 'i8', 'UInt64' : 'u8',
+             'Float32' : 'f4', 'Float64' : 'f8'}
 
-            line = line.split()
+class VTUMeshIO( MeshIO ):
+    """
+    The VTK XML unstructured grid format (.vtu).
+
+    All data arrays are stored in the raw appended data section, optionally
+    compressed by zlib in blocks of `block_size` bytes, as the
+    vtkZLibDataCompressor does.
+    """
+    format = 'vtu'
+    block_size = 65536
+
+    def _read_file(self):
+        """
+        Read the whole file into a writable buffer and parse the XML part.
+        """
+        import xml.etree.ElementTree as et
+
+        fd = open(self.filename, 'rb')
+        buf = bytearray(op.getsize(self.filename))
+        fd.readinto(buf)
+        fd.close()
+
+        ia = buf.find('<AppendedData')
+        if ia >= 0:
+            # The appended data are not parsed, check the start tag only.
+            ie = buf.find('>', ia)
+            tag = et.fromstring(str(buf[ia:ie]).rstrip('/') + '/>')
+            if tag.get('encoding') != 'raw':
+                raise ValueError('only raw appended VTU data are supported!'
+                                 ' (%s: %s)'
+                                 % (self.filename, tag.get('encoding')))
+
+            head = str(buf[:ia]) + '</VTKFile>'
+            ia = buf.find('_', ie) + 1
+
+        else:
+            head = str(buf)
+
+        root = et.fromstring(head)
+
+        bo = '<' if root.get('byte_order', 'LittleEndian') == 'LittleEndian' \
+             else '>'
+        info = Struct(buf=buf, appended=ia, byte_order=bo,
+                      header_type=bo + vtu_types[root.get('header_type',
+                                                          'UInt32')],
+                      compressed=root.get('compressor') is not None,
+                      piece=root.find('UnstructuredGrid/Piece'))
+
+        return info
+
+    def _get_array(self, info, node):
+        """
+        Get the data of a DataArray `node`, without copying, if possible.
+        """
+        dtype = nm.dtype(info.byte_order + vtu_types[node.get('type')])
+        nc = int(node.get('NumberOfComponents', 1))
+
+        if node.get('format') == 'ascii':
+            data = nm.fromstring(node.text, sep=' ', dtype=dtype)
+
+        elif node.get('format') == 'appended':
+            buf, ht = info.buf, nm.dtype(info.header_type)
+            i0 = info.appended + int(node.get('offset'))
+            if info.compressed:
+                import zlib
+
+                n_block = int(nm.frombuffer(buf, ht, 1, i0)[0])
+                sizes = nm.frombuffer(buf, ht, n_block, i0 + 3 * ht.itemsize)
+                i0 += (3 + n_block) * ht.itemsize
+                blocks = []
+                for size in sizes:
+                    blocks.append(zlib.decompress(buffer(buf, i0, size)))
+                    i0 += size
+                data = nm.frombuffer(bytearray(''.join(blocks)), dtype)
+
+            else:
+                n_byte = int(nm.frombuffer(buf, ht, 1, i0)[0])
+                data = nm.frombuffer(buf, dtype, n_byte / dtype.itemsize,
+                                     i0 + ht.itemsize)
+
+        else:
+            raise ValueError('unsupported VTU data array format! (%s)'
+                             % node.get('format'))
+
+        if nc > 1:
+            data = data.reshape((-1, nc))
+
+        return data
+
+    def _get_arrays(self, info, node):
+        """
+        Get all data arrays of a PointData or CellData `node` by names.
+        """
+        arrays = {}
+        if node is not None:
+            for child in node.findall('DataArray'):
+                arrays[child.get('Name')] = self._get_array(info, child)
+
+        return arrays
+
+    def get_dimension(self, coors):
+        dz = nm.diff(coors[:,2])
+        if nm.allclose(dz, 0.0):
+            dim = 2
+        else:
+            dim = 3
+        return dim
+
+    def read_coors(self, info=None):
+        if info is None:
+            info = self._read_file()
+
+        return self._get_array(info, info.piece.find('Points/DataArray'))
+
+    def _read_metadata(self):
+        """
+        Get the metadata from the points and the cell types only.
+        """
+        info = self._read_file()
+        coors = self.read_coors(info)
+        dim = self.get_dimension(coors)
+
+        cell_types = None
+        offsets = {}
+        for node in info.piece.iter('DataArray'):
+            if node.get('Name') == 'types':
+                cell_types = self._get_array(info, node)
+            if node.get('format') == 'appended':
+                offsets[node.get('Name', 'Points')] = info.appended \
+                                                      + int(node.get('offset'))
+
+        descs = []
+        n_els = []
+        counts = nm.bincount(cell_types)
+        for ct in nm.nonzero(counts)[0]:
+            key = (ct, dim)
+            if key in vtk_inverse_cell_types:
+                descs.append(vtk_inverse_cell_types[key])
+                n_els.append(counts[ct])
+
+        return get_metadata_dict(coors, descs, n_els, dim=dim,
+                                 offsets=offsets)
+
+    def read_dimension(self, ret_fd=False):
+        return self.read_metadata().dim
+
+    def read_bounding_box(self, ret_fd=False, ret_dim=False):
+        metadata = self.read_metadata()
+
+        if ret_dim:
+            return metadata.bbox, metadata.dim
+        else:
+            return metadata.bbox
+
+    def read(self, mesh, **kwargs):
+        info = self._read_file()
+        piece = info.piece
+        n_nod = int(piece.get('NumberOfPoints'))
+        n_el = int(piece.get('NumberOfCells'))
+
+        coors = self.read_coors(info)
+        dim = self.get_dimension(coors)
+        if dim == 2:
+            coors = coors[:,:2]
+
+        cells = {}
+        for node in piece.findall('Cells/DataArray'):
+            cells[node.get('Name')] = self._get_array(info, node)
+        point_data = self._get_arrays(info, piece.find('PointData'))
+        cell_data = self._get_arrays(info, piece.find('CellData'))
+
+        ngroups = point_data.get('node_groups')
+        mat_id = cell_data.get('mat_id', nm.zeros((n_el,), dtype=nm.int32))
+
+        cell_types = cells['types']
+        offsets = nm.asarray(cells['offsets'], dtype=nm.int64)
+        n_e_ps = nm.diff(nm.r_[0, offsets])
+
+        conns = []
+        mat_ids = []
+        descs = []
+        for ct in nm.unique(cell_types):
+            key = (ct, dim)
+            if key not in vtk_inverse_cell_types:
+                continue
+
+            iels = nm.where(cell_types == ct)[0]
+            n_ep = n_e_ps[iels[0]]
+            assert_((n_e_ps[iels] == n_ep).all())
+
+            ii = offsets[iels][:, None] - n_ep + nm.arange(n_ep)
+            conn = nm.asarray(cells['connectivity'][ii], dtype=nm.int32)
+            if ct in vtk_remap_keys: # Remap pixels and voxels.
+                conn = conn[:, vtk_remap[ct]]
+
+            conns.append(conn)
+            mat_ids.append(mat_id[iels])
+            descs.append(vtk_inverse_cell_types[key])
+
+        conns, mat_ids = sort_by_mat_id2(conns, mat_ids)
+        conns, mat_ids, descs = split_by_mat_id(conns, mat_ids, descs)
+        mesh._set_data(coors, ngroups, conns, mat_ids, descs)
+
+        return mesh
+
+    def write(self, filename, mesh, out=None, ts=None, compression=None,
+              complevel=6, **kwargs):
+        """
+        Write mesh + optional results in `out` to a VTU file.
+
+        Parameters
+        ----------
+        compression : None or 'zlib', optional
+            If 'zlib', the data arrays are compressed by zlib.
+        complevel : int, optional
+            The zlib compression level.
+        """
+        import zlib
+
+        def _get_out_data(mode, n_row):
+            aux = []
+            if out is None:
+                return aux
+
+            for key, val in ordered_iteritems(out):
+                if val.mode != mode: continue
+
+                data = val.data.reshape((n_row, -1))
+                nc = data.shape[1]
+                if nc == dim:
+                    if dim == 2:
+                        data = nm.c_[data, nm.zeros((n_row, 1))]
+
+                elif (nc == sym) or (nc == (dim * dim)):
+                    data = reshape_vtk_tensors(data, dim, sym, nc)
+
+                elif nc != 1:
+                    raise NotImplementedError(nc)
+
+                aux.append((key, data))
+
+            return aux
+
+        def _add_array(name, data, vtype):
+            data = nm.ascontiguousarray(data, dtype='<' + vtu_types[vtype])
+            nc = data.shape[1] if data.ndim == 2 else 1
+
+            attrs = ['type="%s"' % vtype]
+            if name is not None:
+                attrs.append('Name="%s"' % name)
+            if nc > 1:
+                attrs.append('NumberOfComponents="%d"' % nc)
+            attrs.append('format="appended" offset="%d"' % offsets[0])
+
+            n_byte = data.nbytes
+            if compression == 'zlib':
+                bs = self.block_size
+                blocks = [zlib.compress(buffer(data, ii, bs), complevel)
+                          for ii in xrange(0, n_byte, bs)]
+                last = n_byte - bs * (len(blocks) - 1) if blocks else 0
+                header = [len(blocks), bs, last] + [len(ii) for ii in blocks]
+                chunks.append(nm.array(header, dtype='<u8'))
+                chunks.extend(blocks)
+                offsets[0] += 8 * len(header) + sum(len(ii) for ii in blocks)
+
+            else:
+                chunks.append(nm.array([n_byte], dtype='<u8'))
+                chunks.append(data)
+                offsets[0] += 8 + n_byte
+
+            return '<DataArray %s/>\n' % ' '.join(attrs)
+
+        if compression not in (None, 'zlib'):
+            raise ValueError('unsupported VTU compression! (%s)' % compression)
+
+        n_nod, dim = mesh.coors.shape
+        sym = dim * (dim + 1) / 2
+        n_el = mesh.n_el
+
+        chunks = []
+        offsets = [0]
+
+        point_data = _add_array('node_groups', mesh.ngroups, 'Int32')
+        for key, data in _get_out_data('vertex', n_nod):
+            point_data += _add_array(key, data, 'Float64')
+
+        cell_data = _add_array('mat_id', nm.hstack(mesh.mat_ids), 'Int32')
+        for key, data in _get_out_data('cell', n_el):
+            cell_data += _add_array(key, data, 'Float64')
+
+        coors = mesh.coors
+        if dim == 2:
+            coors = nm.c_[coors, nm.zeros((n_nod, 1))]
+        points = _add_array(None, coors, 'Float64')
+
+        conn = nm.concatenate([conn.ravel() for conn in mesh.conns])
+        cell_offsets = nm.cumsum(nm.repeat(mesh.n_e_ps, mesh.n_els))
+        cell_types = nm.repeat([vtk_cell_types[desc] for desc in mesh.descs],
+                               mesh.n_els)
+        cells = _add_array('connectivity', conn, 'Int32') \
+                + _add_array('offsets', cell_offsets, 'Int64') \
+                + _add_array('types', cell_types, 'UInt8')
+
+        if ts is None:
+            step, time, nt  = 0, 0.0, 0.0
+        else:
+            step, time, nt = ts.step, ts.time, ts.nt
+
+        fd = open(filename, 'wb')
+        fd.write('<?xml version="1.0"?>\n')
+        fd.write('<!-- step %d time %e normalized time %e, generated by %s -->\n'
+                 % (step, time, nt, op.basename(sys.argv[0])))
+        fd.write('<VTKFile type="UnstructuredGrid" version="1.0"'
+                 ' byte_order="LittleEndian" header_type="UInt64"%s>\n'
+                 % (' compressor="vtkZLibDataCompressor"'
+                    if compression == 'zlib' else ''))
+        fd.write('<UnstructuredGrid>\n')
+        fd.write('<Piece NumberOfPoints="%d" NumberOfCells="%d">\n'
+                 % (n_nod, n_el))
+        fd.write('<PointData>\n%s</PointData>\n' % point_data)
+        fd.write('<CellData>\n%s</CellData>\n' % cell_data)
+        fd.write('<Points>\n%s</Points>\n' % points)
+        fd.write('<Cells>\n%s</Cells>\n' % cells)
+        fd.write('</Piece>\n</UnstructuredGrid>\n')
+        fd.write('<AppendedData encoding="raw">\n_')
+        for chunk in chunks:
+            if isinstance(chunk, nm.ndarray):
+                chunk.tofile(fd)
+            else:
+                fd.write(chunk)
+        fd.write('\n</AppendedData>\n</VTKFile>\n')
+        fd.close()
+
+    def read_data(self, step, filename=None):
+        """
+        Read the point and cell data, except node groups and material ids.
+        """
+        io = self if filename is None else VTUMeshIO(filename)
+        info = io._read_file()
+        piece = info.piece
+        n_el = int(piece.get('NumberOfCells'))
+        dim = io.get_dimension(io.read_coors(info))
+
+        out = {}
+        for mode, key, skip in [('vertex', 'PointData', 'node_groups'),
+                                ('cell', 'CellData', 'mat_id')]:
+            arrays = io._get_arrays(info, piece.find(key))
+            for name, data in arrays.iteritems():
+                if name == skip: continue
+
+                data = data.reshape((data.shape[0], -1))
+                if (dim == 2) and (data.shape[1] == 3):
+                    data = data[:,:2]
+
+                if mode == 'cell':
+                    data = data.reshape((n_el, 1, data.shape[1], 1))
+
+                out[name] = Struct(name=name, mode=mode, data=data, dofs=None)
+
+        return out
+
+stl_dtype = nm.dtype([('normal', '<f4', (3,)),
+                      ('vertices', '<f4', (3, 3)),
+                      ('attr', '<u2')])
+
+def weld_vertices(vertices):
+    """
+    Merge the identical vertices of triangles.
+
+    Parameters
+    ----------
+    vertices : array
+        The triangle vertices, shape (n_tri, 3, dim).
+
+    Returns
+    -------
+    coors : array
+        The unique vertices in the order of their first occurrence.
+    conn : array
+        The triangle connectivity, shape (n_tri, 3).
+    """
+    n_tri, n_ep, dim = vertices.shape
+    # Adding zero turns -0.0 to 0.0, so that the bytes can be compared.
+    coors = nm.ascontiguousarray(vertices.reshape((n_tri * n_ep, dim)) + 0.0)
+    aux = coors.view(nm.dtype((nm.void, coors.dtype.itemsize * dim))).ravel()
+    _, ii, inverse = nm.unique(aux, return_index=True, return_inverse=True)
+
+    # Keep the first occurrence order.
+    order = nm.argsort(ii)
+    remap = nm.empty_like(order)
+    remap[order] = nm.arange(len(order))
+
+    conn = remap[inverse].reshape((n_tri, n_ep)).astype(nm.int32)
+    return coors[ii[order]], conn
+
+class STLMeshIO( MeshIO ):
+    """
+    The STL triangulated surface format.
+
+    Binary files are written, binary and ASCII files are read. The
+    identical vertices are merged on reading. The material ids are stored
+    in the attribute field of the binary triangles. The boundary faces of
+    volume elements are written, quadrilaterals are split into triangles.
+    """
+    format = 'stl'
+
+    def _read_triangles(self):
+        """
+        Return the triangle vertices and attributes.
+        """
+        size = op.getsize(self.filename)
+        fd = open(self.filename, 'rb')
+        header = fd.read(84)
+        if len(header) == 84:
+            n_tri = nm.fromstring(header[80:], dtype='<u4')[0]
+
+        else:
+            n_tri = -1
+
+        if size == (84 + n_tri * stl_dtype.itemsize):
+            data = nm.fromfile(fd, dtype=stl_dtype, count=n_tri)
+            fd.close()
+
+            return data['vertices'].astype(nm.float64), data['attr']
+
+        fd.seek(0)
+        text = fd.read()
+        fd.close()
+
+        if not text.lstrip().startswith('solid'):
+            raise ValueError('not a STL file! (%s)' % self.filename)
+
+        vals = re.findall(r'vertex\s+(\S+)\s+(\S+)\s+(\S+)', text)
+        vertices = nm.array(vals, dtype=nm.float64).reshape((-1, 3, 3))
+
+        return vertices, nm.zeros(vertices.shape[0], dtype=nm.uint16)
+
+    def read_dimension(self, ret_fd=False):
+        return 3
+
+    def read_bounding_box(self, ret_fd=False, ret_dim=False):
+        metadata = self.read_metadata()
+        if ret_dim:
+            return metadata.bbox, metadata.dim
+
+        else:
+            return metadata.bbox
+
+    def read(self, mesh, **kwargs):
+        vertices, attr = self._read_triangles()
+        coors, conn = weld_vertices(vertices)
+
+        if attr.any():
+            mat_ids = attr.astype(nm.int32)
+
+        else:
+            mat_ids = nm.ones(conn.shape[0], dtype=nm.int32)
+
+        mesh._set_data(coors, None, [conn], [mat_ids], ['2_3'])
+
+        return mesh
 
-            if line[0] == 'SCALARS':
-                name, dtype, nc = line[1:]
-                assert_(int(nc) == 1)
-                fd.readline() # skip lookup table line
-                
-                data = nm.zeros((n_nod,), dtype=nm.float64)
-                ii = 0
-                while ii < n_nod:
-                    data[ii] = float(fd.readline())
-                    ii += 1
-
-                out[name] = Struct( name = name,
-                                    mode = 'vertex',
-                                    data = data,
-                                    dofs = None )
-
-            elif line[0] == 'VECTORS':
-                name, dtype = line[1:]
-                data = []
-                ii = 0
-                while ii < n_nod:
-                    data.append([float(val) for val in fd.readline().split()])
-                    ii += 1
-
-                out[name] = Struct( name = name,
-                                    mode = 'vertex',
-                                    data = nm.array(data, dtype=nm.float64),
-                                    dofs = None )
-
-            elif line[0] == 'CELL_DATA':
-                break
+    def write(self, filename, mesh, out=None, **kwargs):
+        from genfem_base import surface_face_tab, get_surface_faces
 
-            line = fd.readline()
+        tris = []
+        mat_ids = []
+        for ig, conn in enumerate(mesh.conns):
+            desc = mesh.descs[ig]
+            mat_id = mesh.mat_ids[ig]
+            if desc[0] == '3':
+                if desc not in surface_face_tab:
+                    raise ValueError('unsupported element type for STL! (%s)'
+                                     % desc)
+                conn, iels = get_surface_faces(conn, desc)
+                mat_id = mat_id[iels]
+
+            if conn.shape[1] == 4:
+                tris.extend([conn[:, [0, 1, 2]], conn[:, [0, 2, 3]]])
+                mat_ids.extend([mat_id, mat_id])
+
+            elif conn.shape[1] == 3:
+                tris.append(conn)
+                mat_ids.append(mat_id)
 
+            else:
+                raise ValueError('unsupported element type for STL! (%s)'
+                                 % desc)
+
+        tris = nm.concatenate(tris)
+        n_tri = tris.shape[0]
+
+        coors = nm.zeros((mesh.n_nod, 3), dtype=nm.float64)
+        coors[:, :mesh.dim] = mesh.coors
+        vertices = coors[tris]
+
+        normals = nm.cross(vertices[:, 1] - vertices[:, 0],
+                           vertices[:, 2] - vertices[:, 0])
+        norms = nm.sqrt((normals**2).sum(axis=1))[:, None]
+        nm.divide(normals, norms, out=normals, where=norms > 0.0)
+
+        data = nm.empty(n_tri, dtype=stl_dtype)
+        data['normal'] = normals
+        data['vertices'] = vertices
+        data['attr'] = nm.clip(nm.concatenate(mat_ids), 0, 65535)
+
+        fd = open(filename, 'wb')
+        # The header must not start with 'solid'.
+        fd.write(('binary STL: %s' % mesh.name)[:80].ljust(80))
+        nm.array([n_tri], dtype='<u4').tofile(fd)
+        data.tofile(fd)
         fd.close()
 
-        return out
+        if out is not None:
+            output('STL format does not support output data!')
 
 ##
 # c: 15.02.2008
@@ -956,83 +1682,101 @@ class TetgenMeshIO( MeshIO ):
     def read( self, mesh, **kwargs ):
         import os
         fname = os.path.splitext(self.filename)[0]
-        nodes=self.getnodes(fname+".node", MyBar("       nodes:"))
-        etype, elements, regions = self.getele(fname+".ele",
-                                               MyBar("       elements:"))
+        nodes = self.getnodes(fname+".node")
+        etype, elements, regions = self.getele(fname+".ele")
+
+        # Conns sorted by region, element order kept within each region.
+        region_ids, inverse = nm.unique(regions, return_inverse=True)
+        perm = nm.argsort(inverse, kind='mergesort')
+        counts = nm.bincount(inverse, minlength=len(region_ids))
+        ends = nm.cumsum(counts)
+
         descs = []
         conns = []
         mat_ids = []
-        elements = nm.array( elements, dtype = nm.int32 )-1
-        for key, value in regions.iteritems():
+        for ii, region_id in enumerate(region_ids):
+            iels = perm[ends[ii] - counts[ii]:ends[ii]]
             descs.append( etype )
-            mat_ids.append( nm.ones_like(value) * key )
-            conns.append( elements[nm.array(value)-1].copy() )
+            mat_ids.append( nm.empty(len(iels), dtype=nm.int32) )
+            mat_ids[-1].fill(region_id)
+            conns.append( elements[iels] )
 
         mesh._set_data( nodes, None, conns, mat_ids, descs )
         return mesh
 
+    @staticmethod
+    def _read_table(filename, n_header):
+        """
+        Read the whole TetGen file `filename` as a flat array of numbers,
+        with the '#' comments removed. Return the `n_header` integers of
+        the header line and the remaining values.
+        """
+        fd = open(filename, 'r')
+        text = re.sub('#[^\n]*', '', fd.read())
+        fd.close()
+
+        values = nm.fromstring(text, dtype=nm.float64, sep=' ')
+        header = values[:n_header].astype(nm.int32)
+        if len(header) < n_header:
+            raise ValueError('bad TetGen file header! (%s)' % filename)
+
+        return header, values[n_header:]
+
     ##
     # c: 15.02.2008, r: 15.02.2008
     @staticmethod
-    def getnodes(fnods, up=None, verbose=False):
+    def getnodes(fnods):
         """
-        Reads t.1.nodes, returns a list of nodes.
+        Reads t.1.nodes, returns an array of node coordinates.
 
         Example:
 
-        >>> self.getnodes("t.1.node", MyBar("nodes:"))
-        [(0.0, 0.0, 0.0), (4.0, 0.0, 0.0), (0.0, 4.0, 0.0), (-4.0, 0.0, 0.0),
-        (0.0, 0.0, 4.0), (0.0, -4.0, 0.0), (0.0, -0.0, -4.0), (-2.0, 0.0,
-        -2.0), (-2.0, 2.0, 0.0), (0.0, 2.0, -2.0), (0.0, -2.0, -2.0), (2.0,
-        0.0, -2.0), (2.0, 2.0, 0.0), ... ]
+        >>> TetgenMeshIO.getnodes("t.1.node")
+        array([[ 0.,  0.,  0.],
+               [ 4.,  0.,  0.],
+               [ 0.,  4.,  0.],
+               ...])
 
         """
-        f=open(fnods)
-        l=[int(x) for x in f.readline().split()]
-        npoints,dim,nattrib,nbound=l
-        if dim == 2:
-            ndapp = [0.0]
-        else:
-            ndapp = []
-        if verbose and up is not None: up.init(npoints)
-        nodes=[]
-        for line in f:
-            if line[0]=="#": continue
-            l=[float(x) for x in line.split()]
-            l = l[:(dim + 1)]
-            assert_( int(l[0])==len(nodes)+1 )
-            l = l[1:]
-            nodes.append(tuple(l + ndapp))
-            if verbose and up is not None: up.update(len(nodes))
-        assert_( npoints==len(nodes) )
+        header, values = TetgenMeshIO._read_table(fnods, 4)
+        npoints, dim, nattrib, nbound = header
+
+        n_col = 1 + dim + nattrib + nbound
+        if values.shape[0] != npoints * n_col:
+            raise ValueError('wrong number of nodes! (%s)' % fnods)
+        values = values.reshape((npoints, n_col))
+
+        # Nodes may be numbered from zero (-z) or from one.
+        ids = values[:, 0].astype(nm.int32)
+        if (ids != nm.arange(ids[0], ids[0] + npoints)).any():
+            raise ValueError('nodes not numbered consecutively! (%s)' % fnods)
+
+        nodes = nm.zeros((npoints, max(dim, 3)), dtype=nm.float64)
+        nodes[:, :dim] = values[:, 1:dim + 1]
         return nodes
 
     ##
     # c: 15.02.2008, r: 15.02.2008
     @staticmethod
-    def getele(fele, up=None, verbose=False):
+    def getele(fele):
         """
-        Reads t.1.ele, returns a list of elements.
+        Reads t.1.ele, returns the element type, the array of element
+        connectivities (zero-based) and the array of element regions.
 
         Example:
 
-        >>> elements, regions = self.getele("t.1.ele", MyBar("elements:"))
+        >>> etype, elements, regions = TetgenMeshIO.getele("t.1.ele")
         >>> elements
-        [(20, 154, 122, 258), (86, 186, 134, 238), (15, 309, 170, 310), (146,
-        229, 145, 285), (206, 207, 125, 211), (99, 193, 39, 194), (185, 197,
-        158, 225), (53, 76, 74, 6), (19, 138, 129, 313), (23, 60, 47, 96),
-        (119, 321, 1, 329), (188, 296, 122, 322), (30, 255, 177, 256), ...]
+        array([[ 19, 153, 121, 257],
+               [ 85, 185, 133, 237],
+               ...])
         >>> regions
-        {100: [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18,
-        19, 20, 21, 22, 23, 24, 25, 26, 27, 28, 29, 30, 31, 32, 33, 34, 35, 36,
-        37, 38, 39, 40, 41, 42, 43, 44, 45, 46, 47, 48, 49, 50, 51, 52, 53, 54,
-        55, 56, 57, 58, 59, 60, 61, 62, 63, 64, 65, 66, 67, 68, 69, 7, ...],
-        ...}
+        array([100, 100, 100, ...])
 
         """
-        f=file(fele)
-        l=[int(x) for x in f.readline().split()]
-        ntetra,nnod,nattrib=l
+        header, values = TetgenMeshIO._read_table(fele, 3)
+        ntetra, nnod, nattrib = header
+
         #we have either linear or quadratic tetrahedra:
         elem = None
         if nnod in [4,10]:
@@ -1042,35 +1786,33 @@ class TetgenMeshIO( MeshIO ):
             elem = '2_3'
             linear = (nnod == 3)
         if elem is None or not linear:
-            raise Exception("Only linear triangle and tetrahedra reader is implemented")
-        if verbose and up is not None: up.init(ntetra)
-        # if nattrib!=1:
-        #     raise "tetgen didn't assign an entity number to each element (option -A)"
-        els=[]
-        regions={}
-        for line in f:
-            if line[0]=="#": continue
-            l=[int(x) for x in line.split()]
-            if elem == '2_3':
-                assert_((len(l) - 1 - nattrib) == 3 )
-                els.append((l[1],l[2],l[3]))
-            if elem == '3_4':
-                assert_((len(l) - 1 - nattrib) == 4 )
-                els.append((l[1],l[2],l[3],l[4]))
-            if nattrib == 1:
-                regionnum = l[-1]
-            else:
-                regionnum = 1
+            raise ValueError('only linear triangle and tetrahedra reader'
+                             ' is implemented')
+
+        n_col = 1 + nnod + nattrib
+        if values.shape[0] != ntetra * n_col:
+            raise ValueError('wrong number of elements! (%s)' % fele)
+        values = values.reshape((ntetra, n_col)).astype(nm.int32)
+
+        ids = values[:, 0]
+        if (ids != nm.arange(ids[0], ids[0] + ntetra)).any():
+            raise ValueError('elements not numbered consecutively! (%s)'
+                             % fele)
+
+        # The node numbering base is the one of the .node file, i.e. the
+        # element numbering base.
+        els = values[:, 1:nnod + 1] - ids[0]
+
+        if nattrib == 1:
+            regions = values[:, -1]
+            ii = nm.where(regions == 0)[0]
+            if len(ii):
+                raise ValueError('there are elements not belonging to any'
+                                 ' physical entity! (%s, element # %d)'
+                                 % (fele, ids[ii[0]]))
+        else:
+            regions = nm.ones(ntetra, dtype=nm.int32)
 
-            if regionnum==0:
-                print "see %s, element # %d"%(fele,l[0])
-                raise "there are elements not belonging to any physical entity"
-            if regions.has_key(regionnum):
-                regions[regionnum].append(l[0])
-            else:
-                regions[regionnum]=[l[0]]
-            assert_( l[0]==len(els) )
-            if verbose and up is not None: up.update(l[0])
         return elem, els, regions
 
     ##
@@ -1098,14 +1840,14 @@ class ComsolMeshIO( MeshIO ):
         return int( skip_read_line( self.fd ).split( '#' )[0] )
 
     def _skip_comment(self):
-        read_token(self.fd)
+        self.fd.read_token()
         self.fd.readline()
 
     ##
     # c: 20.03.2008, r: 20.03.2008
     def read( self, mesh, **kwargs ):
 
-        self.fd = fd = open( self.filename, 'r' )
+        self.fd = fd = Tokenizer(self.filename)
         mode = 'header'
 
         coors = conns = desc = None
@@ -1131,7 +1873,7 @@ class ComsolMeshIO( MeshIO ):
 
             elif mode == 'points':
                 self._skip_comment()
-                coors = read_array( fd, n_nod, dim, nm.float64 )
+                coors = fd.read_array(n_nod, dim, nm.float64)
                 mode = 'cells'
 
             elif mode == 'cells':
@@ -1146,7 +1888,7 @@ class ComsolMeshIO( MeshIO ):
                     n_el = self._read_commented_int()
 
                     self._skip_comment()
-                    aux = read_array(fd, n_el, n_ep, nm.int32)
+                    aux = fd.read_array(n_el, n_ep, nm.int32)
                     if t_name == 'tri':
                         conns.append(aux)
                         descs.append('2_3')
@@ -1180,7 +1922,7 @@ class ComsolMeshIO( MeshIO ):
                     assert_( n_domain == n_el )
                     if is_conn:
                         self._skip_comment()
-                        mat_id = read_array( fd, n_domain, 1, nm.int32 )
+                        mat_id = fd.read_array(n_domain, 1, nm.int32)
                         mat_ids.append( mat_id )
                     else:
                         for ii in xrange( n_domain ):
@@ -1215,9 +1957,7 @@ class ComsolMeshIO( MeshIO ):
             fd.write( "%d # number of nodes per element\n" % npe)
             fd.write( "%d # number of elements\n" % conn.shape[0] )
             fd.write( "# Elements\n" )
-            for ii in range( conn.shape[0] ):
-                nn = conn[ii] # Zero based
-                fd.write( format % tuple( nn[norder] ) )
+            write_array( fd, conn[:, norder], format ) # Zero based
             fd.write( "\n%d # number of parameter values per element\n" 
                       % nm_params)
             # Top level always 0?
@@ -1230,8 +1970,7 @@ class ComsolMeshIO( MeshIO ):
                 # Domains in comsol have to be > 0
                 if (mi <= 0).any():
                     mi += mi.min() + 1
-                for dom in mi:
-                    fd.write("%d\n" % abs(dom))
+                write_array( fd, nm.abs(mi), "%d\n" )
             fd.write( "\n0 # number of up/down pairs\n" )
             fd.write( "# Up/down\n" )
 
@@ -1267,9 +2006,7 @@ class ComsolMeshIO( MeshIO ):
         fd.write( "# Mesh point coordinates\n" )
 
         format = self.get_vector_format( dim ) + '\n'
-        for ii in range( n_nod ):
-            nn = tuple( coors[ii] )
-            fd.write( format % tuple( nn ) )
+        write_array( fd, coors, format )
 
         fd.write( "\n%d # number of element types\n\n\n" % len(conns) )
 
@@ -1340,13 +2077,100 @@ class HDF5MeshIO( MeshIO ):
 
         return mesh
 
-    def write( self, filename, mesh, out = None, ts = None, **kwargs ):
+    def read_lazy(self, mesh, **kwargs):
+        """
+        Read the mesh name and element types only, and keep the file open.
+        The coordinates, node groups, connectivities and material ids are
+        read on the first access, until mesh.close() is called.
+        """
+        fd = pt.openFile(self.filename, mode='r')
+
+        mesh_group = fd.root.mesh
+
+        mesh.name = mesh_group.name.read()
+        n_gr = mesh_group.n_gr.read()
+
+        groups = [mesh_group._f_getChild('group%d' % ig)
+                  for ig in xrange(n_gr)]
+
+        conns = LazyList([group.conn for group in groups], dtype=nm.int32)
+        mat_ids = LazyList([group.mat_id for group in groups],
+                           dtype=nm.int32)
+        descs = [group.desc.read() for group in groups]
+
+        mesh._set_lazy_data(fd, {'coors' : mesh_group.coors,
+                                 'ngroups' : mesh_group.ngroups},
+                            conns, mat_ids, descs)
+
+        return mesh
+
+    def _create_array(self, fd, group, name, data, title, filters=None):
+        """
+        Create an array node. Non-empty arrays are stored as chunked CArray,
+        if `filters` are given.
+        """
+        if ((filters is None) or (not isinstance(data, nm.ndarray))
+            or (data.ndim == 0) or (data.size == 0)):
+            return fd.createArray(group, name, data, title)
+
+        node = fd.createCArray(group, name, pt.Atom.from_dtype(data.dtype),
+                               data.shape, title, filters=filters)
+        node[:] = data
+
+        return node
+
+    def _write_data_info(self, fd, data_group, key, val):
+        """
+        Write the description of data `val` with the name `key`.
+        """
+        dofs = get_default(val.dofs, (-1,))
+        shape = val.get('shape', val.data.shape)
+        var_name = val.get('var_name', 'None')
+
+        fd.createArray( data_group, 'mode', val.mode, 'mode' )
+        fd.createArray( data_group, 'dofs', dofs, 'dofs' )
+        fd.createArray( data_group, 'shape', shape, 'shape' )
+        fd.createArray( data_group, 'name', val.name, 'object name' )
+        fd.createArray( data_group, 'var_name',
+                        var_name, 'object parent name' )
+        fd.createArray( data_group, 'dname', key, 'data name' )
+        if val.mode == 'full':
+            fd.createArray(data_group, 'field_name', val.field_name,
+                           'field name')
+
+    def write(self, filename, mesh, out=None, ts=None, compression=None,
+              complevel=5, shuffle=True, **kwargs):
+        """
+        Write mesh + optional results in `out` to a HDF5 file.
+
+        Each call with `out` reopens the file and stores the results in a
+        new group of the time step `ts.step`. Use HDF5SeriesWriter to store
+        many time steps.
+
+        Parameters
+        ----------
+        compression : None or str, optional
+            The compression library supported by PyTables ('zlib', 'blosc',
+            'lzo', 'bzip2'). If given, the mesh and data arrays are stored
+            as chunked, compressed CArrays.
+        complevel : int, optional
+            The compression level.
+        shuffle : bool, optional
+            If True, the shuffle filter is applied before the compression.
+        """
         from time import asctime
 
         if pt is None:
             output( 'pytables not imported!' )
             raise ValueError
 
+        if compression is None:
+            filters = None
+
+        else:
+            filters = pt.Filters(complevel=complevel, complib=compression,
+                                 shuffle=shuffle)
+
         step = get_default_attr(ts, 'step', 0)
         if step == 0:
             # A new file.
@@ -1356,14 +2180,18 @@ class HDF5MeshIO( MeshIO ):
             mesh_group = fd.createGroup( '/', 'mesh', 'mesh' )
 
             fd.createArray( mesh_group, 'name', mesh.name, 'name' )
-            fd.createArray( mesh_group, 'coors', mesh.coors, 'coors' )
-            fd.createArray( mesh_group, 'ngroups', mesh.ngroups, 'ngroups' )
+            self._create_array(fd, mesh_group, 'coors', mesh.coors, 'coors',
+                               filters)
+            self._create_array(fd, mesh_group, 'ngroups', mesh.ngroups,
+                               'ngroups', filters)
             fd.createArray( mesh_group, 'n_gr', len( mesh.conns ), 'n_gr' )
             for ig, conn in enumerate( mesh.conns ):
                 conn_group = fd.createGroup( mesh_group, 'group%d' % ig,
                                             'connectivity group' )
-                fd.createArray( conn_group, 'conn', conn, 'connectivity' )
-                fd.createArray( conn_group, 'mat_id', mesh.mat_ids[ig], 'material id' )
+                self._create_array(fd, conn_group, 'conn', conn,
+                                   'connectivity', filters)
+                self._create_array(fd, conn_group, 'mat_id', mesh.mat_ids[ig],
+                                   'material id', filters)
                 fd.createArray( conn_group, 'desc', mesh.descs[ig], 'element Type' )
 
             if ts is not None:
@@ -1403,24 +2231,12 @@ class HDF5MeshIO( MeshIO ):
             name_dict = {}
             for key, val in out.iteritems():
     #            print key
-                dofs = get_default(val.dofs, (-1,))
-                shape = val.get('shape', val.data.shape)
-                var_name = val.get('var_name', 'None')
-
                 group_name = '__' + key.translate( self._tr )
                 data_group = fd.createGroup(step_group, group_name,
                                             '%s data' % key)
-                fd.createArray( data_group, 'data', val.data, 'data' )
-                fd.createArray( data_group, 'mode', val.mode, 'mode' )
-                fd.createArray( data_group, 'dofs', dofs, 'dofs' )
-                fd.createArray( data_group, 'shape', shape, 'shape' )
-                fd.createArray( data_group, 'name', val.name, 'object name' )
-                fd.createArray( data_group, 'var_name',
-                                var_name, 'object parent name' )
-                fd.createArray( data_group, 'dname', key, 'data name' )
-                if val.mode == 'full':
-                    fd.createArray(data_group, 'field_name', val.field_name,
-                                   'field name')
+                self._create_array(fd, data_group, 'data', val.data, 'data',
+                                   filters)
+                self._write_data_info(fd, data_group, key, val)
 
                 name_dict[key] = group_name
 
@@ -1472,6 +2288,13 @@ class HDF5MeshIO( MeshIO ):
         filename = get_default(filename, self.filename)
         fd = pt.openFile(filename, mode='r')
 
+        if 'series' in fd.root:
+            series = fd.root.series
+            out = (series.steps.read(), series.times.read(),
+                   series.nts.read())
+            fd.close()
+            return out
+
         steps = sorted(int(name[4:]) for name in fd.root._v_groups.keys()
                        if name.startswith('step'))
         times = []
@@ -1490,25 +2313,37 @@ class HDF5MeshIO( MeshIO ):
         return steps, times, nts
 
     def _get_step_group( self, step, filename = None ):
+        """
+        Get the group with the data of the given time step. For the series
+        layout (see HDF5SeriesWriter), the group is common to all steps and
+        the row index of the step is returned as well, otherwise the index
+        is None.
+        """
         filename = get_default( filename, self.filename )
         fd = pt.openFile( filename, mode = "r" )
 
+        if 'series' in fd.root:
+            step_group = fd.root.series
+            ii = nm.where(step_group.steps.read() == step)[0]
+            if len(ii):
+                return fd, step_group, ii[0]
+
         gr_name = 'step%d' % step
         try:
             step_group = fd.getNode( fd.root, gr_name )
         except:
             output( 'step %d data not found - premature end of file?' % step )
             fd.close()
-            return None, None
+            return None, None, None
 
-        return fd, step_group
+        return fd, step_group, None
 
     def read_data( self, step, filename = None ):
-        fd, step_group = self._get_step_group( step, filename = filename )
+        fd, step_group, index = self._get_step_group(step, filename=filename)
         if fd is None: return None
 
         out = {}
-        for data_group in step_group:
+        for data_group in step_group._v_groups.itervalues():
             try:
                 key = data_group.dname.read()
 
@@ -1517,7 +2352,10 @@ class HDF5MeshIO( MeshIO ):
 
             name = data_group.name.read()
             mode = data_group.mode.read()
-            data = data_group.data.read()
+            if index is None:
+                data = data_group.data.read()
+            else:
+                data = data_group.data[index]
             dofs = tuple(data_group.dofs.read())
             try:
                 shape = tuple(data_group.shape.read())
@@ -1542,7 +2380,7 @@ class HDF5MeshIO( MeshIO ):
         return out
 
     def read_data_header( self, dname, step = 0, filename = None ):
-        fd, step_group = self._get_step_group( step, filename = filename )
+        fd, step_group, index = self._get_step_group(step, filename=filename)
         if fd is None: return None
 
         groups = step_group._v_groups
@@ -1566,14 +2404,20 @@ class HDF5MeshIO( MeshIO ):
         fd = pt.openFile( filename, mode = "r" )
 
         th = dict_from_keys_init( indx, list )
-        for step in xrange( fd.root.last_step[0] + 1 ):
-            gr_name = 'step%d' % step
+        if 'series' in fd.root:
+            data = fd.root.series._f_getChild( node_name ).data
+            for ii in indx:
+                th[ii] = data[:, ii]
 
-            step_group = fd.getNode( fd.root, gr_name )
-            data = step_group._f_getChild( node_name ).data
+        else:
+            for step in xrange( fd.root.last_step[0] + 1 ):
+                gr_name = 'step%d' % step
 
-            for ii in indx:
-                th[ii].append( nm.array( data[ii] ) )
+                step_group = fd.getNode( fd.root, gr_name )
+                data = step_group._f_getChild( node_name ).data
+
+                for ii in indx:
+                    th[ii].append( nm.array( data[ii] ) )
 
         fd.close()
 
@@ -1593,6 +2437,16 @@ class HDF5MeshIO( MeshIO ):
 
         ths = dict_from_keys_init( var_names, list )
 
+        if 'series' in fd.root:
+            series = fd.root.series
+            name_dict = series._v_attrs.name_dict
+            for var_name in var_names:
+                data = series._f_getChild( name_dict[var_name] ).data
+                ths[var_name] = list( data.read() )
+
+            fd.close()
+            return ths
+
         arr = nm.asarray
         for step in xrange( ts.n_step ):
             gr_name = 'step%d' % step
@@ -1606,6 +2460,131 @@ class HDF5MeshIO( MeshIO ):
 
         return ths
 
+class HDF5SeriesWriter(Struct):
+    """
+    A writer session storing the results of many time steps into a HDF5
+    mesh file, that is kept open between the steps.
+
+    The results are appended to extendable arrays of shape `(n_step, ...)`
+    in the `/series` group, so that a time history is a single slice of an
+    array, see HDF5MeshIO.read_time_history(). All steps have to contain
+    the same data.
+
+    Examples
+    --------
+
+    >>> with HDF5SeriesWriter('output.h5', mesh, ts=ts) as writer:
+    ...     for step, time in ts:
+    ...         writer.write(out, ts)
+    """
+
+    def __init__(self, filename, mesh, ts=None, compression=None,
+                 complevel=5, shuffle=True, expected_steps=None):
+        """
+        Create the file and write the mesh and the time stepper `ts` into
+        it. The `compression` arguments are described in
+        HDF5MeshIO.write(); `expected_steps` (by default `ts.n_step`) is
+        used to choose the chunk sizes.
+        """
+        io = HDF5MeshIO(filename)
+        aux = None if ts is None else Struct(step=0, t0=ts.t0, t1=ts.t1,
+                                             dt=ts.dt, n_step=ts.n_step)
+        io.write(filename, mesh, ts=aux, compression=compression,
+                 complevel=complevel, shuffle=shuffle)
+
+        if compression is None:
+            filters = None
+
+        else:
+            filters = pt.Filters(complevel=complevel, complib=compression,
+                                 shuffle=shuffle)
+
+        fd = pt.openFile(filename, mode='r+')
+        expected_steps = get_default(expected_steps,
+                                     get_default_attr(ts, 'n_step', 1000))
+
+        series = fd.createGroup('/', 'series', 'time series data')
+        for name, dtype, title in [('steps', nm.int32, 'step'),
+                                   ('times', nm.float64, 'time'),
+                                   ('nts', nm.float64, 'normalized time')]:
+            fd.createEArray(series, name, pt.Atom.from_dtype(nm.dtype(dtype)),
+                            (0,), title, expectedrows=expected_steps)
+        series._v_attrs.name_dict = {}
+
+        Struct.__init__(self, filename=filename, io=io, fd=fd, series=series,
+                        filters=filters, expected_steps=expected_steps,
+                        n_step=0)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, out, ts=None):
+        """
+        Append the results `out` of the time step `ts`. Without `ts`, the
+        steps are numbered consecutively.
+        """
+        if ts is None:
+            step, time, nt  = self.n_step, 0.0, 0.0
+        else:
+            step, time, nt = ts.step, ts.time, ts.nt
+
+        fd, series = self.fd, self.series
+        name_dict = series._v_attrs.name_dict
+        if self.n_step == 0:
+            for key, val in out.iteritems():
+                data = nm.asarray(val.data)
+
+                group_name = '__' + key.translate(self.io._tr)
+                data_group = fd.createGroup(series, group_name,
+                                            '%s data' % key)
+                fd.createEArray(data_group, 'data',
+                                pt.Atom.from_dtype(data.dtype),
+                                (0,) + data.shape, 'data',
+                                filters=self.filters,
+                                expectedrows=self.expected_steps)
+                self.io._write_data_info(fd, data_group, key, val)
+
+                name_dict[key] = group_name
+
+            series._v_attrs.name_dict = name_dict
+
+        elif set(out.keys()) != set(name_dict.keys()):
+            raise ValueError('all time steps must have the same data! (%s)'
+                             % ', '.join(sorted(name_dict.keys())))
+
+        for key, val in out.iteritems():
+            data_group = series._f_getChild(name_dict[key])
+            data_group.data.append(nm.asarray(val.data)[None, ...])
+
+        series.steps.append(nm.array([step], dtype=nm.int32))
+        series.times.append(nm.array([time], dtype=nm.float64))
+        series.nts.append(nm.array([nt], dtype=nm.float64))
+        fd.root.last_step[0] = step
+
+        self.n_step += 1
+
+    def flush(self):
+        self.fd.flush()
+
+    def close(self):
+        """
+        Record the file closing time and close the file.
+        """
+        from time import asctime
+
+        if self.fd is None:
+            return
+
+        fd = self.fd
+        fd.removeNode(fd.root.tstat.finished)
+        fd.createArray(fd.root.tstat, 'finished', asctime(),
+                       'file closing time')
+        fd.close()
+        self.fd = None
+
 class MEDMeshIO( MeshIO ):
     format = "med"
 
@@ -1898,40 +2877,22 @@ class HypermeshAsciiMeshIO( MeshIO ):
         fd.write("BEGIN DATA\n")
 
         fd.write("BEGIN NODES\n")
-        format = self.get_vector_format(dim) + ' %d\n'
-        for ii in range(n_nod):
-            nn = (ii + 1, ) + tuple(coors[ii])
-            fd.write("*node(%d,%f,%f,%f,0,0,0,1,1)\n" % nn)
+        write_array(fd, (nm.arange(1, n_nod + 1), coors),
+                    "*node(%d,%f,%f,%f,0,0,0,1,1)\n")
         fd.write("END NODES\n\n")
 
+        hm_names = {'1_2' : 'bar2', '2_4' : 'quad4', '2_3' : 'tria3',
+                    '3_4' : 'tetra4', '3_8' : 'hex8'}
         fd.write("BEGIN COMPONENTS\n")
         for ig, conn in enumerate(conns):
             fd.write('*component(%d,"component%d",0,1,0)\n' % (ig + 1, ig + 1))
 
-            if (desc[ig] == "1_2"):
-                for ii in range(conn.shape[0]):
-                    nn = (ii + 1,) + tuple(conn[ii,:-1] + 1)
-                    fd.write("*bar2(%d,1,%d,%d,0)\n" % nn)
-
-            elif (desc[ig] == "2_4"):
-                for ii in range(conn.shape[0]):
-                    nn = (ii + 1,) + tuple(conn[ii,:-1] + 1)
-                    fd.write("*quad4(%d,1,%d,%d,%d,%d,0)\n" % nn)
-
-            elif (desc[ig] == "2_3"):
-                for ii in range(conn.shape[0]):
-                    nn = (ii + 1,) + tuple(conn[ii,:-1] + 1)
-                    fd.write("*tria3(%d,1,%d,%d,%d,0)\n" % nn)
-
-            elif (desc[ig] == "3_4"):
-                for ii in range(conn.shape[0]):
-                    nn = (ii + 1,) + tuple(conn[ii,:-1] + 1)
-                    fd.write("*tetra4(%d,1,%d,%d,%d,%d,0)\n" % nn)
-
-            elif (desc[ig] == "3_8"):
-                for ii in range(conn.shape[0]):
-                    nn = (ii + 1,) + tuple(conn[ii,:-1] + 1)
-                    fd.write("*hex8(%d,1,%d,%d,%d,%d,%d,%d,%d,%d,0)\n" % nn)
+            if desc[ig] in hm_names:
+                n_ep = conn.shape[1] - 1
+                format = '*%s(%%d,1,%s,0)\n' % (hm_names[desc[ig]],
+                                                ','.join(['%d'] * n_ep))
+                write_array(fd, (nm.arange(1, conn.shape[0] + 1),
+                                 conn[:,:-1] + 1), format)
 
             else:
                 raise ValueError('unknown element type! (%s)' % desc[ig])
@@ -1965,247 +2926,368 @@ class AbaqusMeshIO( MeshIO ):
     guess = staticmethod( guess )
 
 
-    def read( self, mesh, **kwargs ):
-        fd = open( self.filename, 'r' )
+    def _read_blocks(self):
+        """
+        Read the file and split it into keyword blocks.
+
+        Returns
+        -------
+        blocks : list of tuples
+            The (keyword, parameters, body) tuples, where the keyword is
+            lower case, the parameters are in a dict with lower case keys
+            and the body is the text of the block data lines.
+        """
+        fd = open(self.filename, 'r')
+        text = fd.read()
+        fd.close()
 
+        # Remove comment lines.
+        text = re.sub(r'(?m)^\*\*.*$', '', text)
+
+        keywords = list(re.finditer(r'(?m)^\*.*$', text))
+        ends = [match.start() for match in keywords[1:]] + [len(text)]
+
+        blocks = []
+        for match, end in zip(keywords, ends):
+            parts = match.group().split(',')
+
+            params = {}
+            for part in parts[1:]:
+                aux = part.split('=')
+                val = aux[1].strip() if len(aux) > 1 else None
+                params[aux[0].strip().lower()] = val
+
+            blocks.append((parts[0].strip().lower(), params,
+                           text[match.end():end]))
+
+        return blocks
+
+    def _parse_body(self, body, n_col, dtype):
+        """
+        Parse the comma-separated values of a block body into an array with
+        `n_col` columns.
+        """
+        data = nm.fromstring(body.replace(',', ' '), dtype=dtype, sep=' ')
+        if data.shape[0] % n_col:
+            raise ValueError('wrong number of values in a block! (%d, %d)'
+                             % (data.shape[0], n_col))
+
+        return data.reshape((-1, n_col))
+
+    def _get_n_col(self, body):
+        """
+        Get the number of values on the first data line of a block body.
+        """
+        line = body.lstrip().split('\n', 1)[0].strip().rstrip(',')
+        return len(line.split(','))
+
+    def read( self, mesh, **kwargs ):
         ids = []
         coors = []
-        tetras = []
-        mat_tetras = []
-        hexas = []
-        mat_hexas = []
-        tris = []
-        mat_tris = []
-        quads = []
-        mat_quads = []
-        nsets = {}
-        ing = 1
+        conns = {'2_3' : [], '2_4' : [], '3_4' : [], '3_8' : []}
+        nsets = []
         dim = 0
 
-        line = fd.readline().split(',')
-        while 1:
-            if not line[0]: break
-
-            token = line[0].strip().lower()
-            if token == '*node':
-                while 1:
-                    line = fd.readline().split(',')
-                    if (not line[0]) or (line[0][0] == '*'): break
-                    if dim == 0:
-                        dim = len(line) - 1
-                    ids.append( int( line[0] ) )
-                    if dim == 2:
-                        coors.append( [float( coor ) for coor in line[1:3]] )
-                    else:
-                        coors.append( [float( coor ) for coor in line[1:4]] )
+        for token, params, body in self._read_blocks():
+            if (token == '*node') and body.strip():
+                n_col = self._get_n_col(body)
+                if dim == 0:
+                    dim = n_col - 1
+                data = self._parse_body(body, n_col, nm.float64)
+
+                ids.append(nm.asarray(data[:,0], dtype=nm.int32))
+                if dim == 2:
+                    coors.append(data[:,1:3])
+                else:
+                    coors.append(data[:,1:4])
 
             elif token == '*element':
+                etype = params.get('type', '')
+                etype = '' if etype is None else etype.upper()
+
+                if etype.find('C3D8') >= 0:
+                    desc = '3_8'
+
+                elif etype.find('C3D4') >= 0:
+                    desc = '3_4'
 
-                if line[1].find( 'C3D8' ) >= 0:
-                    while 1:
-                        line = fd.readline().split(',')
-                        if (not line[0]) or (line[0][0] == '*'): break
-                        mat_hexas.append( 0 )
-                        hexas.append( [int( ic ) for ic in line[1:9]] )
-
-                elif line[1].find( 'C3D4' ) >= 0:
-                    while 1:
-                        line = fd.readline().split(',')
-                        if (not line[0]) or (line[0][0] == '*'): break
-                        mat_tetras.append( 0 )
-                        tetras.append( [int( ic ) for ic in line[1:5]] )
-
-                elif line[1].find('CPS') >= 0 or line[1].find('CPE') >= 0:
-                    if line[1].find('4') >= 0:
-                        while 1:
-                            line = fd.readline().split(',')
-                            if (not line[0]) or (line[0][0] == '*'): break
-                            mat_quads.append( 0 )
-                            quads.append( [int( ic ) for ic in line[1:5]] )
-                    elif line[1].find('3') >= 0:
-                        while 1:
-                            line = fd.readline().split(',')
-                            if (not line[0]) or (line[0][0] == '*'): break
-                            mat_tris.append( 0 )
-                            tris.append( [int( ic ) for ic in line[1:4]] )
+                elif etype.find('CPS') >= 0 or etype.find('CPE') >= 0:
+                    if etype.find('4') >= 0:
+                        desc = '2_4'
+                    elif etype.find('3') >= 0:
+                        desc = '2_3'
                     else:
-                        raise ValueError('unknown element type! (%s)' % line[1])
+                        raise ValueError('unknown element type! (%s)' % etype)
                 else:
-                    raise ValueError('unknown element type! (%s)' % line[1])
+                    raise ValueError('unknown element type! (%s)' % etype)
 
-            elif token == '*nset':
+                n_ep = int(desc[2:])
+                data = self._parse_body(body, n_ep + 1, nm.int32)
+                conns[desc].append(data[:,1:])
 
-                if line[-1].strip().lower() == 'generate':
-                    line = fd.readline()
+            elif token == '*nset':
+                if 'generate' in params:
                     continue
 
-                while 1:
-                    line = fd.readline().strip().split(',')
-                    if (not line[0]) or (line[0][0] == '*'): break
-                    if not line[-1]: line = line[:-1]
-                    aux = [int( ic ) for ic in line]
-                    nsets.setdefault(ing, []).extend( aux )
-                ing += 1
+                nsets.append(nm.fromstring(body.replace(',', ' '),
+                                           dtype=nm.int32, sep=' '))
 
-            else:
-                line = fd.readline().split(',')
-                
-        fd.close()
+        ids = nm.concatenate(ids)
+        coors = nm.concatenate(coors)
 
-        ngroups = nm.zeros( (len(coors),), dtype = nm.int32 )
-        for ing, ii in nsets.iteritems():
-            ngroups[nm.array(ii)-1] = ing
+        remap = nm.zeros((ids.max() + 1,), dtype=nm.int32)
+        remap[ids] = nm.arange(ids.shape[0], dtype=nm.int32)
 
-        mesh = mesh_from_groups(mesh, ids, coors, ngroups,
-                                tris, mat_tris, quads, mat_quads,
-                                tetras, mat_tetras, hexas, mat_hexas)
+        ngroups = nm.zeros((coors.shape[0],), dtype=nm.int32)
+        for ing, nset in enumerate(nsets):
+            ngroups[remap[nset]] = ing + 1
+
+        aux = []
+        for desc in ['2_3', '2_4', '3_4', '3_8']:
+            if len(conns[desc]):
+                conn = nm.concatenate(conns[desc])
+            else:
+                conn = nm.zeros((0, int(desc[2:])), dtype=nm.int32)
+            aux.append(conn)
+            aux.append(nm.zeros((conn.shape[0],), dtype=nm.int32))
+
+        mesh = mesh_from_groups(mesh, ids, coors, ngroups, *aux)
 
         return mesh
 
     def read_dimension(self):
-        fd = open( self.filename, 'r' )
-        line = fd.readline().split(',')
-        while 1:
-            if not line[0]: break
-
-            token = line[0].strip().lower()
-            if token == '*node':
-                while 1:
-                    line = fd.readline().split(',')
-                    if (not line[0]) or (line[0][0] == '*'): break
-                    dim = len(line) - 1
-        
-        fd.close()
-        return dim
+        for token, params, body in self._read_blocks():
+            if (token == '*node') and body.strip():
+                return self._get_n_col(body) - 1
+
+        raise ValueError('no nodes in %s!' % self.filename)
 
     def write( self, filename, mesh, out = None, **kwargs ):
         raise NotImplementedError
 
+_bdf_exponent = re.compile(r'([0-9.])([+-]\d+)$')
+
+def _get_inner_space_table(n_bit):
+    """
+    Get the table of `n_bit` bit masks of filled characters, True for masks
+    with a gap, i.e. with non-contiguous bits.
+    """
+    masks = nm.arange(2**n_bit, dtype=nm.int32)
+    aux = masks // nm.maximum(masks & -masks, 1)
+    return (aux & (aux + 1)) != 0
+
+_bdf_inner_space8 = _get_inner_space_table(8)
+_bdf_inner_space16 = _get_inner_space_table(16)
+
 class BDFMeshIO( MeshIO ):
     format = 'nastran'
 
+    def _read_cards(self):
+        """
+        Read the non-comment lines into a fixed-width array of 8-character
+        fields.
+
+        The lines that are not valid fixed-field cards - free-field cards
+        with commas, or whitespace-separated cards (with several values or
+        tabs in a field, or longer than 80 characters) - are split to
+        values, see :func:`BDFMeshIO._split_card()`.
+
+        Returns
+        -------
+        keys : array
+            The card keywords (the stripped first fields) of the lines.
+        fields : array
+            The (n_line, 10) array of the fields.
+        """
+        fd = open(self.filename, 'r')
+        raw = fd.read().splitlines()
+        fd.close()
+
+        lines = nm.array(raw, dtype='S80')
+        iok = nm.where(lines.view(nm.uint8)[::80] != ord('$'))[0]
+        lines = lines[iok]
+        fields = lines.view('S8').reshape((-1, 10))
+        keys = nm.char.strip(fields[:,0])
+
+        bad = self._get_bad_fields(lines)
+        if max([0] + map(len, raw)) > 80:
+            bad |= nm.fromiter((len(raw[ii]) > 80 for ii in iok),
+                               dtype=nm.bool, count=len(iok))
+        ibad = nm.where(bad)[0]
+        if not len(ibad):
+            return keys, fields
+
+        rows = [self._split_card(raw[ii]) for ii in iok[ibad]]
+        n_rows = nm.ones((len(lines),), dtype=nm.int32)
+        n_rows[ibad] = [len(row) for row in rows]
+        width = max([8] + [len(val) for row in rows
+                           for card in row for val in card])
+
+        fields = fields.astype('S%d' % width)[nm.repeat(nm.arange(len(lines)),
+                                                         n_rows)]
+        starts = nm.cumsum(n_rows) - n_rows
+        for ii, row in zip(ibad, rows):
+            for ir, card in enumerate(row):
+                fields[starts[ii] + ir] = card
+
+        keys = nm.char.strip(fields[:,0])
+
+        return keys, fields
+
+    @staticmethod
+    def _get_bad_fields(lines):
+        """
+        Get the mask of lines that are not valid fixed-field cards: the
+        lines with commas or tabs, or with inner spaces in a field, i.e.
+        several values in a field. The large field cards have 16-character
+        data fields.
+        """
+        chars = lines.view(nm.uint8).reshape((-1, 80))
+        # Large field keywords end, their continuations start, with '*'.
+        is_large = (chars[:,:8] == ord('*')).any(axis=1)
+
+        bad = (chars == ord(',')).any(axis=1) | (chars == 9).any(axis=1)
+
+        # The bit masks of non-blank characters of the 8-character fields.
+        masks = nm.packbits(chars > 32, axis=1)
+        small = _bdf_inner_space8[masks]
+        bad |= small[:,0] | small[:,9]
+
+        large = masks[:,1:9].astype(nm.uint16)
+        large = _bdf_inner_space16[(large[:,0::2] << 8) | large[:,1::2]]
+        bad |= nm.where(is_large, large.any(axis=1),
+                        small[:,1:9].any(axis=1))
+
+        return bad
+
+    @staticmethod
+    def _split_card(line):
+        """
+        Split a free-field (comma-separated) or whitespace-separated card
+        to the fields of fixed-field cards. A large field value (of a
+        keyword ending or a continuation starting with '*') takes two
+        fields. The values not fitting into a card are put into
+        continuation cards, so that the returned list can have several
+        cards of 10 fields.
+        """
+        if ',' in line:
+            vals = [ii.strip() for ii in line.split(',')]
+
+        else:
+            vals = line.split()
+
+        if not vals:
+            return [[''] * 10]
+
+        key, vals = vals[0], vals[1:]
+        n_val = 4 if (key.endswith('*') or key.startswith('*')) else 8
+
+        cont = ''
+        if len(vals) == n_val + 1:
+            # The trailing value is the continuation mark.
+            vals, cont = vals[:-1], vals[-1]
+
+        cards = []
+        for ii in xrange(0, max(len(vals), 1), n_val):
+            aux = vals[ii:ii + n_val]
+            if n_val == 4:
+                aux = sum([[val, ''] for val in aux], [])
+
+            card = [key if ii == 0 else ''] + aux
+            cards.append(card + [''] * (10 - len(card)))
+
+        cards[-1][9] = cont
+
+        return cards
+
+    @staticmethod
+    def _to_float(fields):
+        """
+        Convert fields to floats, including the Nastran exponent shorthand
+        (e.g. 1.0-3).
+        """
+        try:
+            return fields.astype(nm.float64)
+
+        except ValueError:
+            aux = [float(_bdf_exponent.sub(r'\1e\2', ii.strip()))
+                   for ii in fields.ravel()]
+            return nm.array(aux, dtype=nm.float64).reshape(fields.shape)
+
     def read_dimension( self, ret_fd = False ):
-        fd = open( self.filename, 'r' )
-        el3d = 0
-        while 1:
-            try:
-                line = fd.readline()
-            except:
-                output( "reading " + fd.name + " failed!" )
-                raise
-            if len( line ) == 1: continue
-            if line[0] == '$': continue
-            aux = line.split()
-
-            if aux[0] == 'CHEXA':
-                el3d += 1
-            elif aux[0] == 'CTETRA':
-                el3d += 1
-
-        if el3d > 0:
+        keys = self._read_cards()[0]
+
+        if ((keys == 'CHEXA') | (keys == 'CTETRA')).any():
             dim = 3
         else:
             dim = 2
 
         if ret_fd:
-            return dim, fd
+            return dim, open(self.filename, 'r')
         else:
-            fd.close()
             return dim
 
     def read( self, mesh, **kwargs ):
-        def mfloat( s ):
-            if len( s ) > 3:
-                if s[-3] == '-':
-                    return float( s[:-3]+'e'+s[-3:] )
-
-            return float( s )
+        keys, fields = self._read_cards()
+
+        # Small field GRID: id, cp, x1, x2, x3.
+        ig = nm.where(keys == 'GRID')[0]
+        aux = fields[ig]
+        ids = [aux[:,1].astype(nm.int32)]
+        coors = [self._to_float(aux[:,3:6])]
+
+        # Large field GRID* with continuation: id, cp, x1, x2 / x3.
+        ilg = nm.where(keys == 'GRID*')[0]
+        aux = fields[ilg]
+        ids.append(nm.char.add(aux[:,1], aux[:,2]).astype(nm.int32))
+        x12 = [nm.char.add(aux[:,ii], aux[:,ii+1]) for ii in [5, 7]]
+        aux = fields[ilg + 1]
+        x3 = nm.char.add(aux[:,1], aux[:,2])
+        coors.append(self._to_float(nm.c_[x12[0], x12[1], x3]))
+
+        # Keep the nodes in the file order.
+        ii = nm.argsort(nm.r_[ig, ilg], kind='mergesort')
+        ids = nm.concatenate(ids)[ii]
+        nod = nm.concatenate(coors)[ii]
+
+        remap = nm.zeros((ids.max() + 1,), dtype=nm.int32)
+        remap[ids] = nm.arange(ids.shape[0], dtype=nm.int32)
+
+        # Element cards: eid, pid, nodes.
+        conns_in = []
+        descs = []
+        for key, desc in [('CTRIA3', '2_3'), ('CQUAD4', '2_4'),
+                          ('CTETRA', '3_4'), ('CHEXA', '3_8')]:
+            iels = nm.where(keys == key)[0]
+            if not len(iels):
+                continue
 
-        import string
-        fd = open( self.filename, 'r' )
+            aux = fields[iels]
+            if key == 'CHEXA':
+                # The nodes 7, 8 are on the continuation line.
+                nodes = nm.c_[aux[:,3:9], fields[iels + 1][:,1:3]]
+            else:
+                nodes = aux[:,3:3 + int(desc[2:])]
 
-        el = {'3_8' : [], '3_4' : [], '2_4' : [], '2_3' : []}
-        nod = []
-        cmd = ''
-        dim = 2
+            conn = nm.empty((len(iels), nodes.shape[1] + 1), dtype=nm.int32)
+            conn[:,:-1] = remap[nodes.astype(nm.int32)]
+            conn[:,-1] = aux[:,2].astype(nm.int32)
 
-        conns_in = []
-        descs = []
-        node_grp = None
-        while 1:
-            try:
-                line = fd.readline()
-            except EOFError:
-                break
-            except:
-                output( "reading " + fd.name + " failed!" )
-                raise
-
-            if (len( line ) == 0): break
-            if len( line ) < 4: continue
-            if line[0] == '$': continue
-
-            row = line.strip().split()
-            if row[0] == 'GRID':
-                cs = line.strip()[-24:]
-                aux = [ cs[0:8], cs[8:16], cs[16:24] ]
-                nod.append( [mfloat(ii) for ii in aux] );
-            elif row[0] == 'GRID*':
-                aux = row[1:4];
-                cmd = 'GRIDX';
-            elif row[0] == 'CHEXA':
-                aux = [int(ii)-1 for ii in row[3:9]]
-                aux2 = int(row[2])
-                aux3 = row[9]
-                cmd ='CHEXAX'
-            elif row[0] == 'CTETRA':
-                aux = [int(ii)-1 for ii in row[3:]]
-                aux.append( int(row[2]) )
-                el['3_4'].append( aux )
-                dim = 3
-            elif row[0] == 'CQUAD4':
-                aux = [int(ii)-1 for ii in row[3:]]
-                aux.append( int(row[2]) )
-                el['2_4'].append( aux )
-            elif row[0] == 'CTRIA3':
-                aux = [int(ii)-1 for ii in row[3:]]
-                aux.append( int(row[2]) )
-                el['2_3'].append( aux )
-            elif cmd == 'GRIDX':
-                cmd = ''
-                aux2 = row[1]
-                if aux2[-1] == '0':
-                    aux2 = aux2[:-1]
-                    aux3 = aux[1:]
-                    aux3.append( aux2 )
-                    nod.append( [float(ii) for ii in aux3] );
-            elif cmd == 'CHEXAX':
-                cmd = ''
-                aux4 = row[0]
-                aux5 = string.find( aux4, aux3 )
-                aux.append( int(aux4[(aux5+len(aux3)):])-1 )
-                aux.extend( [int(ii)-1 for ii in row[1:]] )
-                aux.append( aux2 )
-                el['3_8'].append( aux )
-                dim = 3
-
-            elif row[0] == 'SPC' or row[0] == 'SPC*':
-                if node_grp is None:
-                    node_grp = [0] * len(nod)
-
-                node_grp[int(row[2]) - 1] = int(row[1])
+            conns_in.append(conn)
+            descs.append(desc)
 
-        for elem in el.keys():
-            if len(el[elem]) > 0:
-                conns_in.append( el[elem] )
-                descs.append( elem )
+        ispc = nm.where((keys == 'SPC') | (keys == 'SPC*'))[0]
+        if len(ispc):
+            aux = fields[ispc]
+            node_grp = nm.zeros((nod.shape[0],), dtype=nm.int32)
+            node_grp[remap[aux[:,2].astype(nm.int32)]] = \
+                aux[:,1].astype(nm.int32)
 
-        fd.close()
+        else:
+            node_grp = None
 
-        nod = nm.array( nod, nm.float64 )
-        if dim == 2:
+        if not ((keys == 'CHEXA') | (keys == 'CTETRA')).any():
             nod = nod[:,:2].copy()
-        conns_in = nm.array( conns_in, nm.int32 )
 
         conns_in, mat_ids = sort_by_mat_id( conns_in )
         conns, mat_ids, descs = split_by_mat_id( conns_in, mat_ids, descs )
@@ -2237,58 +3319,50 @@ class BDFMeshIO( MeshIO ):
         fd.write("$\nBEGIN BULK\n")
 
         fd.write("$\n$ ELEMENT CONNECTIVITY\n$\n")
+        bdf_names = {'2_4' : 'CQUAD4  ', '2_3' : 'CTRIA3  ',
+                     '3_4' : 'CTETRA  ', '3_8' : 'CHEXA   '}
         iel = 0
-        mats = {}
+        mats = set()
         for ig, conn in enumerate(conns):
-            for ii in range(conn.shape[0]):
-                iel += 1
-                nn = conn[ii][:-1] + 1
-                mat = conn[ii][-1]
-                if mat in mats:
-                    mats[mat] += 1
-                else:
-                    mats[mat] = 0
-
-                if (desc[ig] == "2_4"):
-                    fd.write("CQUAD4  %s\n" %\
-                             self.format_str([ii + 1, mat,
-                                              nn[0], nn[1], nn[2], nn[3]],
-                                             iel))
-                elif (desc[ig] == "2_3"):
-                    fd.write("CTRIA3  %s\n" %\
-                             self.format_str([ii + 1, mat,
-                                              nn[0], nn[1], nn[2]], iel))
-                elif (desc[ig] == "3_4"):
-                    fd.write("CTETRA  %s\n" %\
-                             self.format_str([ii + 1, mat,
-                                              nn[0], nn[1], nn[2], nn[3]],
-                                             iel))
-                elif (desc[ig] == "3_8"):
-                    fd.write("CHEXA   %s\n" %\
-                             self.format_str([ii + 1, mat, nn[0], nn[1], nn[2],
-                                              nn[3], nn[4], nn[5], nn[6],
-                                              nn[7]], iel))
-                else:
-                    raise ValueError('unknown element type! (%s)' % desc[ig])
+            if desc[ig] not in bdf_names:
+                raise ValueError('unknown element type! (%s)' % desc[ig])
+
+            n_el = conn.shape[0]
+            ids = nm.arange(1, n_el + 1)
+            nn = conn[:,:-1] + 1
+            mat = conn[:,-1]
+            mats.update(nm.unique(mat).tolist())
+
+            # The same fields as self.format_str(): the small field format,
+            # the continuation after the eighth field.
+            if nn.shape[1] <= 6:
+                format = bdf_names[desc[ig]] + '%-8d' * (nn.shape[1] + 2) \
+                         + '\n'
+                write_array(fd, (ids, mat, nn), format)
+
+            else:
+                iels = nm.arange(iel + 1, iel + n_el + 1)
+                format = bdf_names[desc[ig]] + '%-8d' * 8 + '+%07d\n+%07d' \
+                         + '%-8d' * (nn.shape[1] - 6) + '\n'
+                write_array(fd, (ids, mat, nn[:,:6], iels, iels, nn[:,6:]),
+                            format)
+
+            iel += n_el
 
         fd.write("$\n$ NODAL COORDINATES\n$\n")
-        format = 'GRID*   %s                           % 08E   % 08E\n'
+        format = 'GRID*   %-8d                           % 08E   % 08E\n'
         if coors.shape[1] == 3:
             format += '*          % 08E0               \n'
         else:
             format += '*          % 08E0               \n' % 0.0
-        for ii in range(n_nod):
-            sii = str(ii + 1)
-            fd.write(format % ((sii + ' ' * (8 - len(sii)), )
-                               + tuple(coors[ii])))
+        write_array(fd, (nm.arange(1, n_nod + 1), coors), format)
 
         fd.write("$\n$ GEOMETRY\n$\n1                                   ")
         fd.write("0.000000E+00    0.000000E+00\n")
         fd.write("*           0.000000E+00    0.000000E+00\n*       \n")
 
         fd.write("$\n$ MATERIALS\n$\n")
-        matkeys = mats.keys()
-        matkeys.sort()
+        matkeys = sorted(mats)
         for ii, imat in enumerate(matkeys):
             fd.write("$ material%d : Isotropic\n" % imat)
             aux = str(imat)
@@ -2312,7 +3386,7 @@ class NEUMeshIO( MeshIO ):
 
     def read_dimension( self, ret_fd = False ):
 
-        fd = open( self.filename, 'r' )
+        fd = Tokenizer(self.filename)
 
         row = fd.readline().split()
         while 1:
@@ -2323,6 +3397,8 @@ class NEUMeshIO( MeshIO ):
                 row = fd.readline().split()
                 n_nod, n_el, dim = row[0], row[1], int( row[4] )
                 break;
+
+            row = fd.readline().split()
                 
         if ret_fd:
             return dim, fd
@@ -2343,7 +3419,7 @@ class NEUMeshIO( MeshIO ):
         groups = []
         nodal_bcs = {}
 
-        fd = open( self.filename, 'r' )
+        fd = Tokenizer(self.filename)
 
         row = fd.readline().split()
         while 1:
@@ -2400,7 +3476,7 @@ class NEUMeshIO( MeshIO ):
                 row = fd.readline().split()
                 key = row[0]
                 num = int(row[2])
-                inod = read_array(fd, num, None, nm.int32) - 1
+                inod = fd.read_array(num, None, nm.int32) - 1
                 nodal_bcs[key] = inod.squeeze()
 
                 row = fd.readline().split()
@@ -2480,7 +3556,7 @@ class ANSYSCDBMeshIO( MeshIO ):
         coors = []
         elems = []
 
-        fd = open( self.filename, 'r' )
+        fd = Tokenizer(self.filename)
 
         while True:
             row = fd.readline()
@@ -2514,7 +3590,7 @@ class ANSYSCDBMeshIO( MeshIO ):
                 attr = row[2]
                 nel = int(row[3])
                 format = fd.readline()
-                elems = read_array(fd, nel, nval, nm.int32)
+                elems = fd.read_array(nel, nval, nm.int32)
 
         fd.close()
 
@@ -0,0 +1,427 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Headless DICOM/segmentation to FE mesh batch pipeline.
+
+The jobs are described by a JSON file containing either a list of jobs or
+a dictionary with the optional "defaults" applied to all jobs and the list
+of "jobs". A job is a dictionary with the keys:
+
+  input        : project file, *.seg or *.mat file with segmented data, or
+                 DICOM directory
+  output       : output mesh file name
+  format       : output mesh format [default: given by the output file
+                 suffix]
+  generator    : mesh generator key, see seg2fem.mesh_generators
+                 [default: volume/tetra]
+  smooth       : smoothing method key, see seg2fem.smooth_methods, or null
+                 [default: null]
+  voxel_size   : rescale the segmentation to this voxel size in mm (a number
+                 or three numbers) [default: no rescaling]
+  scale_factor : gmsh characteristic length factor for the marching cubes
+                 volume generator [default: 0.25]
+  threshold    : [min, max] intensity range used to segment DICOM data
+  target_faces : decimate the surface mesh to this number of triangles, see
+                 decimate.decimate_mesh() [default: no decimation]
+  max_error    : decimate the surface mesh up to this error in mm
+                 [default: no decimation]
+  cache_dir    : directory of the cache of generated and smoothed meshes and
+                 of DICOM volumes [default: no caching]
+  cache_size   : cache size limit in MB [default: 1024]
+
+Example:
+
+$ pipeline.py -j 4 jobs.json
+"""
+from optparse import OptionParser
+import os
+import sys
+import time
+import json
+import multiprocessing
+
+import numpy as nm
+
+from base import output
+from meshio import MeshIO, supported_formats, supported_capabilities
+from seg2fem import mesh_generators, smooth_methods
+from rescale import rescale_mask
+from stagecache import StageCache
+from project import read_segmentation
+from dcmloader import load_dcmdir
+from decimate import decimate_mesh
+
+job_defaults = {
+    'format': None,
+    'generator': 'volume/tetra',
+    'smooth': None,
+    'voxel_size': None,
+    'scale_factor': 0.25,
+    'threshold': None,
+    'target_faces': None,
+    'max_error': None,
+    'cache_dir': None,
+    'cache_size': 1024,
+}
+
+def read_jobs(filename):
+    """
+    Read the job specification file and fill in the default values.
+    """
+    fd = open(filename, 'r')
+    spec = json.load(fd)
+    fd.close()
+
+    if isinstance(spec, list):
+        spec = {'jobs': spec}
+
+    defaults = job_defaults.copy()
+    defaults.update(spec.get('defaults', {}))
+
+    jobs = []
+    for job_in in spec['jobs']:
+        job = defaults.copy()
+        job.update(job_in)
+        jobs.append(job)
+
+    return jobs
+
+def get_output_format(job):
+    """
+    Get the output mesh format of a job: the 'format' parameter, or the
+    writable format of the output file suffix.
+    """
+    if job['format'] is not None:
+        return job['format']
+
+    ext = os.path.splitext(job['output'])[1].lower()
+    format = supported_formats.get(ext)
+    if isinstance(format, tuple):
+        formats = [ii for ii in format if 'w' in supported_capabilities[ii]]
+        format = formats[0] if len(formats) == 1 else None
+
+    if format is None:
+        raise ValueError('cannot determine output mesh format! (%s)'
+                         % job['output'])
+
+    return format
+
+def check_job(job):
+    """
+    Check the job parameters before running it.
+    """
+    for key in ['input', 'output']:
+        if key not in job:
+            raise ValueError('missing job parameter! (%s)' % key)
+
+    if job['generator'] not in mesh_generators:
+        raise ValueError('unknown mesh generator! (%s)' % job['generator'])
+
+    if (job['smooth'] is not None) and (job['smooth'] not in smooth_methods):
+        raise ValueError('unknown smoothing method! (%s)' % job['smooth'])
+
+    if (job['target_faces'] is not None) or (job['max_error'] is not None):
+        pars = mesh_generators[job['generator']][2]
+        if (pars.get('mtype') == 'v') or pars.get('gmsh3d'):
+            raise ValueError('decimation needs a surface mesh generator! (%s)'
+                             % job['generator'])
+
+    format = get_output_format(job)
+    if 'w' not in supported_capabilities.get(format, []):
+        raise ValueError('unknown or not writable mesh format! (%s)'
+                         % format)
+
+    if os.path.isdir(job['input']) and (job['threshold'] is None):
+        raise ValueError('threshold needed to segment DICOM data! (%s)'
+                         % job['input'])
+
+def load_segmentation(job, state):
+    """
+    Load the segmentation from a project or *.seg/*.mat file or segment
+    DICOM data by an intensity threshold.
+    """
+    filename = job['input']
+    if os.path.isdir(filename):
+        if job['cache_dir'] is not None:
+            cache_dir = os.path.join(job['cache_dir'], 'dicom')
+
+        else:
+            cache_dir = None
+
+        data, metadata = load_dcmdir(filename, cache_dir=cache_dir,
+                                     cache_size=job['cache_size'])
+        voxelsize = metadata['voxelsize_mm']
+        offset = metadata['offset_mm']
+
+        vmin, vmax = job['threshold']
+        segdata = ((data >= vmin) & (data <= vmax)).astype(nm.int8)
+
+    else:
+        segdata, voxelsize, offset = read_segmentation(filename)
+
+    state['segdata'] = segdata
+    state['voxelsize'] = nm.array(voxelsize, dtype=nm.float64).reshape((3,))
+    state['offset'] = nm.array(offset, dtype=nm.float64).reshape((3,))
+
+def rescale_segmentation(job, state):
+    """
+    Rescale the segmentation to the voxel size given by the job.
+    """
+    if job['voxel_size'] is None:
+        return
+
+    new_vsize = nm.array(job['voxel_size'], dtype=nm.float64)
+    if new_vsize.shape != (3,):
+        new_vsize = nm.repeat(new_vsize.ravel()[:1], 3)
+
+    zoom = state['voxelsize'] / new_vsize
+    if (zoom <= 0.0).any() or (zoom > 100).any():
+        raise ValueError('invalid voxel size! (%s)' % job['voxel_size'])
+
+    state['segdata'] = rescale_mask(state['segdata'], zoom)
+    state['voxelsize'] = state['voxelsize'] / zoom
+
+def get_generator_pars(job):
+    mgid, gen_fun, pars = mesh_generators[job['generator']]
+    pars = pars.copy()
+    if mgid == 1:
+        pars['scale_factor'] = job['scale_factor']
+
+    return gen_fun, pars
+
+def get_stage_keys(job, state):
+    """
+    Get the cache keys of the generated, smoothed and decimated meshes. The
+    keys depend on the segmentation, the voxel size and the parameters of
+    all stages up to the cached one.
+    """
+    cache = state['cache']
+    gen_fun, pars = get_generator_pars(job)
+    key = cache.get_key(state['segdata'], state['voxelsize'],
+                        state['offset'], gen_fun.__name__, pars)
+    keys = [('mesh', key)]
+
+    if job['smooth'] is not None:
+        smooth_fun, smooth_pars = smooth_methods[job['smooth']]
+        key = cache.get_key(key, smooth_fun.__name__, smooth_pars)
+        keys.append(('smooth', key))
+
+    if (job['target_faces'] is not None) or (job['max_error'] is not None):
+        key = cache.get_key(key, 'decimate_mesh', job['target_faces'],
+                            job['max_error'])
+        keys.append(('decimate', key))
+
+    return keys
+
+def generate_mesh(job, state):
+    cache = state.get('cache')
+    if cache is not None:
+        state['keys'] = get_stage_keys(job, state)
+        # Start from the latest cached stage.
+        for ii in xrange(len(state['keys']) - 1, -1, -1):
+            name, key = state['keys'][ii]
+            mesh = cache.load(key)
+            if mesh is not None:
+                state['mesh'] = mesh
+                state['skip'] = [aux[0] for aux in state['keys'][:ii + 1]]
+                state['cache_hits'].append(name)
+                del state['segdata']
+                return
+
+    gen_fun, pars = get_generator_pars(job)
+    mesh = gen_fun(state['segdata'], state['voxelsize'] * 1.0e-3, **pars)
+    mesh.coors += state['offset'] * 1.0e-3
+
+    state['mesh'] = mesh
+    del state['segdata']
+
+    save_stage('mesh', state)
+
+def save_stage(name, state):
+    cache = state.get('cache')
+    if cache is not None:
+        cache.save(dict(state['keys'])[name], state['mesh'])
+
+def smooth(job, state):
+    if (job['smooth'] is None) or ('smooth' in state.get('skip', [])):
+        return
+
+    mesh = state['mesh']
+    smooth_fun, pars = smooth_methods[job['smooth']]
+    etype = '%d_%d' % (mesh.dim, mesh.conns[0].shape[-1])
+    if (etype == '2_2' or etype == '3_3') and pars['volume_corr']:
+        raise ValueError('no volume mesh for smoothing method! (%s)'
+                         % job['smooth'])
+
+    mesh.coors = smooth_fun(mesh, **pars)
+
+    save_stage('smooth', state)
+
+def decimate(job, state):
+    if (((job['target_faces'] is None) and (job['max_error'] is None))
+        or ('decimate' in state.get('skip', []))):
+        return
+
+    max_error = job['max_error']
+    if max_error is not None:
+        max_error *= 1.0e-3
+
+    state['mesh'] = decimate_mesh(state['mesh'],
+                                  target_faces=job['target_faces'],
+                                  max_error=max_error)
+
+    save_stage('decimate', state)
+
+def write_mesh(job, state):
+    filename = job['output']
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.exists(dirname):
+        try:
+            os.makedirs(dirname)
+
+        except OSError: # Created by another job meanwhile.
+            pass
+
+    io = MeshIO.for_format(filename, format=get_output_format(job),
+                           writable=True)
+    io.write(filename, state['mesh'])
+
+stages = [
+    ('load', load_segmentation),
+    ('rescale', rescale_segmentation),
+    ('mesh', generate_mesh),
+    ('smooth', smooth),
+    ('decimate', decimate),
+    ('write', write_mesh),
+]
+
+def run_job(job):
+    """
+    Run all pipeline stages of a job. Errors are returned instead of
+    raised, so that a failed job does not stop the others.
+
+    Returns
+    -------
+    result : tuple
+        The job input, the list of (stage, time) pairs, the number of mesh
+        elements, the list of stages taken from the cache and the error
+        message or None.
+    """
+    timings = []
+    state = {'cache_hits': []}
+    try:
+        if job['cache_dir'] is not None:
+            state['cache'] = StageCache(job['cache_dir'],
+                                        job['cache_size'] * 2**20)
+
+        for name, fun in stages:
+            tt = time.time()
+            fun(job, state)
+            timings.append((name, time.time() - tt))
+
+        err = None
+
+    except Exception, exc:
+        err = '%s: %s' % (exc.__class__.__name__, exc)
+
+    n_el = state['mesh'].n_el if 'mesh' in state else 0
+
+    return job['input'], timings, n_el, state['cache_hits'], err
+
+def run_jobs(jobs, n_jobs=None):
+    """
+    Run the jobs in a pool of `n_jobs` worker processes.
+
+    Returns
+    -------
+    results : list
+        The results of :func:`run_job()` in the order of completion.
+    """
+    if n_jobs is None:
+        n_jobs = multiprocessing.cpu_count()
+    n_jobs = max(min(n_jobs, len(jobs)), 1)
+
+    if n_jobs == 1:
+        pool = None
+        iresults = (run_job(job) for job in jobs)
+
+    else:
+        pool = multiprocessing.Pool(n_jobs)
+        iresults = pool.imap_unordered(run_job, jobs)
+
+    results = []
+    for result in iresults:
+        filename, timings, n_el, cache_hits, err = result
+        aux = ', '.join('%s %.2f s' % stage for stage in timings)
+        if cache_hits:
+            aux += '; cached: %s' % ', '.join(cache_hits)
+        if err is None:
+            output('%s: %d elements (%s)' % (filename, n_el, aux))
+
+        else:
+            output('%s failed: %s (%s)' % (filename, err, aux))
+
+        results.append(result)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    return results
+
+usage = '%prog [options] jobs.json\n' + __doc__.rstrip()
+help = {
+    'jobs': 'number of parallel worker processes [default: number of CPUs]',
+    'cache_dir': 'directory of the cache of generated and smoothed meshes,'
+    ' overrides the job specification',
+    'cache_size': 'cache size limit in MB, overrides the job specification',
+}
+
+def main():
+    parser = OptionParser(usage=usage, description='DICOM2FEM batch')
+    parser.add_option('-j', '--jobs', type='int', action='store',
+                      dest='jobs', default=None,
+                      help=help['jobs'])
+    parser.add_option('-c', '--cache-dir', action='store',
+                      dest='cache_dir', default=None,
+                      help=help['cache_dir'])
+    parser.add_option('--cache-size', type='int', action='store',
+                      dest='cache_size', default=None,
+                      help=help['cache_size'])
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+
+    jobs = read_jobs(args[0])
+    for job in jobs:
+        if options.cache_dir is not None:
+            job['cache_dir'] = options.cache_dir
+
+        if options.cache_size is not None:
+            job['cache_size'] = options.cache_size
+
+        check_job(job)
+
+    tt = time.time()
+    results = run_jobs(jobs, options.jobs)
+
+    totals = {}
+    for filename, timings, n_el, cache_hits, err in results:
+        for name, dt in timings:
+            totals[name] = totals.get(name, 0.0) + dt
+
+    n_failed = len([ii for ii in results if ii[4] is not None])
+    output('%d job(s) done in %.2f s, %d failed' % (len(results),
+                                                   time.time() - tt,
+                                                   n_failed))
+    output('total stage times: %s'
+           % ', '.join('%s %.2f s' % (name, totals[name])
+                       for name, fun in stages if name in totals))
+
+    if n_failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+"""
+Project files with DICOM data and segmentations.
+
+A project is a HDF5 file with the volumes stored as chunked, compressed
+arrays, one chunk holding a slab of z-slices. The project info (array
+shapes, voxel size) can thus be read without touching the volume data,
+and the volumes can be loaded partially - only some of them or only a
+range of z-slices. The MATLAB files written by the older versions (*.dcm,
+*.seg) are still supported for import and export.
+
+The project arrays are:
+
+  data         : DICOM data
+  segdata      : segmentation
+  segseeds     : segmentation seeds
+  voxelsize_mm : voxel size in mm
+  offset_mm    : offset of the data in mm
+"""
+import os.path as op
+
+import numpy as nm
+from scipy.io import loadmat, savemat
+
+from ioutils import pt
+
+project_format = 'dicom2fem project'
+project_version = 1
+
+volume_names = ['data', 'segdata', 'segseeds']
+info_names = ['voxelsize_mm', 'offset_mm']
+
+def is_project_file(filename):
+    """
+    Return True, if `filename` is a HDF5 project file, False for other
+    files (e.g. MATLAB files).
+    """
+    if (pt is None) or not op.isfile(filename):
+        return False
+
+    try:
+        return bool(pt.isHDF5File(filename))
+
+    except Exception:
+        return False
+
+def get_chunkshape(shape, itemsize, chunk_size=2**20):
+    """
+    Get the chunk shape of a volume: a slab of whole z-slices with about
+    `chunk_size` bytes.
+    """
+    slice_size = max(int(nm.prod(shape[1:])) * itemsize, 1)
+    n_slices = min(max(chunk_size // slice_size, 1), shape[0])
+
+    return (n_slices,) + tuple(shape[1:])
+
+def save_project(filename, data=None, voxelsize_mm=None, offset_mm=None,
+                 segdata=None, segseeds=None, compression='blosc',
+                 complevel=5):
+    """
+    Save the DICOM data and the segmentation into a project file.
+
+    Parameters
+    ----------
+    filename : str
+        The project file name.
+    data, segdata, segseeds : array, optional
+        The 3D volumes to save. None values are not saved.
+    voxelsize_mm : array
+        The voxel size in mm.
+    offset_mm : array, optional
+        The offset of the data in mm.
+    compression : str
+        The PyTables compression library.
+    complevel : int
+        The compression level, 0 means no compression.
+    """
+    if pt is None:
+        raise ValueError('PyTables are needed to save projects!')
+
+    if voxelsize_mm is None:
+        raise ValueError('voxel size is needed to save a project!')
+
+    if offset_mm is None:
+        offset_mm = nm.zeros((3,), dtype=nm.float64)
+
+    if complevel > 0:
+        if not pt.whichLibVersion(compression):
+            compression = 'zlib'
+        filters = pt.Filters(complevel=complevel, complib=compression,
+                             shuffle=True)
+
+    else:
+        filters = None
+
+    fd = pt.openFile(filename, mode='w', title='DICOM2FEM project')
+    try:
+        fd.root._v_attrs.format = project_format
+        fd.root._v_attrs.version = project_version
+
+        vols = {'data': data, 'segdata': segdata, 'segseeds': segseeds}
+        for name in volume_names:
+            val = vols[name]
+            if val is None:
+                continue
+
+            val = nm.asarray(val)
+            if val.ndim != 3:
+                raise ValueError('volume %s must be 3D! (%s)'
+                                 % (name, val.shape))
+
+            if val.size == 0:
+                fd.createArray('/', name, val, name)
+                continue
+
+            chunkshape = get_chunkshape(val.shape, val.dtype.itemsize)
+            node = fd.createCArray('/', name,
+                                   pt.Atom.from_dtype(val.dtype),
+                                   val.shape, name, filters=filters,
+                                   chunkshape=chunkshape)
+            for z0 in xrange(0, val.shape[0], chunkshape[0]):
+                node[z0:z0 + chunkshape[0]] = val[z0:z0 + chunkshape[0]]
+
+        for name, val in [('voxelsize_mm', voxelsize_mm),
+                          ('offset_mm', offset_mm)]:
+            val = nm.array(val, dtype=nm.float64).reshape((3,))
+            fd.createArray('/', name, val, name)
+
+    finally:
+        fd.close()
+
+def read_project_info(filename):
+    """
+    Read the project info without loading the volumes.
+
+    Returns
+    -------
+    info : dict
+        The voxel size, the offset and the (shape, dtype) pairs of the
+        volumes stored in the project, under the `volume_names` keys.
+    """
+    fd = pt.openFile(filename, mode='r')
+    try:
+        _check_project(fd, filename)
+
+        info = {}
+        for name in info_names:
+            info[name] = fd.getNode('/', name).read()
+
+        for name in volume_names:
+            if name in fd.root._v_leaves:
+                node = fd.getNode('/', name)
+                info[name] = (node.shape, node.atom.dtype)
+
+    finally:
+        fd.close()
+
+    return info
+
+def load_project(filename, names=None, zrange=None):
+    """
+    Load a project file.
+
+    Parameters
+    ----------
+    filename : str
+        The project file name.
+    names : list of str, optional
+        The names of the volumes to load. By default all volumes present
+        in the project are loaded.
+    zrange : tuple, optional
+        The (start, stop) range of z-slices to load. Only the chunks
+        containing the slices are read. The offset is not shifted.
+
+    Returns
+    -------
+    out : dict
+        The loaded volumes and the voxel size and offset.
+    """
+    if names is None:
+        names = volume_names
+
+    fd = pt.openFile(filename, mode='r')
+    try:
+        _check_project(fd, filename)
+
+        out = {}
+        for name in info_names:
+            out[name] = fd.getNode('/', name).read()
+
+        for name in names:
+            if name not in volume_names:
+                raise ValueError('unknown project volume! (%s)' % name)
+
+            if name not in fd.root._v_leaves:
+                continue
+
+            node = fd.getNode('/', name)
+            if zrange is None:
+                out[name] = node.read()
+
+            else:
+                out[name] = node.read(zrange[0], zrange[1])
+
+    finally:
+        fd.close()
+
+    return out
+
+def _check_project(fd, filename):
+    if getattr(fd.root._v_attrs, 'format', None) != project_format:
+        raise ValueError('not a project file! (%s)' % filename)
+
+    version = fd.root._v_attrs.version
+    if version > project_version:
+        raise ValueError('unsupported project file version! (%s: %s)'
+                         % (filename, version))
+
+def import_mat(filename, names=None):
+    """
+    Load a MATLAB file written by the older versions.
+
+    Returns the same dictionary as :func:`load_project()`. The old
+    'voxelsizemm' key is accepted as 'voxelsize_mm'.
+    """
+    if names is None:
+        names = volume_names
+
+    data = loadmat(filename, appendmat=False,
+                   variable_names=list(names) + info_names + ['voxelsizemm'])
+
+    out = {}
+    for name in names:
+        if name in data:
+            out[name] = data[name]
+
+    if 'voxelsize_mm' in data:
+        vsize = data['voxelsize_mm']
+
+    elif 'voxelsizemm' in data:
+        vsize = data['voxelsizemm']
+
+    else:
+        raise ValueError('no voxel size in file! (%s)' % filename)
+
+    out['voxelsize_mm'] = nm.array(vsize, dtype=nm.float64).reshape((3,))
+    offset = data.get('offset_mm', nm.zeros((3,), dtype=nm.float64))
+    out['offset_mm'] = nm.array(offset, dtype=nm.float64).reshape((3,))
+
+    return out
+
+def export_mat(filename, data=None, voxelsize_mm=None, offset_mm=None,
+               segdata=None, segseeds=None):
+    """
+    Save the DICOM data and the segmentation into a MATLAB file readable
+    by the older versions.
+    """
+    if offset_mm is None:
+        offset_mm = nm.zeros((3,), dtype=nm.float64)
+
+    outdata = {'voxelsize_mm': voxelsize_mm, 'offset_mm': offset_mm}
+    for name, val in [('data', data), ('segdata', segdata),
+                      ('segseeds', segseeds)]:
+        if val is not None:
+            outdata[name] = val
+
+    savemat(filename, outdata, appendmat=False)
+
+def load_file(filename, names=None):
+    """
+    Load a project file or a MATLAB file, see :func:`load_project()`.
+    """
+    if is_project_file(filename):
+        return load_project(filename, names=names)
+
+    else:
+        return import_mat(filename, names=names)
+
+def save_file(filename, **kwargs):
+    """
+    Save a project file, or a MATLAB file if `filename` has the .mat, .dcm
+    or .seg suffix. See :func:`save_project()` for the arguments.
+    """
+    ext = op.splitext(filename)[1].lower()
+    if ext in ['.mat', '.dcm', '.seg']:
+        kwargs.pop('compression', None)
+        kwargs.pop('complevel', None)
+        export_mat(filename, **kwargs)
+
+    else:
+        save_project(filename, **kwargs)
+
+def read_segmentation(filename):
+    """
+    Read the segmentation, the voxel size and the offset (in mm) from a
+    project file or a MATLAB file.
+    """
+    data = load_file(filename, names=['segdata'])
+    if 'segdata' not in data:
+        raise ValueError('no segmentation in file! (%s)' % filename)
+
+    return data['segdata'], data['voxelsize_mm'], data['offset_mm']
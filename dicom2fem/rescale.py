@@ -0,0 +1,251 @@
+"""
+Chunked, multi-threaded rescaling of 3D volumes and segmentation masks.
+
+The output volume is processed in z-slabs by a pool of threads - the
+scipy.ndimage interpolation releases the GIL. The output can be a
+memory-mapped .npy file, so that the whole output does not need to fit in
+memory.
+"""
+import warnings
+import threading
+import Queue
+from multiprocessing import cpu_count
+
+import numpy as nm
+from scipy import ndimage
+
+from base import basestr
+
+# scipy 0.18 - 1.x warns on each call of affine_transform() with a 1D matrix,
+# which is used on purpose below.
+warnings.filterwarnings('ignore', category=UserWarning,
+                        message='The behaviour of affine_transform')
+
+def get_zoom_shape(shape, zoom):
+    """
+    Get the shape of the zoomed volume as in `scipy.ndimage.zoom()`.
+    """
+    zoom = nm.resize(nm.asarray(zoom, dtype=nm.float64), len(shape))
+    return tuple(int(round(ii * iz)) for ii, iz in zip(shape, zoom))
+
+def get_integer_ratios(zoom, eps=1e-6):
+    """
+    Return the integer ratios (positive for magnification, negative for
+    reduction) of the zoom factors, or None if some factor is not an
+    integer or the reciprocal of an integer.
+    """
+    ratios = []
+    for iz in zoom:
+        if iz >= 1.0 and abs(iz - round(iz)) < eps:
+            ratios.append(int(round(iz)))
+
+        elif 0.0 < iz < 1.0 and abs(1.0 / iz - round(1.0 / iz)) < eps:
+            ratios.append(-int(round(1.0 / iz)))
+
+        else:
+            return None
+
+    return ratios
+
+def _get_output(output, shape, dtype):
+    if output is None:
+        output = nm.empty(shape, dtype=dtype)
+
+    elif isinstance(output, basestr):
+        output = nm.lib.format.open_memmap(output, mode='w+', dtype=dtype,
+                                           shape=shape)
+
+    elif output.shape != shape:
+        raise ValueError('wrong output shape! (%s == %s)'
+                         % (output.shape, shape))
+
+    return output
+
+def _run_slabs(fun, n_out, n_threads, slab_size, progress):
+    """
+    Call `fun(z0, z1)` for the z-slabs of the output in parallel threads.
+    """
+    if n_threads is None:
+        n_threads = cpu_count()
+
+    if slab_size is None:
+        # Several slabs per thread for load balancing.
+        slab_size = max(n_out // (4 * n_threads), 1)
+
+    slabs = Queue.Queue()
+    n_slabs = 0
+    for z0 in xrange(0, n_out, slab_size):
+        slabs.put((z0, min(z0 + slab_size, n_out)))
+        n_slabs += 1
+
+    done = Queue.Queue()
+    stop = threading.Event()
+    def worker():
+        while not stop.is_set():
+            try:
+                slab = slabs.get_nowait()
+
+            except Queue.Empty:
+                break
+
+            try:
+                fun(*slab)
+                done.put(None)
+
+            except Exception, exc:
+                done.put(exc)
+
+    threads = [threading.Thread(target=worker)
+               for ii in xrange(max(min(n_threads, n_slabs), 1))]
+    for thread in threads:
+        thread.start()
+
+    try:
+        for ii in xrange(n_slabs):
+            exc = done.get()
+            if exc is not None:
+                raise exc
+
+            if progress is not None:
+                progress(ii + 1, n_slabs)
+
+    finally:
+        # Skip the remaining slabs on errors and cancellation.
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+def rescale_volume(data, zoom, order=3, mode='nearest', prefilter=False,
+                   output=None, n_threads=None, slab_size=None,
+                   progress=None):
+    """
+    Rescale a 3D volume by the spline interpolation. The result is the same
+    as of `scipy.ndimage.zoom()`, but it is computed by z-slabs in
+    parallel threads.
+
+    Parameters
+    ----------
+    data : array
+        The 3D volume.
+    zoom : float or sequence
+        The zoom factors along the axes.
+    order : int
+        The spline interpolation order.
+    mode : str
+        The boundary mode, see `scipy.ndimage.zoom()`.
+    prefilter : bool
+        If True, the spline filter is applied to the whole volume first.
+    output : array or str, optional
+        The output array or the name of a .npy file to be created as a
+        memory-mapped output.
+    n_threads : int, optional
+        The number of threads. The default is the number of CPUs.
+    slab_size : int, optional
+        The number of output z-slices processed at once.
+    progress : callable, optional
+        If given, it is called as `progress(n_done, n_slabs)` after each
+        slab. It can raise an exception to cancel the rescaling.
+
+    Returns
+    -------
+    output : array
+        The rescaled volume.
+    """
+    # The output keeps the input data type as in scipy.ndimage.zoom().
+    dtype = data.dtype
+    if prefilter and order > 1:
+        data = ndimage.spline_filter(data, order=order, output=nm.float64)
+
+    in_shape = nm.array(data.shape)
+    out_shape = get_zoom_shape(data.shape, zoom)
+    output = _get_output(output, out_shape, dtype)
+
+    # The same coordinate mapping as in scipy.ndimage.zoom().
+    div = nm.array(out_shape, dtype=nm.float64) - 1
+    scale = nm.divide(in_shape - 1, div, out=nm.ones_like(div),
+                      where=div > 0)
+
+    def fun(z0, z1):
+        offset = nm.array([z0 * scale[0], 0.0, 0.0])
+        ndimage.affine_transform(data, scale, offset=offset,
+                                 output_shape=(z1 - z0,) + out_shape[1:],
+                                 output=output[z0:z1], order=order,
+                                 mode=mode, prefilter=False)
+
+    _run_slabs(fun, out_shape[0], n_threads, slab_size, progress)
+
+    return output
+
+def rescale_mask(mask, zoom, output=None, n_threads=None, slab_size=None,
+                 progress=None):
+    """
+    Rescale a 3D segmentation mask (or label volume) by the
+    nearest-neighbour interpolation.
+
+    If all zoom factors are integers or reciprocals of integers, the voxels
+    are just replicated or sampled: each voxel becomes a block of voxels
+    when magnifying, and the central voxel of each block is taken when
+    reducing. The voxel boundaries are thus kept exactly. Otherwise
+    :func:`rescale_volume()` with `order=0` is used. In both cases the
+    output shape is the same as of `scipy.ndimage.zoom()`, so a trailing
+    partial block is sampled as well when reducing.
+
+    Parameters
+    ----------
+    mask : array
+        The 3D mask.
+    zoom : float or sequence
+        The zoom factors along the axes.
+    output, n_threads, slab_size, progress
+        See :func:`rescale_volume()`.
+
+    Returns
+    -------
+    output : array
+        The rescaled mask.
+    """
+    zoom = nm.resize(nm.asarray(zoom, dtype=nm.float64), mask.ndim)
+    ratios = get_integer_ratios(zoom)
+    if ratios is None:
+        return rescale_volume(mask, zoom, order=0, output=output,
+                              n_threads=n_threads, slab_size=slab_size,
+                              progress=progress)
+
+    # The sampled input indices of reduced axes: the central voxels of the
+    # blocks, the last block may be partial.
+    out_shape = get_zoom_shape(mask.shape, zoom)
+    indices = []
+    for n_in, n_out, ratio in zip(mask.shape, out_shape, ratios):
+        if ratio > 0:
+            indices.append(None)
+
+        else:
+            starts = nm.arange(n_out) * -ratio
+            indices.append(starts + nm.minimum(-ratio, n_in - starts) // 2)
+
+    output = _get_output(output, out_shape, mask.dtype)
+
+    def fun(z0, z1):
+        if ratios[0] > 0:
+            i0 = z0 // ratios[0]
+            i1 = (z1 - 1) // ratios[0] + 1
+            crop = z0 - i0 * ratios[0]
+            aux = mask[i0:i1]
+
+        else:
+            aux = mask[indices[0][z0:z1]]
+            crop = 0
+
+        for axis in xrange(1, mask.ndim):
+            if indices[axis] is not None:
+                aux = aux.take(indices[axis], axis=axis)
+
+        for axis, ratio in enumerate(ratios):
+            if ratio > 1:
+                aux = aux.repeat(ratio, axis=axis)
+
+        output[z0:z1] = aux[crop:crop + z1 - z0]
+
+    _run_slabs(fun, out_shape[0], n_threads, slab_size, progress)
+
+    return output
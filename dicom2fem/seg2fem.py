@@ -9,7 +9,13 @@ $ seg2fem.py -f brain_seg.mat
 """
 
 from optparse import OptionParser
-from scipy.io import loadmat
+import os
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+import Queue
 import scipy.sparse as sps
 import numpy as nm
 from numpy.core import intc
@@ -17,6 +23,7 @@ from numpy.linalg import lapack_lite
 from mesh import Mesh
 from marching_cubes import marching_cubes
 from genfem_base import set_nodemtx, get_snodes_uedges
+from project import read_segmentation
 
 # compatibility
 try:
@@ -72,7 +79,7 @@ def elems_q2t(el):
 
 def smooth_mesh(mesh, n_iter=4, lam=0.6307, mu=-0.6347,
                 weights=None, bconstr=True,
-                volume_corr=False):
+                volume_corr=False, progress=None):
     """
     FE mesh smoothing.
 
@@ -100,6 +107,10 @@ def smooth_mesh(mesh, n_iter=4, lam=0.6307, mu=-0.6347,
         Boundary constraints, if True only surface smoothing performed.
     volume_corr: logical, optional
         Correct volume after smoothing process.
+    progress : callable, optional
+        If given, it is called as `progress(step, n_steps)` after each
+        smoothing iteration. It can raise an exception to cancel the
+        smoothing.
 
     Returns
     -------
@@ -125,6 +136,9 @@ def smooth_mesh(mesh, n_iter=4, lam=0.6307, mu=-0.6347,
             else:
                 coors += mu * displ
 
+            if progress is not None:
+                progress(ii + 1, n_iter + 1)
+
         return coors
 
     def dets_fast(a):
@@ -216,9 +230,12 @@ def smooth_mesh(mesh, n_iter=4, lam=0.6307, mu=-0.6347,
         scale = volume0 / volume
         coors = (coors - bc) * scale + bc
 
+    if progress is not None:
+        progress(n_iter + 1, n_iter + 1)
+
     return coors
 
-def gen_mesh_from_voxels(voxels, dims, etype='q', mtype='v'):
+def gen_mesh_from_voxels(voxels, dims, etype='q', mtype='v', progress=None):
     """
     Generate FE mesh from voxels (volumetric data).
 
@@ -234,6 +251,10 @@ def gen_mesh_from_voxels(voxels, dims, etype='q', mtype='v'):
     mtype : integer, optional
         'v' - volumetric mesh
         's' - surface mesh
+    progress : callable, optional
+        If given, it is called as `progress(step, n_steps)` after each
+        generation phase. It can raise an exception to cancel the
+        generation.
 
     Returns
     -------
@@ -241,6 +262,9 @@ def gen_mesh_from_voxels(voxels, dims, etype='q', mtype='v'):
         Finite element mesh.
     """
 
+    if progress is None:
+        progress = lambda step, n_steps: None
+
     dims = dims.squeeze()
     dim = len(dims)
     nddims = nm.array(voxels.shape) + 2
@@ -257,6 +281,7 @@ def gen_mesh_from_voxels(voxels, dims, etype='q', mtype='v'):
 
     nodeid = -nm.ones(nddims, dtype=nm.int32)
     nodeid[ndidx] = nm.arange(nnod)
+    progress(1, 4)
 
     if mtype == 's':
         felems = []
@@ -372,6 +397,8 @@ def gen_mesh_from_voxels(voxels, dims, etype='q', mtype='v'):
 
             edim = 2
 
+    progress(2, 4)
+
     # reduce inner nodes
     if mtype == 's':
         aux = nm.zeros((nnod,), dtype=nm.int32)
@@ -390,6 +417,8 @@ def gen_mesh_from_voxels(voxels, dims, etype='q', mtype='v'):
         for ii in range(elems.shape[1]):
             elems[:,ii] = aux[elems[:,ii]]
 
+    progress(3, 4)
+
     if etype == 't':
         elems = elems_q2t(elems)
 
@@ -401,14 +430,224 @@ def gen_mesh_from_voxels(voxels, dims, etype='q', mtype='v'):
                           {0: nm.ascontiguousarray(elems)},
                           {0: nm.ones((nel,), dtype=nm.int32)},
                           {0: '%d_%d' % (edim, nelnd)})
+    progress(4, 4)
 
     return mesh
 
+def run_gmsh(args, timeout=None, gmsh='gmsh', cwd=None, log_callback=None,
+             poll_interval=0.1):
+    """
+    Run gmsh as an external process.
+
+    Parameters
+    ----------
+    args : list
+        The gmsh command line arguments.
+    timeout : float, optional
+        The time limit in seconds. The process is killed when exceeded.
+    gmsh : str, optional
+        The gmsh executable.
+    cwd : str, optional
+        The working directory of the process.
+    log_callback : callable, optional
+        If given, it is called with each line printed by gmsh, in the
+        calling thread. It can raise an exception to cancel the run - the
+        process is killed then.
+    poll_interval : float, optional
+        The interval of checking the process state in seconds.
+
+    Returns
+    -------
+    log : list
+        The lines printed by gmsh.
+    elapsed : float
+        The run time in seconds.
+    """
+    tt = time.time()
+    try:
+        proc = subprocess.Popen([gmsh] + list(args), cwd=cwd,
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+
+    except OSError, exc:
+        raise RuntimeError('cannot run gmsh! (%s: %s)' % (gmsh, exc))
+
+    lines = Queue.Queue()
+    def read_output():
+        for line in iter(proc.stdout.readline, ''):
+            lines.put(line.rstrip())
+
+    log = []
+    def flush_log():
+        while 1:
+            try:
+                line = lines.get_nowait()
+
+            except Queue.Empty:
+                break
+
+            log.append(line)
+            if log_callback is not None:
+                log_callback(line)
+
+    reader = threading.Thread(target=read_output)
+    reader.daemon = True
+    reader.start()
+
+    try:
+        while proc.poll() is None:
+            if (timeout is not None) and ((time.time() - tt) > timeout):
+                raise RuntimeError('gmsh timed out after %.1f s!' % timeout)
+
+            flush_log()
+            time.sleep(poll_interval)
+
+    finally:
+        # Timeout or cancelled by log_callback.
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+            # Children of the process may still hold the output pipe.
+            reader.join(poll_interval)
+
+    reader.join()
+    flush_log()
+    elapsed = time.time() - tt
+
+    if proc.returncode != 0:
+        raise RuntimeError('gmsh failed with exit code %d:\n%s'
+                           % (proc.returncode, '\n'.join(log[-10:])))
+
+    return log, elapsed
+
+def gen_volume_mesh_gmsh(mesh, scale_factor=0.25, timeout=None,
+                         gmsh='gmsh', log_callback=None, ret_log=False):
+    """
+    Generate a tetrahedral volume mesh bounded by a triangulated surface
+    mesh using gmsh.
+
+    The surface and the gmsh input files are written to a unique temporary
+    directory, so that several meshing jobs can run concurrently. The
+    directory is removed afterwards.
+
+    Parameters
+    ----------
+    mesh : Mesh
+        The closed triangulated surface mesh.
+    scale_factor : float, optional
+        The gmsh characteristic length factor.
+    timeout : float, optional
+        The gmsh time limit in seconds.
+    gmsh : str, optional
+        The gmsh executable.
+    log_callback : callable, optional
+        If given, it is called with each line printed by gmsh, see
+        :func:`run_gmsh()`.
+    ret_log : bool, optional
+        If True, return also the gmsh output lines and the run time.
+
+    Returns
+    -------
+    mesh : Mesh
+        The volume mesh.
+    log : list, optional
+        The lines printed by gmsh.
+    elapsed : float, optional
+        The gmsh run time in seconds.
+    """
+    tmpdir = tempfile.mkdtemp(prefix='dicom2fem_gmsh_')
+    try:
+        stl_fn = os.path.join(tmpdir, 'surf.stl')
+        geo_fn = os.path.join(tmpdir, 'surf2vol.geo')
+        mesh_fn = os.path.join(tmpdir, 'vol.mesh')
+
+        mesh.write(stl_fn, io='auto')
+        geofile = open(geo_fn, 'wt')
+        geofile.write(gmsh3d_geo.replace('__INFILE__',
+                                         stl_fn).replace('__SCFACTOR__',
+                                                         str(scale_factor)))
+        geofile.close()
+
+        output('running gmsh...')
+        log, elapsed = run_gmsh(['-3', '-format', 'mesh', '-o', mesh_fn,
+                                 geo_fn], timeout=timeout, gmsh=gmsh,
+                                cwd=tmpdir, log_callback=log_callback)
+        output('...done in %.2f s' % elapsed)
+
+        if not os.path.exists(mesh_fn):
+            raise RuntimeError('gmsh did not create the volume mesh:\n%s'
+                               % '\n'.join(log[-10:]))
+
+        vmesh = Mesh.from_file(mesh_fn)
+
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    if ret_log:
+        return vmesh, log, elapsed
+
+    else:
+        return vmesh
+
+def gen_volume_meshes_gmsh(meshes, n_jobs=None, **kwargs):
+    """
+    Run several gmsh volume meshing jobs concurrently, see
+    :func:`gen_volume_mesh_gmsh()`.
+
+    Parameters
+    ----------
+    meshes : list
+        The surface meshes.
+    n_jobs : int, optional
+        The number of concurrent gmsh processes. The default is the number
+        of CPUs.
+    **kwargs : dict, optional
+        The arguments passed to :func:`gen_volume_mesh_gmsh()`.
+
+    Returns
+    -------
+    vmeshes : list
+        The volume meshes in the order of `meshes`.
+    """
+    from multiprocessing import cpu_count
+    from multiprocessing.pool import ThreadPool
+
+    if n_jobs is None:
+        n_jobs = cpu_count()
+
+    # The work is done by the external processes, so threads suffice.
+    pool = ThreadPool(max(min(n_jobs, len(meshes)), 1))
+    try:
+        vmeshes = pool.map(lambda mesh: gen_volume_mesh_gmsh(mesh, **kwargs),
+                           meshes)
+
+    finally:
+        pool.close()
+        pool.join()
+
+    return vmeshes
+
 def gen_mesh_from_voxels_mc(voxels, voxelsize,
-                            gmsh3d=False, scale_factor=0.25):
+                            gmsh3d=False, scale_factor=0.25,
+                            gmsh_timeout=None, progress=None):
+    """
+    Generate a triangulated surface mesh by the marching cubes algorithm,
+    optionally remeshed to a tetrahedral volume mesh by gmsh.
+
+    The optional `progress` callable is called as `progress(step,
+    n_steps)` after each generation phase, and also with each line printed
+    by gmsh. It can raise an exception to cancel the generation, including
+    a running gmsh.
+    """
     import scipy.spatial as scsp
 
+    if progress is None:
+        progress = lambda step, n_steps: None
+
+    n_steps = 3 if gmsh3d else 2
+
     tri = marching_cubes(voxels, voxelsize)
+    progress(1, n_steps)
 
     nel, nnd, dim = tri.shape
     coors = tri.reshape((nel * nnd, dim))
@@ -435,32 +674,47 @@ def gen_mesh_from_voxels_mc(voxels, voxelsize,
                           {0: nm.ascontiguousarray(ntri.reshape((nel, nnd)))},
                           {0: nm.ones((nel,), dtype=nm.int32)},
                           {0: '%d_%d' % (2, 3)})
+    progress(2, n_steps)
 
     if gmsh3d:
-        from vtk2stl import vtk2stl
-        import tempfile
-        import os
-
-        auxfile = os.path.join(tempfile.gettempdir(), 'dicom2fem_aux')
-        vtk_fn = auxfile + '_surfmc.vtk'
-        stl_fn = auxfile + '_surfmc.stl'
-        geo_fn = auxfile + '_surf2vol.geo'
-        mesh_fn = auxfile + '_volmv.mesh'
-        mesh.write(vtk_fn)
-        vtk2stl(vtk_fn, stl_fn)
-        geofile = open(geo_fn, 'wt')
-        geofile.write(gmsh3d_geo.replace('__INFILE__',
-                                         stl_fn).replace('__SCFACTOR__',
-                                                         str(scale_factor)))
-        geofile.close()
-        os.system('gmsh -3 -format mesh -o %s %s' % (mesh_fn, geo_fn))
-        mesh = Mesh.from_file(mesh_fn)
+        def log_callback(line):
+            # Report the running gmsh, so that it can be cancelled.
+            progress(2, n_steps)
+
+        mesh = gen_volume_mesh_gmsh(mesh, scale_factor=scale_factor,
+                                    timeout=gmsh_timeout,
+                                    log_callback=log_callback)
+        progress(3, n_steps)
 
     return mesh
 
+smooth_methods = {
+    'taubin vol.': (smooth_mesh, {'n_iter': 10, 'volume_corr': True,
+                             'lam': 0.6307, 'mu': -0.6347}),
+    'taubin': (smooth_mesh, {'n_iter': 10, 'volume_corr': False,
+                             'lam': 0.6307, 'mu': -0.6347}),
+
+    }
+
+mesh_generators = {
+    'surface/tri': (6, gen_mesh_from_voxels, {'etype': 't', 'mtype': 's'}),
+    'surface/quad': (5, gen_mesh_from_voxels, {'etype': 'q', 'mtype': 's'}),
+    'volume/tetra': (4, gen_mesh_from_voxels, {'etype': 't', 'mtype': 'v'}),
+    'volume/hexa': (3, gen_mesh_from_voxels, {'etype': 'q', 'mtype': 'v'}),
+    'march. cubes - surf.': (2, gen_mesh_from_voxels_mc, {}),
+    'march. cubes - vol.': (1, gen_mesh_from_voxels_mc, {'gmsh3d': True}),
+    }
+
+elem_tab = {
+    '2_3': 'triangles',
+    '3_4': 'tetrahedrons',
+    '2_4': 'quads',
+    '3_8': 'hexahedrons'
+    }
+
 usage = '%prog [options]\n' + __doc__.rstrip()
 help = {
-    'in_file': 'input *.seg file with segmented data',
+    'in_file': 'input project or *.seg file with segmented data',
     'out_file': 'output mesh file',
 }
 
@@ -478,11 +732,9 @@ def main():
         raise IOError('No input data!')
 
     else:
-        dataraw = loadmat(options.in_filename,
-                          variable_names=['segdata', 'voxelsizemm'])
+        segdata, voxelsize, offset = read_segmentation(options.in_filename)
 
-    mesh = gen_mesh_from_voxels(dataraw['segdata'],
-                                dataraw['voxelsizemm'] * 1e-3,
+    mesh = gen_mesh_from_voxels(segdata, voxelsize * 1e-3,
                                 etype='t', mtype='s')
 
     ncoors = smooth_mesh(mesh, n_iter=34, lam=0.6307, mu=-0.6347)
@@ -0,0 +1,150 @@
+"""
+Content-addressed on-disk cache of intermediate pipeline meshes.
+
+The meshes are stored as HDF5 files named by the SHA1 hash of the stage
+inputs and parameters. The least recently used files are removed when the
+total cache size exceeds the limit.
+"""
+import os
+import os.path as op
+import json
+import hashlib
+import tempfile
+
+import numpy as nm
+
+from base import output
+from mesh import Mesh
+from meshio import HDF5MeshIO
+
+def get_hash(*args):
+    """
+    Get the SHA1 hex digest of arrays and JSON-serializable parameters.
+    """
+    sha1 = hashlib.sha1()
+    for arg in args:
+        if isinstance(arg, nm.ndarray):
+            sha1.update('%s%s' % (arg.dtype.str, arg.shape))
+            sha1.update(nm.ascontiguousarray(arg).data)
+
+        else:
+            sha1.update(json.dumps(arg, sort_keys=True))
+
+    return sha1.hexdigest()
+
+class StageCache(object):
+    """
+    The cache of meshes in directory `dirname` with the total size limited
+    to `max_size` bytes. Subclasses can store other objects by overriding
+    `suffix`, :func:`read()` and :func:`write()`.
+    """
+    suffix = '.h5'
+
+    def __init__(self, dirname, max_size=2**30):
+        self.dirname = dirname
+        self.max_size = max_size
+
+        if not op.exists(dirname):
+            try:
+                os.makedirs(dirname)
+
+            except OSError: # Created by another process meanwhile.
+                pass
+
+        else:
+            self.evict()
+
+    get_key = staticmethod(get_hash)
+
+    def get_filename(self, key):
+        return op.join(self.dirname, key + self.suffix)
+
+    def __contains__(self, key):
+        return op.exists(self.get_filename(key))
+
+    def read(self, filename):
+        return Mesh.from_file(filename)
+
+    def write(self, filename, mesh):
+        HDF5MeshIO(filename).write(filename, mesh)
+
+    def load(self, key):
+        """
+        Load the mesh stored under `key`, or return None.
+        """
+        filename = self.get_filename(key)
+        try:
+            mesh = self.read(filename)
+
+        except (IOError, OSError):
+            return None
+
+        # Mark as recently used.
+        try:
+            os.utime(filename, None)
+
+        except OSError:
+            pass
+
+        return mesh
+
+    def save(self, key, mesh):
+        """
+        Store `mesh` under `key` and evict the least recently used meshes
+        if the cache is too large.
+        """
+        # Write to a temporary file first, so that concurrent readers never
+        # see incomplete files.
+        fd, tmp_filename = tempfile.mkstemp(suffix=self.suffix + '.tmp',
+                                            dir=self.dirname)
+        os.close(fd)
+        try:
+            self.write(tmp_filename, mesh)
+            os.rename(tmp_filename, self.get_filename(key))
+
+        finally:
+            if op.exists(tmp_filename):
+                os.remove(tmp_filename)
+
+        self.evict()
+
+    def get_entries(self):
+        """
+        Return the list of (modification time, size, file name) of the
+        cached meshes.
+        """
+        entries = []
+        for fn in os.listdir(self.dirname):
+            if not fn.endswith(self.suffix):
+                continue
+
+            filename = op.join(self.dirname, fn)
+            try:
+                stat = os.stat(filename)
+
+            except OSError:
+                continue
+
+            entries.append((stat.st_mtime, stat.st_size, filename))
+
+        return entries
+
+    def evict(self):
+        """
+        Remove the least recently used meshes until the cache size is
+        within the limit.
+        """
+        entries = sorted(self.get_entries())
+        size = sum(entry[1] for entry in entries)
+        for mtime, fsize, filename in entries:
+            if size <= self.max_size:
+                break
+
+            try:
+                os.remove(filename)
+
+            except OSError:
+                pass
+
+            output('evicted %s from cache' % op.basename(filename))
+            size -= fsize
@@ -10,10 +10,113 @@ $ viewer.py -f head.vtk
 from optparse import OptionParser
 import sys
 
-from PyQt4.QtGui import QApplication, QDialog, QGridLayout, QPushButton 
+import numpy as nm
+from PyQt4.QtGui import QApplication, QDialog, QGridLayout, QPushButton
 from vtk.qt4.QVTKRenderWindowInteractor import QVTKRenderWindowInteractor
+from vtk.util import numpy_support
 import vtk
 
+from mesh import Mesh
+from genfem_base import get_surface_faces
+from decimate import decimate_clustering
+from stagecache import get_hash
+
+vtk_id_dtype = nm.dtype('i%d' % vtk.vtkIdTypeArray().GetDataTypeSize())
+
+def mesh_to_polydata(mesh):
+    """
+    Build the VTK surface of a mesh without any file I/O. The boundary
+    faces of volume elements and the surface elements are stored as
+    polygons with the material ids as cell scalars.
+
+    Parameters
+    ----------
+    mesh : Mesh
+        The mesh.
+
+    Returns
+    -------
+    polydata : vtkPolyData
+        The mesh surface.
+    arrays : list
+        The numpy arrays shared with `polydata` - they must be kept alive
+        as long as `polydata` is used.
+    """
+    # Shared without copying, if the coordinates are already 3D doubles.
+    if mesh.dim == 3:
+        coors = nm.ascontiguousarray(mesh.coors, dtype=nm.float64)
+
+    else:
+        coors = nm.zeros((mesh.n_nod, 3), dtype=nm.float64)
+        coors[:, :mesh.dim] = mesh.coors
+
+    cells = []
+    mat_ids = []
+    for ig, conn in enumerate(mesh.conns):
+        desc = mesh.descs[ig]
+        mat_id = mesh.mat_ids[ig]
+        if desc[0] == '3':
+            conn, iels = get_surface_faces(conn, desc)
+            mat_id = mat_id[iels]
+
+        elif desc[0] != '2':
+            continue
+
+        # The VTK cell array layout: n_vertex, vertex ids, ...
+        aux = nm.empty((conn.shape[0], conn.shape[1] + 1),
+                       dtype=vtk_id_dtype)
+        aux[:, 0] = conn.shape[1]
+        aux[:, 1:] = conn
+        cells.append(aux.ravel())
+        mat_ids.append(mat_id)
+
+    if len(cells):
+        cells = nm.concatenate(cells)
+        mat_ids = nm.concatenate(mat_ids).astype(nm.int32)
+
+    else:
+        cells = nm.empty((0,), dtype=vtk_id_dtype)
+        mat_ids = nm.empty((0,), dtype=nm.int32)
+
+    points = vtk.vtkPoints()
+    points.SetData(numpy_support.numpy_to_vtk(coors, deep=False))
+
+    polys = vtk.vtkCellArray()
+    polys.SetCells(mat_ids.shape[0],
+                   numpy_support.numpy_to_vtkIdTypeArray(cells, deep=False))
+
+    scalars = numpy_support.numpy_to_vtk(mat_ids, deep=False)
+    scalars.SetName('mat_id')
+
+    polydata = vtk.vtkPolyData()
+    polydata.SetPoints(points)
+    polydata.SetPolys(polys)
+    polydata.GetCellData().SetScalars(scalars)
+
+    return polydata, [coors, cells, mat_ids]
+
+# The (key, preview mesh) pairs of recently viewed meshes, the latest last.
+lod_cache = []
+
+def get_lod_mesh(mesh, n_tri, cache_size=4):
+    """
+    Get the decimated preview of `mesh` with at most `n_tri` surface
+    triangles, see :func:`decimate.decimate_clustering()`. The previews of
+    the last `cache_size` meshes are cached.
+    """
+    key = get_hash(mesh.coors, n_tri, *(mesh.conns + mesh.mat_ids))
+    for ii, (ikey, lod) in enumerate(lod_cache):
+        if ikey == key:
+            lod_cache.append(lod_cache.pop(ii))
+            return lod
+
+    lod = decimate_clustering(mesh, n_tri)
+    if lod is not mesh:
+        lod_cache.append((key, lod))
+        del lod_cache[:-cache_size]
+
+    return lod
+
 class QVTKViewer(QDialog):
     """
     Simple VTK Viewer.
@@ -25,22 +128,31 @@ class QVTKViewer(QDialog):
         self.vtkWidget = QVTKRenderWindowInteractor(self)
         grid.addWidget(self.vtkWidget, 0, 0, 1, 1)
 
+        self.btn_full = QPushButton("full resolution", self)
+        self.btn_full.setCheckable(True)
+        self.btn_full.toggled.connect(self.setFullResolution)
+        self.btn_full.hide()
+        grid.addWidget(self.btn_full, 1, 0, 1, 1)
+
         btn_close = QPushButton("close", self)
         btn_close.clicked.connect(self.close)
-        grid.addWidget(btn_close, 1, 0, 1, 1)
-        
+        grid.addWidget(btn_close, 2, 0, 1, 1)
+
         self.setLayout(grid)
         self.setWindowTitle('VTK Viewer')
         self.show()
 
-    def __init__(self, vtk_filename):
+    def __init__(self, mesh, preview_tri=200000):
         """
         Initiate Viwer
 
         Parameters
         ----------
-        vtk_filename : str
-            Input VTK filename
+        mesh : Mesh or str
+            Input mesh or mesh filename
+        preview_tri : int
+            Maximum number of surface triangles rendered, larger surfaces
+            are decimated until the full resolution is requested
         """
 
         QDialog.__init__(self)
@@ -50,21 +162,26 @@ class QVTKViewer(QDialog):
         self.vtkWidget.GetRenderWindow().AddRenderer(ren)
         iren = self.vtkWidget.GetRenderWindow().GetInteractor()
 
-        # VTK file
-        reader = vtk.vtkUnstructuredGridReader()
-        reader.SetFileName(vtk_filename)
-        reader.Update()
+        if not isinstance(mesh, Mesh):
+            mesh = Mesh.from_file(mesh)
+
+        self.mesh = mesh
+        self.surfaces = {}
 
         # VTK surface
-        surface=vtk.vtkDataSetSurfaceFilter()
-        surface.SetInput(reader.GetOutput())
-        surface.Update()
+        lod = get_lod_mesh(mesh, preview_tri)
+        self.surfaces[lod is mesh] = mesh_to_polydata(lod)
+        if lod is not mesh:
+            self.btn_full.show()
 
-        mapper = vtk.vtkDataSetMapper()
-        mapper.SetInput(surface.GetOutput())
+        mat_ids = nm.concatenate(mesh.mat_ids)
+        self.mapper = vtk.vtkPolyDataMapper()
+        self.mapper.SetInput(self.surfaces[lod is mesh][0])
+        if len(mat_ids):
+            self.mapper.SetScalarRange(mat_ids.min(), mat_ids.max())
 
         actor = vtk.vtkActor()
-        actor.SetMapper(mapper)
+        actor.SetMapper(self.mapper)
         actor.GetProperty().EdgeVisibilityOn()
         actor.GetProperty().SetEdgeColor(1,1,1)
         actor.GetProperty().SetLineWidth(0.5)
@@ -88,10 +205,17 @@ class QVTKViewer(QDialog):
 
         ren.ResetCamera()
         iren.Initialize()
+
+    def setFullResolution(self, full):
+        if full not in self.surfaces:
+            self.surfaces[full] = mesh_to_polydata(self.mesh)
+
+        self.mapper.SetInput(self.surfaces[full][0])
+        self.vtkWidget.GetRenderWindow().Render()
         
 usage = '%prog [options]\n' + __doc__.rstrip()
 help = {
-    'in_file': 'input VTK file with unstructured mesh',
+    'in_file': 'input mesh file',
 }
   
 def main():
@@ -102,7 +226,7 @@ def main():
     (options, args) = parser.parse_args()
 
     if options.in_filename is None:
-        raise IOError('No VTK data!')
+        raise IOError('No mesh data!')
 
     app = QApplication(sys.argv)
     viewer = QVTKViewer(options.in_filename)
@@ -2,21 +2,17 @@
 # -*- coding: utf-8 -*-
 import sys
 import os
-import vtk
 
-def vtk2stl(fn_in, fn_out):
-
-    reader = vtk.vtkDataSetReader()
-    reader.SetFileName(fn_in)
-    reader.Update()
+from mesh import Mesh
+from meshio import STLMeshIO
 
-    gfilter = vtk.vtkGeometryFilter()
-    gfilter.SetInput(reader.GetOutput())
-
-    writer = vtk.vtkSTLWriter()
-    writer.SetFileName(fn_out)
-    writer.SetInput(gfilter.GetOutput())
-    writer.Write()
+def vtk2stl(fn_in, fn_out):
+    """
+    Convert a mesh to a binary STL file. The boundary faces of volume
+    elements are written.
+    """
+    mesh = Mesh.from_file(fn_in)
+    mesh.write(fn_out, io=STLMeshIO(fn_out))
 
 def main():
     fname, ext = os.path.splitext(sys.argv[1])
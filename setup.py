@@ -72,9 +72,10 @@ setup(
     # To provide executable scripts, use entry points in preference to the
     # "scripts" keyword. Entry points provide cross-platform support and allow
     # pip to create the appropriate form of executable for the target platform.
-    # entry_points={
-    #     'console_scripts': [
-    #         'sample=sample:main',
-    #     ],
-    # },
+    entry_points={
+        'console_scripts': [
+            'dicom2fem-convert=dicom2fem.convert:main',
+            'dicom2fem-batch=dicom2fem.pipeline:main',
+        ],
+    },
 )
@@ -0,0 +1,158 @@
+import os
+import os.path as op
+import shutil
+import tempfile
+import unittest
+
+import numpy as nm
+
+from dicom2fem.mesh import Mesh
+
+def make_mesh():
+    """
+    Two hexahedra and two tetrahedra in two groups with different material
+    ids.
+    """
+    coors = nm.array([[0, 0, 0], [1, 0, 0], [1, 1, 0], [0, 1, 0],
+                      [0, 0, 1], [1, 0, 1], [1, 1, 1], [0, 1, 1],
+                      [2, 0, 0], [2, 1, 0], [2, 0, 1], [2, 1, 1]],
+                     dtype=nm.float64)
+    ngroups = nm.zeros((coors.shape[0],), dtype=nm.int32)
+    hexa = nm.array([[0, 1, 2, 3, 4, 5, 6, 7]], dtype=nm.int32)
+    tetra = nm.array([[1, 8, 9, 10], [2, 9, 11, 6]], dtype=nm.int32)
+
+    return Mesh.from_data('test', coors, ngroups, [hexa, tetra],
+                          [nm.array([1], dtype=nm.int32),
+                           nm.array([2, 2], dtype=nm.int32)],
+                          ['3_8', '3_4'])
+
+class TestVTKMeshIO(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def _check_round_trip(self, binary):
+        mesh = make_mesh()
+        filename = op.join(self.output_dir, 'mesh_%s.vtk' % binary)
+        mesh.write(filename, io='auto', binary=binary)
+
+        mesh2 = Mesh.from_file(filename)
+        self.assertEqual(mesh2.n_el, mesh.n_el)
+        self.assertTrue(nm.allclose(mesh2.coors, mesh.coors))
+
+        for ig, desc in enumerate(mesh.descs):
+            ig2 = mesh2.descs.index(desc)
+            self.assertTrue(nm.all(mesh2.conns[ig2] == mesh.conns[ig]))
+            self.assertTrue(nm.all(mesh2.mat_ids[ig2] == mesh.mat_ids[ig]))
+
+    def test_round_trip_ascii(self):
+        self._check_round_trip(False)
+
+    def test_round_trip_binary(self):
+        self._check_round_trip(True)
+
+# The cards of the make_mesh() mesh, the CHEXA with a continuation.
+bdf_cards = [
+    ['GRID', 1, 0, '0.', '0.', '0.'],
+    ['GRID', 2, 0, '1.', '0.', '0.'],
+    ['GRID', 3, 0, '1.', '1.', '0.'],
+    ['GRID', 4, 0, '0.', '1.', '0.'],
+    ['GRID', 5, 0, '0.', '0.', '1.'],
+    ['GRID', 6, 0, '1.', '0.', '1.'],
+    ['GRID', 7, 0, '1.', '1.', '1.'],
+    ['GRID', 8, 0, '0.', '1.', '1.'],
+    ['GRID', 9, 0, '2.', '0.', '0.'],
+    ['GRID', 10, 0, '2.', '1.', '0.'],
+    ['GRID', 11, 0, '2.0+0', '0.', '1.'],
+    ['GRID', 12, 0, '2.', '1.', '1.0-0'],
+    ['CHEXA', 1, 1, 1, 2, 3, 4, 5, 6, '+C1'],
+    ['+C1', 7, 8],
+    ['CTETRA', 2, 2, 2, 9, 10, 11],
+    ['CTETRA', 3, 2, 3, 10, 12, 7],
+]
+
+class TestBDFMeshIO(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def _read(self, lines):
+        filename = op.join(self.output_dir, 'mesh.bdf')
+        fd = open(filename, 'w')
+        fd.write('$ comment\nBEGIN BULK\n' + '\n'.join(lines)
+                 + '\nENDDATA\n')
+        fd.close()
+
+        return Mesh.from_file(filename)
+
+    def _check_mesh(self, mesh2, mesh=None):
+        if mesh is None:
+            mesh = make_mesh()
+
+        self.assertEqual(mesh2.n_el, mesh.n_el)
+        self.assertTrue(nm.allclose(mesh2.coors, mesh.coors))
+
+        for ig, desc in enumerate(mesh.descs):
+            ig2 = mesh2.descs.index(desc)
+            self.assertTrue(nm.all(mesh2.conns[ig2] == mesh.conns[ig]))
+            self.assertTrue(nm.all(mesh2.mat_ids[ig2] == mesh.mat_ids[ig]))
+
+    def test_round_trip(self):
+        mesh = make_mesh()
+        filename = op.join(self.output_dir, 'mesh.bdf')
+        mesh.write(filename, io='auto')
+
+        self._check_mesh(Mesh.from_file(filename), mesh)
+
+    def test_read_fixed(self):
+        lines = [''.join('%-8s' % val for val in card) for card in bdf_cards]
+        self._check_mesh(self._read(lines))
+
+    def test_read_large_field(self):
+        lines = []
+        for card in bdf_cards:
+            if card[0] == 'GRID':
+                lines.append('%-8s%-16s%-16s%-16s%-16s%-8s'
+                             % ('GRID*', card[1], card[2], card[3], card[4],
+                                '*G%d' % card[1]))
+                lines.append('%-8s%-16s' % ('*G%d' % card[1], card[5]))
+
+            else:
+                lines.append(''.join('%-8s' % val for val in card))
+
+        self._check_mesh(self._read(lines))
+
+    def test_read_free_field(self):
+        lines = [','.join(str(val) for val in card) for card in bdf_cards]
+        self._check_mesh(self._read(lines))
+
+        # Large field free-field cards and a CHEXA without continuation.
+        lines = []
+        for card in bdf_cards:
+            if card[0] == 'GRID':
+                lines.append('GRID*,%s,,%s,%s,*' % (card[1], card[3], card[4]))
+                lines.append('*,%s' % card[5])
+
+            elif card[0] == 'CHEXA':
+                lines.append('CHEXA,1,1,1,2,3,4,5,6,7,8')
+
+            elif card[0] != '+C1':
+                lines.append(','.join(str(val) for val in card))
+
+        self._check_mesh(self._read(lines))
+
+    def test_read_whitespace(self):
+        lines = [' '.join(str(val) for val in card) for card in bdf_cards]
+        self._check_mesh(self._read(lines))
+
+        lines = ['\t'.join(str(val) for val in card) for card in bdf_cards]
+        self._check_mesh(self._read(lines))
+
+if __name__ == '__main__':
+    unittest.main()